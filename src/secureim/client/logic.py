@@ -10,6 +10,10 @@ SERVER_HOST = '0.0.0.0'
 SERVER_PORT = 12345
 P2P_PORT = 54321
 
+# 好友列表分页：每页数量，以及后台继续加载后续页的间隔（毫秒）
+FRIENDS_PAGE_SIZE = 100
+FRIENDS_PAGE_INTERVAL_MS = 300
+
 class ClientLogic(QObject):
     # Signals for UI updates
     login_success_signal = pyqtSignal(str)
@@ -22,10 +26,12 @@ class ClientLogic(QObject):
     
     generic_response_signal = pyqtSignal(dict)
     online_friends_updated_signal = pyqtSignal(list)
+    friends_page_received_signal = pyqtSignal(list)  # 后续分页到达，追加到好友列表
     friend_status_updated_signal = pyqtSignal(dict)
     friend_removed_signal = pyqtSignal(str)
 
     incoming_message_signal = pyqtSignal(dict)
+    ai_stream_chunk_signal = pyqtSignal(dict)  # AI流式回复的增量，携带目前为止的完整文本
     incoming_stego_signal = pyqtSignal(dict)
     incoming_file_signal = pyqtSignal(dict)
     logout_success_signal = pyqtSignal()
@@ -48,11 +54,16 @@ class ClientLogic(QObject):
         self._p2p_addresses = {} # friend_username -> (ip, port)
         self._friends_data = {}  # friend_username -> friend_data_dict
         self._pending_messages = {} # friend_username -> [payload, ...]
+        self._ai_streams = {}  # stream_id -> {"parts": [...], "next_seq": int, "early": {seq: payload}}
         self._p2p_handshake_timers = {} # friend_username -> QTimer
+        self._friends_next_cursor = None  # 好友列表下一页游标
+        self._friends_page_pending = False
+        self._friends_generation = 0  # 每次重新加载好友列表加一，丢弃旧加载过程中迟到的分页
 
         self.network = Networking(SERVER_HOST, SERVER_PORT, P2P_PORT)
         self.network.server_message_received_signal.connect(self.handle_server_message)
         self.network.p2p_message_received_signal.connect(self.handle_p2p_message)
+        self.network.p2p_peer_unreachable_signal.connect(self._handle_p2p_peer_unreachable)
         self.network.connection_failed_signal.connect(self.connection_failed_signal.emit)
         self._mode_sync_pending = {}
         self._pending_mode_requests = {}
@@ -86,12 +97,16 @@ class ClientLogic(QObject):
         elif msg_type == "all_friends_list":
             self._friends_data = {f['username']: f for f in payload}
             self.online_friends_updated_signal.emit(payload)
+        elif msg_type == "friends_page":
+            self._handle_friends_page(payload)
         elif msg_type == "public_key_response":
             self._handle_public_key_response(payload)
         elif msg_type == "receive_session_key":
             self._handle_receive_session_key(payload)
         elif msg_type == "receive_message":
             self._handle_receive_message(payload)
+        elif msg_type == "ai_stream_chunk":
+            self._handle_ai_stream_chunk(payload)
         elif msg_type == "friend_status_update":
             self._handle_friend_status_update(payload)
         elif msg_type == "p2p_connection_info":
@@ -114,6 +129,17 @@ class ClientLogic(QObject):
             self._handle_mode_change_response(payload)
         elif msg_type == "mode_change_notification":
             self._handle_mode_change_notification(payload)
+        elif msg_type == "offline_messages":
+            self._handle_offline_messages(payload)
+
+    def _handle_offline_messages(self, payload):
+        """按顺序处理离线期间的消息，并向服务器确认已收到。"""
+        messages = payload.get("messages", [])
+        for message in messages:
+            self.handle_server_message({"type": message.get("type"), "payload": message.get("payload", {})})
+        if messages:
+            self.network.send_request({"type": "ack_offline_messages",
+                                       "payload": {"upto_seq": messages[-1].get("seq")}})
 
     def _handle_mode_change_request(self, payload):
         """处理来自其他用户的模式切换请求"""
@@ -298,6 +324,9 @@ class ClientLogic(QObject):
                 self.p2p_status_updated_signal.emit(username, 'cs')
             except IndexError:
                 pass
+        elif action == "relay_session_key" and status == "success":
+            # 会话密钥已存入对方的离线队列，随后的消息会单独得到回复，这里不再提示
+            print(f"[DEBUG] {data.get('message')}")
         else:
             self.generic_response_signal.emit(data)
 
@@ -393,6 +422,39 @@ class ClientLogic(QObject):
                 "timestamp": timestamp
             })
 
+    def _handle_ai_stream_chunk(self, payload):
+        """按序号拼接AI流式回复的增量帧，每收到一段就通知界面刷新该条消息。"""
+        sender = payload.get("from")
+        aes_key = self._session_keys.get(sender)
+        stream_id = payload.get("stream_id")
+        if not aes_key or not stream_id:
+            print(f"Dropped stream chunk from {sender}: no session key.")
+            return
+
+        stream = self._ai_streams.setdefault(stream_id, {"parts": [], "next_seq": 0, "early": {}})
+        stream["early"][payload.get("seq", 0)] = payload
+        while stream["next_seq"] in stream["early"]:
+            chunk = stream["early"].pop(stream["next_seq"])
+            stream["next_seq"] += 1
+            decrypted_content = crypto.decrypt_with_aes(aes_key, chunk.get("content"))
+            if decrypted_content is None:
+                print(f"Failed to decrypt stream chunk from {sender}.")
+                continue
+            stream["parts"].append(decrypted_content.decode('utf-8'))
+            final = chunk.get("final", False)
+            if final:
+                self._ai_streams.pop(stream_id, None)
+            self.ai_stream_chunk_signal.emit({
+                "from": sender,
+                "stream_id": stream_id,
+                "content": "".join(stream["parts"]),
+                "final": final,
+                "mode": self._chat_modes.get(sender, 'cs'),
+                "timestamp": chunk.get("timestamp", time.time())
+            })
+            if final:
+                break
+
     def _handle_p2p_info(self, payload):
         # Server response with target's address
         username = payload.get("username")
@@ -467,6 +529,7 @@ class ClientLogic(QObject):
         self._p2p_addresses = {}
         self._friends_data = {}
         self._pending_messages = {}
+        self._ai_streams = {}
 
 
 
@@ -686,6 +749,14 @@ class ClientLogic(QObject):
         # 设置状态为等待P2P连接
         self.p2p_status_updated_signal.emit(friend_username, 'p2p_connecting')
 
+    def _handle_p2p_peer_unreachable(self, addr):
+        """可靠传输层多次重传仍无响应：该地址对应的好友回退到C/S模式"""
+        for friend_username, friend_addr in list(self._p2p_addresses.items()):
+            if tuple(friend_addr) == tuple(addr) and self._chat_modes.get(friend_username) == 'p2p':
+                print(f"P2P对端 {friend_username} 不可达，回退到C/S模式")
+                self._switch_to_cs_mode(friend_username)
+                self._notify_mode_change(friend_username, 'cs')
+
     def _switch_to_cs_mode(self, friend_username):
         """切换到C/S模式"""
         self._chat_modes[friend_username] = 'cs'
@@ -707,7 +778,37 @@ class ClientLogic(QObject):
         self.network.send_request(request)
 
     def request_friends(self):
-        self.network.send_request({"type": "get_friends"})
+        """重新加载好友列表：立即请求第一页，其余页随后惰性加载。"""
+        self._friends_generation += 1
+        self._friends_next_cursor = None
+        self._friends_page_pending = True
+        self.network.send_request({"type": "get_friends_page",
+                                   "payload": {"limit": FRIENDS_PAGE_SIZE, "generation": self._friends_generation}})
+
+    def request_more_friends(self):
+        """请求好友列表的下一页（如果还有且没有正在进行的请求）。"""
+        if self._friends_next_cursor is None or self._friends_page_pending:
+            return
+        self._friends_page_pending = True
+        self.network.send_request({"type": "get_friends_page",
+                                   "payload": {"cursor": self._friends_next_cursor, "limit": FRIENDS_PAGE_SIZE,
+                                               "generation": self._friends_generation}})
+
+    def _handle_friends_page(self, payload):
+        if payload.get("generation") != self._friends_generation:
+            return  # 重新加载之前发出的请求的响应
+        friends = payload.get("friends", [])
+        self._friends_page_pending = False
+        if payload.get("cursor") is None:
+            # 第一页：替换整个列表
+            self._friends_data = {f['username']: f for f in friends}
+            self.online_friends_updated_signal.emit(friends)
+        else:
+            self._friends_data.update({f['username']: f for f in friends})
+            self.friends_page_received_signal.emit(friends)
+        self._friends_next_cursor = payload.get("next_cursor")
+        if self._friends_next_cursor is not None:
+            QTimer.singleShot(FRIENDS_PAGE_INTERVAL_MS, self.request_more_friends)
 
     def add_friend(self, friend_username):
         self.network.send_request({"type": "add_friend", "payload": {"friend_username": friend_username}})
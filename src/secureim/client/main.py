@@ -29,8 +29,10 @@ class MainController:
         self.logic.registration_success_signal.connect(lambda: self.login_window.show_info("注册成功！现在您可以登录了。"))
         self.logic.registration_failed_signal.connect(self.login_window.show_error)
         self.logic.online_friends_updated_signal.connect(self.update_friend_list)
+        self.logic.friends_page_received_signal.connect(self.append_friends)
         self.logic.friend_status_updated_signal.connect(self.update_friend_status)
         self.logic.incoming_message_signal.connect(self.display_incoming_message)
+        self.logic.ai_stream_chunk_signal.connect(self.display_ai_stream_chunk)
         self.logic.incoming_stego_signal.connect(self.display_incoming_stego)
         self.logic.incoming_file_signal.connect(self.display_incoming_file)
         self.logic.generic_response_signal.connect(self.display_generic_response)
@@ -141,6 +143,10 @@ class MainController:
         if self.main_window:
             self.main_window.update_friend_list(friends)
             
+    def append_friends(self, friends):
+        if self.main_window:
+            self.main_window.append_friends(friends)
+
     def update_friend_status(self, status_update):
         if self.main_window:
             self.main_window.set_friend_status(status_update)
@@ -158,6 +164,17 @@ class MainController:
                 mode=mode
             )
 
+    def display_ai_stream_chunk(self, chunk_data):
+        if self.main_window:
+            self.main_window.update_stream_message(
+                chunk_data['from'],
+                chunk_data['stream_id'],
+                chunk_data['content'],
+                final=chunk_data.get('final', False),
+                mode=chunk_data.get('mode', 'cs'),
+                timestamp=chunk_data.get('timestamp')
+            )
+
     def display_incoming_stego(self, stego_data):
         if self.main_window:
             self.main_window.add_stego_image_to_chat(
@@ -1,15 +1,27 @@
+import itertools
+import random
 import socket
+import struct
 import threading
 import json
 import time
-import uuid
 
 from PyQt6.QtCore import QObject, pyqtSignal
 
+from .reassembly import FragmentReassembler
+from .reliable_udp import RUDP_OVERHEAD, ReliableUDP
+
+# P2P分片格式（网络字节序）：魔数(1) 消息ID(4) 分片序号(4) 分片总数(4) 消息总长度(4) 标志(1) + 原始数据
+# 未分片的消息仍是 JSON + b'\n'，魔数不可能是JSON的首字节
+FRAGMENT_MAGIC = 0xF7
+FRAGMENT_FLAG_LAST = 0x01
+FRAGMENT_HEADER = struct.Struct('!BIIIIB')
+
 class Networking(QObject):
     connection_failed_signal = pyqtSignal()
     server_message_received_signal = pyqtSignal(dict)
     p2p_message_received_signal = pyqtSignal(dict)
+    p2p_peer_unreachable_signal = pyqtSignal(object)  # 对端地址 (ip, port)
 
     def __init__(self, server_host, server_port, p2p_port, parent=None):
         super().__init__(parent)
@@ -18,9 +30,11 @@ class Networking(QObject):
         self.p2p_port = p2p_port
         self._socket = None
         self._p2p_socket = None
+        self._transport = None  # P2P可靠传输层
         self._is_listening = False
-        self.MAX_UDP_SIZE = 1400  # 安全的UDP数据包大小
-        self._fragment_buffer = {}# 用于重组分片数据
+        self._reassembler = FragmentReassembler()  # 用于重组分片数据，键为 (地址, 消息ID)
+        # 随机起点：本端重启后的消息ID不会与对端记录的最近完成的消息冲突
+        self._message_ids = itertools.count(random.getrandbits(32))
 
     def connect_to_server(self):
         try:
@@ -43,6 +57,8 @@ class Networking(QObject):
             self._p2p_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1024 * 1024*4)
 
             self._p2p_socket.bind(('', self.p2p_port))
+            self._transport = ReliableUDP(self._p2p_socket, self._handle_p2p_datagram,
+                                          self.p2p_peer_unreachable_signal.emit)
             p2p_thread = threading.Thread(target=self._listen_for_p2p_messages)
             p2p_thread.daemon = True
             p2p_thread.start()
@@ -52,7 +68,7 @@ class Networking(QObject):
 
     def send_request(self, data, is_p2p=False, recipient_addr=None):
         if is_p2p:
-            if not self._p2p_socket or not recipient_addr:
+            if not self._transport or not recipient_addr:
                 print(f"错误: P2P套接字或接收方地址不可用。")
                 return False
             try:
@@ -60,15 +76,14 @@ class Networking(QObject):
                 json_data = json.dumps(data)
                 data_bytes = json_data.encode('utf-8')
 
-                # 检查数据大小是否需要分片
-                if len(data_bytes) <= self.MAX_UDP_SIZE:
+                # 检查数据大小是否需要分片：数据报大小按对端路径探测得到，可靠传输层的头部也要占用其中的空间
+                datagram_size = self._transport.datagram_size(recipient_addr)
+                if len(data_bytes) + 1 <= datagram_size - RUDP_OVERHEAD:
                     # 小数据直接发送
-                    self._p2p_socket.sendto(data_bytes + b'\n', recipient_addr)
+                    return self._transport.send(recipient_addr, data_bytes + b'\n')
                 else:
                     # 大数据需要分片发送
-                    return self._send_fragmented_data(data_bytes, recipient_addr)
-
-                return True
+                    return self._send_fragmented_data(data_bytes, recipient_addr, datagram_size)
             except Exception as e:
                 print(f"发送P2P数据时出错: {e}")
                 return False
@@ -85,36 +100,24 @@ class Networking(QObject):
                 self.connection_failed_signal.emit()
                 return False
 
-    def _send_fragmented_data(self, data_bytes, recipient_addr):
-        """发送分片数据"""
+    def _send_fragmented_data(self, data_bytes, recipient_addr, datagram_size):
+        """发送分片数据：固定的二进制分片头 + 原始字节，填满整个数据报"""
         try:
-            fragment_id = str(uuid.uuid4())
+            message_id = next(self._message_ids) & 0xFFFFFFFF
             total_size = len(data_bytes)
-            fragment_size = self.MAX_UDP_SIZE - 200  # 预留头部信息空间
+            fragment_size = datagram_size - RUDP_OVERHEAD - FRAGMENT_HEADER.size
             total_fragments = (total_size + fragment_size - 1) // fragment_size
 
             print(f"发送大数据包，总大小: {total_size} 字节，分片数: {total_fragments}")
 
+            view = memoryview(data_bytes)
             for i in range(total_fragments):
                 start = i * fragment_size
-                end = min(start + fragment_size, total_size)
-                fragment_data = data_bytes[start:end]
-
-                # 创建分片包
-                fragment_packet = {
-                    "type": "fragment",
-                    "fragment_id": fragment_id,
-                    "fragment_index": i,
-                    "total_fragments": total_fragments,
-                    "data": fragment_data.decode('utf-8', errors='ignore')  # 转为base64更安全
-                }
-
-                # 使用base64编码二进制数据
-                import base64
-                fragment_packet["data"] = base64.b64encode(fragment_data).decode('ascii')
-
-                packet_json = json.dumps(fragment_packet)
-                self._p2p_socket.sendto(packet_json.encode('utf-8') + b'\n', recipient_addr)
+                flags = FRAGMENT_FLAG_LAST if i == total_fragments - 1 else 0
+                header = FRAGMENT_HEADER.pack(FRAGMENT_MAGIC, message_id, i, total_fragments, total_size, flags)
+                if not self._transport.send(recipient_addr, header + view[start:start + fragment_size]):
+                    print("P2P发送缓冲区已满")
+                    return False
 
             return True
         except Exception as e:
@@ -130,21 +133,10 @@ class Networking(QObject):
     def _listen_for_p2p_messages(self):
         while self._is_listening:
             try:
-                data, addr = self._p2p_socket.recvfrom(8192)  # 增加接收缓冲区
-                message_str = data.decode('utf-8').strip()
-
-                try:
-                    message = json.loads(message_str)
-
-                    # 检查是否为分片数据
-                    if message.get("type") == "fragment":
-                        self._handle_fragment(message, addr)
-                    else:
-                        # 普通消息直接处理
-                        self.p2p_message_received_signal.emit({"data": message, "addr": addr})
-
-                except json.JSONDecodeError:
-                    print(f"收到无效的JSON数据: {message_str[:100]}...")
+                data, addr = self._p2p_socket.recvfrom(65535)
+                # 可靠传输层的数据包与确认由传输层处理，按序交付的负载回调 _handle_p2p_datagram
+                if not self._transport.handle_datagram(data, addr):
+                    self._handle_p2p_datagram(data, addr)
 
             except OSError as e:
                 if not self._is_listening:
@@ -153,50 +145,42 @@ class Networking(QObject):
             except Exception as e:
                 print(f"P2P监听器出错 (其他错误): {e}")
 
-    def _handle_fragment(self, fragment, addr):
-        """处理接收到的分片数据"""
+    def _handle_p2p_datagram(self, data, addr):
+        """处理一个P2P数据报的内容（普通消息或分片）"""
+        # 检查是否为分片数据
+        if data[:1] == bytes((FRAGMENT_MAGIC,)):
+            self._handle_fragment(data, addr)
+            return
+
+        message_str = data.decode('utf-8', errors='replace').strip()
         try:
-            fragment_id = fragment["fragment_id"]
-            fragment_index = fragment["fragment_index"]
-            total_fragments = fragment["total_fragments"]
-            fragment_data = fragment["data"]
-
-            # 使用base64解码
-            import base64
-            fragment_bytes = base64.b64decode(fragment_data.encode('ascii'))
-
-            # 初始化分片缓冲区
-            if fragment_id not in self._fragment_buffer:
-                self._fragment_buffer[fragment_id] = {
-                    "fragments": {},
-                    "total_fragments": total_fragments,
-                    "addr": addr
-                }
-
-            # 存储分片
-            self._fragment_buffer[fragment_id]["fragments"][fragment_index] = fragment_bytes
-
-            # 检查是否收到所有分片
-            buffer_entry = self._fragment_buffer[fragment_id]
-            if len(buffer_entry["fragments"]) == total_fragments:
-                # 重组数据
-                complete_data = b""
-                for i in range(total_fragments):
-                    complete_data += buffer_entry["fragments"][i]
-
-                # 清理缓冲区
-                del self._fragment_buffer[fragment_id]
-
-                # 解析重组后的消息
-                try:
-                    complete_message = json.loads(complete_data.decode('utf-8'))
-                    self.p2p_message_received_signal.emit({"data": complete_message, "addr": addr})
-                    print(f"成功重组分片消息，总大小: {len(complete_data)} 字节")
-                except json.JSONDecodeError as e:
-                    print(f"重组后的数据不是有效JSON: {e}")
+            # 普通消息直接处理
+            message = json.loads(message_str)
+            self.p2p_message_received_signal.emit({"data": message, "addr": addr})
+        except json.JSONDecodeError:
+            print(f"收到无效的JSON数据: {message_str[:100]}...")
 
-        except Exception as e:
-            print(f"处理分片数据时出错: {e}")
+    def _handle_fragment(self, data, addr):
+        """处理接收到的分片数据"""
+        try:
+            _, message_id, fragment_index, total_fragments, total_size, _ = FRAGMENT_HEADER.unpack_from(data)
+        except struct.error:
+            print("收到不完整的分片头部")
+            return
+
+        # 消息ID由发送方分配，只在同一对端内唯一；分片数据以 memoryview 直接写入预分配的缓冲区
+        complete_data = self._reassembler.add((addr, message_id), fragment_index, total_fragments, total_size,
+                                              memoryview(data)[FRAGMENT_HEADER.size:])
+        if complete_data is None:
+            return
+
+        # 解析重组后的消息
+        try:
+            complete_message = json.loads(complete_data)
+            self.p2p_message_received_signal.emit({"data": complete_message, "addr": addr})
+            print(f"成功重组分片消息，总大小: {len(complete_data)} 字节")
+        except (UnicodeDecodeError, json.JSONDecodeError) as e:
+            print(f"重组后的数据不是有效JSON: {e}")
 
     def _listen_for_server_messages(self):
         while self._is_listening:
@@ -218,6 +202,8 @@ class Networking(QObject):
 
     def disconnect(self):
         self._is_listening = False
+        if self._transport:
+            self._transport.close()
         if self._socket:
             self._socket.close()
         if self._p2p_socket:
@@ -0,0 +1,175 @@
+import errno
+import socket
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+# 数据报大小均指UDP负载字节数（IPv4: 链路MTU - 20字节IP头 - 8字节UDP头）
+BASE_DATAGRAM_SIZE = 1200   # 未探测或探测不可用时使用的大小，绝大多数隧道/VPN路径都不会分片
+# 依次探测的候选大小：IPv6最小MTU、常见隧道、WireGuard、PPPoE、以太网、巨帧
+PROBE_SIZES = (1252, 1372, 1392, 1464, 1472, 8972)
+PROBE_ATTEMPTS = 3          # 同一大小连续这么多次没有回应即认为路径不支持
+PROBE_MIN_TIMEOUT = 0.5     # 探测包等待回应的最短时间（秒），实际取 max(该值, 对端的RTO)
+RAISE_INTERVAL = 600        # 探测失败或回退后，隔这么久再尝试更大的大小（路径可能已变化）
+CACHE_SIZE = 256            # 缓存的对端数，超出时淘汰最久未使用的
+
+# Python 3.12 之前 socket 模块没有这些常量，按平台的数值定义
+_IP_MTU_DISCOVER = getattr(socket, 'IP_MTU_DISCOVER', 10)   # Linux
+_IP_PMTUDISC_PROBE = getattr(socket, 'IP_PMTUDISC_PROBE', 3)  # 设置DF且忽略内核缓存的路径MTU
+_IP_PMTUDISC_DONT = getattr(socket, 'IP_PMTUDISC_DONT', 0)    # 不设置DF，超过MTU时由IP层分片
+_IP_DONTFRAGMENT = 14                                        # Windows
+_IP_DONTFRAG = getattr(socket, 'IP_DONTFRAG', 28)            # macOS/BSD
+
+
+def set_dont_fragment(sock, enabled=True):
+    """设置套接字发出的数据报是否带DF标志（不允许IP分片），成功返回True；平台不支持时返回False。"""
+    if sys.platform.startswith('linux'):
+        option, value = _IP_MTU_DISCOVER, _IP_PMTUDISC_PROBE if enabled else _IP_PMTUDISC_DONT
+    elif sys.platform == 'win32':
+        option, value = _IP_DONTFRAGMENT, int(enabled)
+    elif sys.platform == 'darwin' or 'bsd' in sys.platform:
+        option, value = _IP_DONTFRAG, int(enabled)
+    else:
+        return False
+    try:
+        sock.setsockopt(socket.IPPROTO_IP, option, value)
+        return True
+    except OSError as e:
+        print(f"无法设置P2P套接字的DF标志: {e}")
+        return False
+
+
+def is_too_big(error):
+    """发送数据报时的错误是否表示超过了本机接口的MTU。"""
+    return isinstance(error, OSError) and error.errno in (errno.EMSGSIZE, getattr(errno, 'WSAEMSGSIZE', None))
+
+
+class _PathState:
+    __slots__ = ('size', 'limit', 'limit_until', 'probe_size', 'probe_deadline', 'attempts')
+
+    def __init__(self):
+        self.size = BASE_DATAGRAM_SIZE  # 已确认可用的大小
+        self.limit = None               # 已确认不可用的最小大小，在 limit_until 之前不再探测 >= 它的大小
+        self.limit_until = 0.0
+        self.probe_size = None          # 正在探测的大小（每个对端同时只有一个探测包）
+        self.probe_deadline = 0.0
+        self.attempts = 0
+
+
+class PathMTUCache:
+    """
+    按对端地址缓存可用的数据报大小，并驱动DF探测：从 BASE_DATAGRAM_SIZE 开始依次探测更大的候选大小，
+    收到回应即采用，连续 PROBE_ATTEMPTS 次没有回应（或本机直接报告过大）即停止向上探测。
+    数据连续超时时回退到基础大小（路径MTU变小导致的黑洞），RAISE_INTERVAL 后重新向上探测。
+    可由多个线程调用。
+    """
+
+    def __init__(self, enabled=True, cache_size=CACHE_SIZE):
+        self.enabled = enabled
+        self.cache_size = cache_size
+        self._paths = OrderedDict()  # addr -> _PathState，按最近使用排序
+        self._lock = threading.Lock()
+        self.black_holes = 0
+
+    def _path(self, addr):
+        # 调用方持有 self._lock
+        path = self._paths.get(addr)
+        if path is None:
+            path = self._paths[addr] = _PathState()
+            if len(self._paths) > self.cache_size:
+                self._paths.popitem(last=False)
+        else:
+            self._paths.move_to_end(addr)
+        return path
+
+    def get(self, addr):
+        """返回发往 addr 的数据报可以使用的最大UDP负载字节数。"""
+        if not self.enabled:
+            return BASE_DATAGRAM_SIZE
+        with self._lock:
+            path = self._paths.get(addr)
+            return path.size if path else BASE_DATAGRAM_SIZE
+
+    def next_probe(self, addr, now, timeout):
+        """返回现在需要向 addr 发送的探测包大小（包括超时重发），不需要时返回None。"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            path = self._path(addr)
+            if path.probe_size is not None:
+                if now < path.probe_deadline:
+                    return None
+                if path.attempts < PROBE_ATTEMPTS:
+                    path.attempts += 1
+                    path.probe_deadline = now + max(PROBE_MIN_TIMEOUT, timeout)
+                    return path.probe_size
+                self._fail(addr, path, now)
+            if path.limit is not None and now >= path.limit_until:
+                path.limit = None
+            size = next((s for s in PROBE_SIZES
+                         if s > path.size and (path.limit is None or s < path.limit)), None)
+            if size is None:
+                return None
+            path.probe_size = size
+            path.attempts = 1
+            path.probe_deadline = now + max(PROBE_MIN_TIMEOUT, timeout)
+            return size
+
+    def on_probe_ack(self, addr, size):
+        """对端确认收到了 size 字节的探测包。"""
+        if size not in PROBE_SIZES:
+            return
+        with self._lock:
+            path = self._paths.get(addr)
+            if path is None or size <= path.size:
+                return
+            path.size = size
+            if path.limit is not None and path.limit <= size:
+                path.limit = None  # 迟到的回应：该大小其实可用
+            if path.probe_size is not None and path.probe_size <= size:
+                path.probe_size = None
+        print(f"到 {addr} 的P2P数据报大小提升为 {size} 字节")
+
+    def on_probe_error(self, addr, size, now=None):
+        """本机拒绝发送 size 字节的探测包（超过出口接口的MTU），无需等待超时。"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            path = self._paths.get(addr)
+            if path is not None and path.probe_size == size:
+                self._fail(addr, path, now)
+
+    def _fail(self, addr, path, now):
+        # 调用方持有 self._lock
+        path.limit = path.probe_size
+        path.limit_until = now + RAISE_INTERVAL
+        path.probe_size = None
+        print(f"到 {addr} 的路径不支持 {path.limit} 字节的数据报，使用 {path.size} 字节")
+
+    def on_black_hole(self, addr, size, now=None):
+        """
+        发往 addr 的 size 字节数据报连续超时：可能是路径MTU变小，当前大小不小于它时回退到基础大小，
+        并在 RAISE_INTERVAL 内不再探测 >= size 的大小。有回退时返回True。
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            path = self._paths.get(addr)
+            if path is None or size <= BASE_DATAGRAM_SIZE:
+                return False
+            path.limit = size if path.limit is None else min(path.limit, size)
+            path.limit_until = now + RAISE_INTERVAL
+            if path.probe_size is not None and path.probe_size >= size:
+                path.probe_size = None
+            if path.size < size:
+                return False
+            print(f"到 {addr} 的 {size} 字节数据报连续超时，回退到 {BASE_DATAGRAM_SIZE} 字节")
+            path.size = BASE_DATAGRAM_SIZE
+            self.black_holes += 1
+            return True
+
+    def stats(self, addr):
+        with self._lock:
+            path = self._paths.get(addr)
+            if path is None:
+                return None
+            return {"size": path.size, "limit": path.limit, "probing": path.probe_size}
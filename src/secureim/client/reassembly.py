@@ -0,0 +1,144 @@
+import time
+from collections import OrderedDict
+
+REASSEMBLY_TIMEOUT = 30                    # 不完整的消息超过该秒数没有收到新分片即丢弃
+REASSEMBLY_MAX_BYTES = 256 * 1024 * 1024   # 所有未完成消息预分配缓冲区的总大小上限
+EXPIRE_CHECK_INTERVAL = 1.0                # 检查过期消息的最小间隔（秒）
+RECENT_COMPLETED = 1024                    # 记住最近完成的消息数，其迟到的重复分片直接丢弃
+
+
+class _PartialMessage:
+    """一条正在重组的消息：按声明的总长度预分配的缓冲区与每个分片的到达标记。"""
+
+    __slots__ = ('buffer', 'view', 'count', 'total_len', 'chunk_size', 'received', 'received_count', 'deadline')
+
+    def __init__(self, count, total_len, deadline):
+        self.buffer = bytearray(total_len)
+        self.view = memoryview(self.buffer)
+        self.count = count
+        self.total_len = total_len
+        self.chunk_size = None  # 非最后分片的长度，由第一个收到的非最后分片确定
+        self.received = bytearray(count)
+        self.received_count = 0
+        self.deadline = deadline
+
+
+class FragmentReassembler:
+    """
+    分片重组引擎。每条消息按分片头中声明的总长度预分配一个 bytearray，
+    分片通过 memoryview 直接写入各自的偏移，完成时不需要再拼接。
+    重复分片、序号越界或与已收到分片长度不一致的分片会被丢弃；
+    长时间不完整的消息会过期，所有未完成消息占用的内存受全局预算限制（超出时淘汰最久没有进展的消息）。
+    只在P2P接收线程中调用，不加锁。
+    """
+
+    def __init__(self, timeout=REASSEMBLY_TIMEOUT, max_bytes=REASSEMBLY_MAX_BYTES):
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self._messages = OrderedDict()  # key -> _PartialMessage，按最近收到分片的时间排序
+        self._completed = OrderedDict()  # 最近完成的消息 key -> None
+        self._bytes = 0
+        self._next_expire_check = 0.0
+        self.completed = 0
+        self.expired = 0
+        self.evicted = 0
+        self.dropped = 0      # 越界、不一致或超出预算而丢弃的分片
+        self.duplicates = 0
+
+    def add(self, key, index, count, total_len, chunk):
+        """
+        写入一个分片（chunk 可以是 memoryview）。消息完整时返回重组好的 bytearray，否则返回None。
+        key 用于区分不同的消息，例如 (对端地址, 消息ID)。
+        """
+        now = time.monotonic()
+        if now >= self._next_expire_check:
+            self.expire(now)
+            self._next_expire_check = now + EXPIRE_CHECK_INTERVAL
+
+        message = self._messages.get(key)
+        if message is None:
+            if key in self._completed:
+                self.duplicates += 1
+                return None
+            if not 0 < count <= total_len or total_len > self.max_bytes:
+                self.dropped += 1
+                return None
+            self._make_room(total_len)
+            message = self._messages[key] = _PartialMessage(count, total_len, now + self.timeout)
+            self._bytes += total_len
+        elif message.count != count or message.total_len != total_len:
+            self.dropped += 1
+            return None
+
+        if index >= count:
+            self.dropped += 1
+            return None
+        if message.received[index]:
+            self.duplicates += 1
+            return None
+
+        size = len(chunk)
+        if index == count - 1:
+            offset = total_len - size
+            valid = offset >= 0 and (message.chunk_size is None or offset == index * message.chunk_size)
+        else:
+            offset = index * size
+            valid = (size > 0 and (message.chunk_size is None or size == message.chunk_size)
+                     and offset + size <= total_len)
+        if not valid:
+            self.dropped += 1
+            return None
+        if index != count - 1:
+            message.chunk_size = size
+
+        message.view[offset:offset + size] = chunk
+        message.received[index] = 1
+        message.received_count += 1
+        message.deadline = now + self.timeout
+        self._messages.move_to_end(key)
+
+        if message.received_count < count:
+            return None
+        self._remove(key)
+        self.completed += 1
+        self._completed[key] = None
+        if len(self._completed) > RECENT_COMPLETED:
+            self._completed.popitem(last=False)
+        return message.buffer
+
+    def _make_room(self, size):
+        while self._messages and self._bytes + size > self.max_bytes:
+            key = next(iter(self._messages))
+            print(f"分片重组缓冲区已满，丢弃未完成的消息 {key}")
+            self._remove(key)
+            self.evicted += 1
+
+    def _remove(self, key):
+        message = self._messages.pop(key)
+        message.view.release()
+        self._bytes -= message.total_len
+
+    def expire(self, now=None):
+        """丢弃超时未完成的消息，返回丢弃的数量。"""
+        now = time.monotonic() if now is None else now
+        count = 0
+        while self._messages:
+            key, message = next(iter(self._messages.items()))
+            if message.deadline > now:
+                break
+            print(f"分片消息 {key} 重组超时，已收到 {message.received_count}/{message.count} 个分片")
+            self._remove(key)
+            count += 1
+        self.expired += count
+        return count
+
+    def stats(self):
+        return {
+            "pending": len(self._messages),
+            "bytes": self._bytes,
+            "completed": self.completed,
+            "expired": self.expired,
+            "evicted": self.evicted,
+            "dropped": self.dropped,
+            "duplicates": self.duplicates
+        }
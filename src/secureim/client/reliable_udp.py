@@ -0,0 +1,425 @@
+import random
+import struct
+import threading
+import time
+from collections import OrderedDict, deque
+
+from .pmtu import PathMTUCache, is_too_big, set_dont_fragment
+
+# 传输层数据包格式（网络字节序）：
+#   数据包: 魔数(1) 类型(1) 会话ID(4) 序号(4) + 原始负载
+#   确认包: 魔数(1) 类型(1) 会话ID(4) 累计确认序号(4) 触发确认的序号(4) SACK区间数(1) + 区间[起始(4) 结束(4)]...
+#   探测包/探测确认: 魔数(1) 类型(1) 大小(4)，探测包用0填充到要探测的数据报大小，确认包回报实际收到的字节数
+# 魔数不可能是JSON文本的首字节，因此可以与旧版本的JSON数据报区分
+RUDP_MAGIC = 0xA5
+RUDP_DATA = 1
+RUDP_ACK = 2
+RUDP_PROBE = 3
+RUDP_PROBE_ACK = 4
+_DATA_HEADER = struct.Struct('!BBII')
+_ACK_HEADER = struct.Struct('!BBIIIB')
+_SACK_BLOCK = struct.Struct('!II')
+_PROBE_HEADER = struct.Struct('!BBI')
+RUDP_OVERHEAD = _DATA_HEADER.size  # 每个数据包的传输层头部字节数，上层按 数据报大小 - RUDP_OVERHEAD 切分负载
+
+RECV_WINDOW = 1024          # 接收窗口（包数）：超出 cum + RECV_WINDOW 的包直接丢弃
+INITIAL_CWND = 10           # 初始拥塞窗口（包数）
+MIN_RTO = 0.2               # 重传超时的上下限与初始值（秒），按 RFC 6298 由 RTT 估算
+MAX_RTO = 10.0
+INITIAL_RTO = 1.0
+MAX_TIMEOUTS = 8            # 连续超时次数超过该值即认为对端不可达
+BLACK_HOLE_TIMEOUTS = 2     # 最早的未确认包连续超时这么多次后，把数据报大小回退到基础大小（路径MTU可能变小）
+SEND_BUFFER_BYTES = 64 * 1024 * 1024  # 每个对端尚未确认的数据上限
+PACING_GAIN_SLOW_START = 2.0  # 节奏发送的速率 = 增益 * cwnd / srtt
+PACING_GAIN = 1.25
+PACING_BURST = 4            # 落后于节奏时最多连续补发的包数
+# 丢包区分：最近的RTT不超过最小RTT的 (1 + QUEUE_DELAY_TOLERANCE) 倍（瓶颈处没有排队）、
+# 且本轮丢包数不超过 cwnd 的 LOSS_TOLERANCE 时，视为链路随机丢包，只重传不减窗
+QUEUE_DELAY_TOLERANCE = 0.25
+LOSS_TOLERANCE = 0.15
+MIN_LOSS_BURST = 3          # 窗口较小时，一轮内至少丢这么多包才按丢包率判定为拥塞
+MAX_SACK_BLOCKS = 4
+IDLE_TIMEOUT = 60           # 发送状态空闲超过该时间后清除（下次发送使用新的会话ID）
+RECV_IDLE_TIMEOUT = 120     # 接收状态的空闲清除时间，须大于 IDLE_TIMEOUT
+
+
+class _Segment:
+    __slots__ = ('seq', 'datagram', 'size', 'sent_at', 'retransmitted')
+
+    def __init__(self, seq, datagram, size):
+        self.seq = seq
+        self.datagram = datagram
+        self.size = size
+        self.sent_at = 0.0
+        self.retransmitted = False
+
+
+class _SendState:
+    """发往一个对端的发送状态：序号、未确认的数据、RTT估计与拥塞窗口。"""
+
+    def __init__(self):
+        self.sid = random.getrandbits(32)  # 会话ID，对端据此识别重启后的新会话
+        self.next_seq = 0
+        self.snd_una = 0                    # 最小的未确认序号
+        self.high_sent = 0                  # 已发出的最大序号 + 1
+        self.segments = {}                  # seq -> _Segment，所有未确认的包
+        self.outstanding = OrderedDict()    # 已发出且未判定丢失的seq，按发送时间排序
+        self.lost = deque()                 # 等待重传的seq
+        self.queue = deque()                # 尚未发送的新包
+        self.buffered_bytes = 0
+        self.cwnd = float(INITIAL_CWND)
+        self.ssthresh = float('inf')
+        self.srtt = None
+        self.rttvar = None
+        self.min_rtt = None
+        self.latest_rtt = None
+        self.rto = INITIAL_RTO
+        self.recovery_until = -1            # 快速恢复期间不再重复减窗
+        self.rack_time = 0.0                # 已确认的包中最晚的发送时间，早于它的未确认包视为丢失
+        self.round_start = 0.0              # 本轮（一个srtt）的开始时间，以及本轮判定丢失的包数
+        self.round_lost = 0
+        self.next_send = 0.0
+        self.timeouts = 0
+        self.last_active = time.monotonic()
+        self.sent = 0
+        self.retransmits = 0
+        self.loss_events = 0
+
+    def update_rtt(self, sample):
+        self.latest_rtt = sample
+        self.min_rtt = sample if self.min_rtt is None else min(self.min_rtt, sample)
+        if self.srtt is None:
+            self.srtt, self.rttvar = sample, sample / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - sample)
+            self.srtt = 0.875 * self.srtt + 0.125 * sample
+        self.rto = min(MAX_RTO, max(MIN_RTO, self.srtt + 4 * self.rttvar))
+
+
+    def congestion_loss(self):
+        """丢包是否由拥塞引起：瓶颈处已有排队延迟，或本轮丢包过多。"""
+        if self.min_rtt is None or self.round_lost > max(self.cwnd * LOSS_TOLERANCE, MIN_LOSS_BURST):
+            return True
+        return self.latest_rtt > self.min_rtt * (1 + QUEUE_DELAY_TOLERANCE)
+
+
+class _RecvState:
+    """来自一个对端的接收状态：累计确认序号与乱序到达的包。"""
+
+    def __init__(self, sid):
+        self.sid = sid
+        self.cum = 0          # 下一个期望的序号
+        self.buffer = {}      # seq -> 负载，乱序到达尚未交付
+        self.last_active = time.monotonic()
+
+    def sack_blocks(self, seq):
+        """乱序区间 [start, end)，包含刚收到的包的区间排在最前。"""
+        if not self.buffer:
+            return []
+        blocks = []
+        ordered = sorted(self.buffer)
+        start = previous = ordered[0]
+        for s in ordered[1:]:
+            if s != previous + 1:
+                blocks.append([start, previous + 1])
+                start = s
+            previous = s
+        blocks.append([start, previous + 1])
+        blocks.sort(key=lambda b: (not b[0] <= seq < b[1], -b[0]))
+        return blocks[:MAX_SACK_BLOCKS]
+
+
+class ReliableUDP:
+    """
+    基于UDP套接字的可靠P2P传输：每个对端一个会话，包带序号并按序交付，
+    接收方对每个包回复累计确认 + 选择确认(SACK)；发送方按 RFC 6298 估算重传超时，
+    以“更晚发出的包已被确认”判定丢包（RACK），拥塞窗口慢启动 + 加性增/乘性减，并按 cwnd/srtt 节奏发送。
+    伴随排队延迟或大量丢包的丢包才减窗，链路上的零星随机丢包只重传，因此有损链路也能跑满带宽。
+
+    接收线程调用 handle_datagram，交付的负载通过 on_payload(负载, 地址) 回调（在接收线程中）；
+    发送、重传与超时由内部线程处理。对端连续超时不可达时调用 on_peer_failed(地址)。
+    内部线程同时向有数据往来的对端发送DF探测包，上层按 datagram_size(地址) 切分负载。
+    """
+
+    def __init__(self, sock, on_payload, on_peer_failed=None):
+        self.sock = sock
+        self.on_payload = on_payload
+        self.on_peer_failed = on_peer_failed
+        self._peers = {}      # addr -> _SendState
+        self._receivers = {}  # addr -> _RecvState
+        self._cond = threading.Condition()
+        self._thread = None
+        self._closed = False
+        self.pmtu = PathMTUCache(set_dont_fragment(sock))
+
+    def datagram_size(self, addr):
+        """发往 addr 的数据报（含传输层头部）可以使用的最大字节数。"""
+        return self.pmtu.get(addr)
+
+    def send(self, addr, payload):
+        """把一个负载排入发往 addr 的队列，立即返回；发送缓冲已满时返回False。"""
+        with self._cond:
+            if self._closed:
+                return False
+            state = self._peers.get(addr)
+            if state is None:
+                state = self._peers[addr] = _SendState()
+            if state.buffered_bytes + len(payload) > SEND_BUFFER_BYTES:
+                return False
+            header = _DATA_HEADER.pack(RUDP_MAGIC, RUDP_DATA, state.sid, state.next_seq)
+            segment = _Segment(state.next_seq, header + payload, len(payload))
+            state.next_seq += 1
+            state.segments[segment.seq] = segment
+            state.queue.append(segment)
+            state.buffered_bytes += len(payload)
+            state.last_active = time.monotonic()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._pump, name="rudp", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return True
+
+    def handle_datagram(self, data, addr):
+        """处理收到的数据报；不是传输层数据包时返回False，由调用方按普通消息处理。"""
+        if len(data) < _PROBE_HEADER.size or data[0] != RUDP_MAGIC:
+            return False
+        msg_type = data[1]
+        try:
+            if msg_type == RUDP_DATA:
+                _, _, sid, seq = _DATA_HEADER.unpack_from(data)
+                self._on_data(sid, seq, data[_DATA_HEADER.size:], addr)
+            elif msg_type == RUDP_ACK:
+                _, _, sid, cum, seq, count = _ACK_HEADER.unpack_from(data)
+                blocks = [_SACK_BLOCK.unpack_from(data, _ACK_HEADER.size + i * _SACK_BLOCK.size)
+                          for i in range(min(count, MAX_SACK_BLOCKS))]
+                self._on_ack(sid, cum, seq, blocks, addr)
+            elif msg_type == RUDP_PROBE:
+                self._sendto(_PROBE_HEADER.pack(RUDP_MAGIC, RUDP_PROBE_ACK, len(data)), addr)
+            elif msg_type == RUDP_PROBE_ACK:
+                _, _, size = _PROBE_HEADER.unpack_from(data)
+                self.pmtu.on_probe_ack(addr, size)
+                with self._cond:
+                    self._cond.notify()  # 立即探测下一个大小
+        except struct.error:
+            pass  # 截断的数据包
+        return True
+
+    def _on_data(self, sid, seq, payload, addr):
+        delivered = []
+        with self._cond:
+            receiver = self._receivers.get(addr)
+            if receiver is None or receiver.sid != sid:
+                receiver = self._receivers[addr] = _RecvState(sid)  # 新会话（对端重启或空闲后重新开始）
+            receiver.last_active = time.monotonic()
+            # 重复包与窗口外的包不保存，但仍然回复确认
+            if receiver.cum <= seq < receiver.cum + RECV_WINDOW and seq not in receiver.buffer:
+                receiver.buffer[seq] = payload
+                while receiver.cum in receiver.buffer:
+                    delivered.append(receiver.buffer.pop(receiver.cum))
+                    receiver.cum += 1
+            blocks = receiver.sack_blocks(seq)
+            ack = _ACK_HEADER.pack(RUDP_MAGIC, RUDP_ACK, sid, receiver.cum, seq, len(blocks)) + b''.join(
+                _SACK_BLOCK.pack(start, end) for start, end in blocks)
+        self._sendto(ack, addr)
+        for item in delivered:
+            self.on_payload(item, addr)
+
+    def _on_ack(self, sid, cum, ack_seq, blocks, addr):
+        now = time.monotonic()
+        with self._cond:
+            state = self._peers.get(addr)
+            if state is None or sid != state.sid:
+                return
+            acked = []
+            cum = min(cum, state.next_seq)
+            while state.snd_una < cum:
+                segment = state.segments.pop(state.snd_una, None)
+                if segment is not None:
+                    acked.append(segment)
+                state.snd_una += 1
+            for start, end in blocks:
+                for seq in range(max(start, state.snd_una), min(end, state.next_seq)):
+                    segment = state.segments.pop(seq, None)
+                    if segment is not None:
+                        acked.append(segment)
+            if not acked:
+                return
+
+            for segment in acked:
+                state.outstanding.pop(segment.seq, None)
+                state.buffered_bytes -= segment.size
+                if segment.sent_at > state.rack_time:
+                    state.rack_time = segment.sent_at
+                # Karn算法：重传过的包不用于RTT采样
+                if segment.seq == ack_seq and not segment.retransmitted:
+                    state.update_rtt(now - segment.sent_at)
+                if state.snd_una >= state.recovery_until:
+                    state.cwnd += 1 if state.cwnd < state.ssthresh else 1 / state.cwnd
+            state.cwnd = min(state.cwnd, float(RECV_WINDOW))
+            state.timeouts = 0
+            state.last_active = now
+
+            # RACK：比最近确认的包早发出超过 srtt/4 且仍未确认的包判定为丢失
+            reorder_window = (state.srtt or 0) / 4
+            if now >= state.round_start + (state.srtt or 0):
+                state.round_start = now
+                state.round_lost = 0
+            lost = False
+            while state.outstanding:
+                seq = next(iter(state.outstanding))
+                if state.segments[seq].sent_at + reorder_window >= state.rack_time:
+                    break
+                del state.outstanding[seq]
+                state.lost.append(seq)
+                state.round_lost += 1
+                lost = True
+            if lost and state.snd_una >= state.recovery_until and state.congestion_loss():
+                state.ssthresh = max(state.cwnd / 2, 2.0)
+                state.cwnd = state.ssthresh
+                state.recovery_until = state.high_sent
+                state.loss_events += 1
+            self._cond.notify()
+
+    def _service(self, addr, state, now, out):
+        """处理一个对端的超时与发送，返回下次需要唤醒的时间；对端不可达时返回None。"""
+        if state.outstanding:
+            oldest = state.segments[next(iter(state.outstanding))]
+            if now >= oldest.sent_at + state.rto:
+                state.timeouts += 1
+                if state.timeouts > MAX_TIMEOUTS:
+                    return None
+                # 超时：所有在途的包都需要重传，窗口回到1并退避超时时间
+                state.lost.extend(state.outstanding)
+                state.outstanding.clear()
+                state.ssthresh = max(state.cwnd / 2, 2.0)
+                state.cwnd = 1.0
+                state.recovery_until = -1
+                state.rto = min(state.rto * 2, MAX_RTO)
+                state.loss_events += 1
+                if state.timeouts >= BLACK_HOLE_TIMEOUTS:
+                    self.pmtu.on_black_hole(addr, len(oldest.datagram), now)
+
+        gain = PACING_GAIN_SLOW_START if state.cwnd < state.ssthresh else PACING_GAIN
+        interval = state.srtt / (state.cwnd * gain) if state.srtt else 0.0
+        wake = now + 1.0
+        while len(state.outstanding) < state.cwnd:
+            while state.lost and state.lost[0] not in state.segments:
+                state.lost.popleft()  # 等待重传期间已被确认
+            if not state.lost and not (state.queue and state.queue[0].seq < state.snd_una + RECV_WINDOW):
+                break
+            if now < state.next_send:
+                wake = state.next_send  # 还没到节奏发送的时间
+                break
+            if state.lost:
+                segment = state.segments[state.lost.popleft()]
+                segment.retransmitted = True
+                state.retransmits += 1
+            else:
+                segment = state.queue.popleft()
+            segment.sent_at = now
+            state.high_sent = max(state.high_sent, segment.seq + 1)
+            state.outstanding[segment.seq] = None
+            state.sent += 1
+            out.append(segment.datagram)
+            state.next_send = max(state.next_send, now - interval * PACING_BURST) + interval
+
+        if state.outstanding:
+            oldest = state.segments[next(iter(state.outstanding))]
+            wake = min(wake, oldest.sent_at + state.rto)
+        return wake
+
+    def _pump(self):
+        next_sweep = time.monotonic() + IDLE_TIMEOUT
+        while True:
+            sends, probes, failed = [], [], []
+            with self._cond:
+                if self._closed:
+                    return
+                now = time.monotonic()
+                wake = now + 1.0
+                for addr, state in list(self._peers.items()):
+                    out = []
+                    next_wake = self._service(addr, state, now, out)
+                    if next_wake is None:
+                        del self._peers[addr]
+                        failed.append(addr)
+                        continue
+                    sends.extend((datagram, addr) for datagram in out)
+                    probe_size = self.pmtu.next_probe(addr, now, state.rto)
+                    if probe_size is not None:
+                        probes.append((probe_size, addr))
+                    wake = min(wake, next_wake)
+                if now >= next_sweep:
+                    self._sweep(now)
+                    next_sweep = now + IDLE_TIMEOUT
+                if not sends and not probes and not failed:
+                    self._cond.wait(max(0.0, wake - now))
+            self._send_all(sends)
+            for size, addr in probes:
+                self._send_probe(size, addr)
+            for addr in failed:
+                print(f"P2P对端 {addr} 连续 {MAX_TIMEOUTS} 次超时未响应，放弃发送")
+                if self.on_peer_failed:
+                    self.on_peer_failed(addr)
+
+    def _sweep(self, now):
+        # 调用方持有 self._cond
+        for addr, state in list(self._peers.items()):
+            if not state.segments and now - state.last_active > IDLE_TIMEOUT:
+                del self._peers[addr]
+        for addr, receiver in list(self._receivers.items()):
+            if now - receiver.last_active > RECV_IDLE_TIMEOUT:
+                del self._receivers[addr]
+
+    def _sendto(self, datagram, addr):
+        try:
+            self.sock.sendto(datagram, addr)
+        except OSError as e:
+            print(f"发送P2P数据报到 {addr} 失败: {e}")
+
+    def _send_all(self, sends):
+        oversized = []
+        for datagram, addr in sends:
+            if self.pmtu.enabled and len(datagram) > self.pmtu.get(addr):
+                oversized.append((datagram, addr))
+            else:
+                self._sendto(datagram, addr)
+        if oversized:
+            # 数据报大小回退之前切分的包：暂时允许IP分片，否则路径MTU变小后这些包永远无法送达
+            set_dont_fragment(self.sock, False)
+            for datagram, addr in oversized:
+                self._sendto(datagram, addr)
+            set_dont_fragment(self.sock, True)
+
+    def _send_probe(self, size, addr):
+        probe = _PROBE_HEADER.pack(RUDP_MAGIC, RUDP_PROBE, size).ljust(size, b'\0')
+        try:
+            self.sock.sendto(probe, addr)
+        except OSError as e:
+            if is_too_big(e):
+                self.pmtu.on_probe_error(addr, size)
+            else:
+                print(f"发送P2P探测包到 {addr} 失败: {e}")
+
+    def stats(self, addr):
+        with self._cond:
+            state = self._peers.get(addr)
+            if state is None:
+                return None
+            return {
+                "cwnd": state.cwnd,
+                "ssthresh": state.ssthresh,
+                "srtt": state.srtt,
+                "rto": state.rto,
+                "in_flight": len(state.outstanding),
+                "unacked": len(state.segments),
+                "sent": state.sent,
+                "retransmits": state.retransmits,
+                "loss_events": state.loss_events,
+                "datagram_size": self.pmtu.get(addr)
+            }
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
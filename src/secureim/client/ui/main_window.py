@@ -7,7 +7,7 @@ from PyQt6.QtWidgets import (
     QStackedWidget, QLabel, QInputDialog, QFileDialog, QMessageBox,
     QTextBrowser, QMenu, QStyle, QGroupBox, QFormLayout
 )
-from PyQt6.QtGui import QIcon, QPixmap, QImage, QColor, QPainter, QAction
+from PyQt6.QtGui import QIcon, QPixmap, QImage, QColor, QPainter, QAction, QTextCursor, QTextFrameFormat
 from PyQt6.QtCore import Qt, pyqtSignal, QSize, QUrl, QBuffer, QIODevice
 
 # 默认文件保存目录（Windows）
@@ -48,6 +48,9 @@ class ChatWidget(QWidget):
 
         self.setLayout(layout)
 
+        # 正在增量显示的流式消息: stream_id -> (文档中的独立框架, 首帧时间戳)
+        self._stream_frames = {}
+
     def set_input_enabled(self, enabled):
         """启用或禁用聊天输入控件。"""
         self.message_input.setEnabled(enabled)
@@ -60,8 +63,8 @@ class ChatWidget(QWidget):
         else:
             self.message_input.setPlaceholderText("输入消息...")
 
-    def append_message(self, sender, message, is_self=False, mode='cs', timestamp=None):
-        """添加消息到聊天窗口，带时间戳"""
+    def _message_html(self, sender, message, is_self=False, mode='cs', timestamp=None):
+        """生成一条消息气泡的HTML，带时间戳"""
         align_right = is_self
 
         # 如果没有提供时间戳，使用当前时间
@@ -129,6 +132,12 @@ class ChatWidget(QWidget):
             </table>
         '''
 
+        return html
+
+    def append_message(self, sender, message, is_self=False, mode='cs', timestamp=None):
+        """添加消息到聊天窗口，带时间戳"""
+        html = self._message_html(sender, message, is_self=is_self, mode=mode, timestamp=timestamp)
+
         # 添加HTML并强制刷新
         self.chat_display.append(html)
         self.chat_display.repaint()
@@ -137,6 +146,30 @@ class ChatWidget(QWidget):
         if scrollbar:
             scrollbar.setValue(scrollbar.maximum())
 
+    def update_stream_message(self, sender, stream_id, message, final=False, mode='cs', timestamp=None):
+        """
+        增量显示流式消息：首帧时在末尾插入一个独立框架，之后每帧只替换该框架内的内容，
+        即使期间有其他消息追加到后面也不受影响。final 为真时结束跟踪。
+        """
+        entry = self._stream_frames.get(stream_id)
+        if entry is None:
+            cursor = QTextCursor(self.chat_display.document())
+            cursor.movePosition(QTextCursor.MoveOperation.End)
+            entry = (cursor.insertFrame(QTextFrameFormat()), timestamp)
+            self._stream_frames[stream_id] = entry
+        frame, first_timestamp = entry
+
+        cursor = frame.firstCursorPosition()
+        cursor.setPosition(frame.lastPosition(), QTextCursor.MoveMode.KeepAnchor)
+        cursor.removeSelectedText()
+        cursor.insertHtml(self._message_html(sender, message, mode=mode, timestamp=first_timestamp))
+        if final:
+            self._stream_frames.pop(stream_id, None)
+
+        scrollbar = self.chat_display.verticalScrollBar()
+        if scrollbar:
+            scrollbar.setValue(scrollbar.maximum())
+
     def append_system_message(self, message):
         html = f'''
             <div style="text-align: left; margin: 5px;">
@@ -329,6 +362,8 @@ class MainWindow(QMainWindow):
         self.setGeometry(100, 100, 900, 700)
         self.chat_widgets = {}
         self.friend_chat_modes = {}
+        self._friend_items = {}  # username -> QListWidgetItem
+        self._online_rows = 0    # 列表顶部在线好友区的行数，后续分页的在线好友插入到该区末尾
         self._setup_ui()
         self.setWindowTitle(f"安全IM - 已登录为 {username}")
 
@@ -393,6 +428,7 @@ class MainWindow(QMainWindow):
         self.friend_list_widget.setContextMenuPolicy(Qt.ContextMenuPolicy.CustomContextMenu)
         self.friend_list_widget.customContextMenuRequested.connect(self._show_friend_context_menu)
         self.friend_list_widget.currentItemChanged.connect(self._on_friend_selected)
+        self.friend_list_widget.verticalScrollBar().valueChanged.connect(self._on_friend_list_scrolled)
         add_friend_button = QPushButton("添加好友")
         add_friend_button.clicked.connect(self._on_add_friend)
 
@@ -467,38 +503,66 @@ class MainWindow(QMainWindow):
 
     def update_friend_list(self, friends):
         self.friend_list_widget.clear()
+        self._friend_items = {}
+        self._online_rows = 0
         # Sort friends to show online users first
         friends.sort(key=lambda f: f.get("status", "offline") == "offline")
 
         for friend_data in friends:
-            username = friend_data.get("username")
-            self.friend_chat_modes.setdefault(username, 'cs')
-            item = QListWidgetItem()
-            item.setData(Qt.ItemDataRole.UserRole, friend_data)
+            self._add_friend_item(friend_data)
+            if friend_data.get("status") == "online":
+                self._online_rows += 1
+
+    def append_friends(self, friends):
+        """追加后续分页加载的好友，不清空已有列表；在线好友插入到在线区末尾，与第一页的排序一致。"""
+        for friend_data in friends:
+            if friend_data.get("username") in self._friend_items:
+                continue
+            if friend_data.get("status") == "online":
+                self._add_friend_item(friend_data, self._online_rows)
+                self._online_rows += 1
+            else:
+                self._add_friend_item(friend_data)
 
-            # 设置特别关注好友的背景色
-            if username in self.starred_friends:
-                item.setBackground(QColor("#ffcccc"))  # 浅红色背景
+    def _friend_item(self, username):
+        return self._friend_items.get(username)
 
+    def _add_friend_item(self, friend_data, row=None):
+        username = friend_data.get("username")
+        self.friend_chat_modes.setdefault(username, 'cs')
+        item = QListWidgetItem()
+        item.setData(Qt.ItemDataRole.UserRole, friend_data)
+
+        # 设置特别关注好友的背景色
+        if username in self.starred_friends:
+            item.setBackground(QColor("#ffcccc"))  # 浅红色背景
+
+        if row is None:
             self.friend_list_widget.addItem(item)
-            self._update_friend_item_display(item)
+        else:
+            self.friend_list_widget.insertItem(row, item)
+        self._friend_items[username] = item
+        self._update_friend_item_display(item)
+
+    def _on_friend_list_scrolled(self, value):
+        # 滚动到底部附近时立即加载下一页好友
+        if self.logic and value >= self.friend_list_widget.verticalScrollBar().maximum() - 2:
+            self.logic.request_more_friends()
 
     def set_friend_status(self, friend_update_data):
         username = friend_update_data.get("username")
         status = friend_update_data.get("status")
-        for i in range(self.friend_list_widget.count()):
-            item = self.friend_list_widget.item(i)
+        item = self._friend_item(username)
+        if item is not None:
             item_data = item.data(Qt.ItemDataRole.UserRole)
-            if item_data and item_data.get("username") == username:
-                item_data.update(friend_update_data)
-                item.setData(Qt.ItemDataRole.UserRole, item_data)
-                self._update_friend_item_display(item)
-                # If this friend's chat is currently open, update its input state
-                current_chat_widget = self._get_current_chat_widget()
-                if current_chat_widget and current_chat_widget.partner_name == username:
-                    is_online = friend_update_data.get("status") == "online"
-                    current_chat_widget.set_input_enabled(is_online)
-                break
+            item_data.update(friend_update_data)
+            item.setData(Qt.ItemDataRole.UserRole, item_data)
+            self._update_friend_item_display(item)
+            # If this friend's chat is currently open, update its input state
+            current_chat_widget = self._get_current_chat_widget()
+            if current_chat_widget and current_chat_widget.partner_name == username:
+                is_online = friend_update_data.get("status") == "online"
+                current_chat_widget.set_input_enabled(is_online)
 
     def set_chat_mode(self, username, mode):
         # 更新本地缓存
@@ -510,14 +574,7 @@ class MainWindow(QMainWindow):
             self.logic._chat_modes[username] = mode
 
         # 更新好友列表图标
-        item_to_update = None
-        for i in range(self.friend_list_widget.count()):
-            item = self.friend_list_widget.item(i)
-            item_data = item.data(Qt.ItemDataRole.UserRole)
-            if item_data and item_data.get("username") == username:
-                item_to_update = item
-                break
-
+        item_to_update = self._friend_item(username)
         if item_to_update:
             self._update_friend_item_icon(item_to_update)
 
@@ -592,13 +649,29 @@ class MainWindow(QMainWindow):
 
         # 未读消息通知
         if not is_self and self._get_current_partner_name() != sender:
-            for i in range(self.friend_list_widget.count()):
-                item = self.friend_list_widget.item(i)
-                if item.data(Qt.ItemDataRole.UserRole).get("username") == sender:
-                    font = item.font()
-                    font.setBold(True)
-                    item.setFont(font)
-                    break
+            item = self._friend_item(sender)
+            if item is not None:
+                font = item.font()
+                font.setBold(True)
+                item.setFont(font)
+
+    def update_stream_message(self, sender, stream_id, message, final=False, mode='cs', timestamp=None):
+        """显示好友（AI）流式回复的最新内容。"""
+        if sender not in self.chat_widgets:
+            self._create_chat_widget(sender)
+
+        chat_widget = self.chat_widgets.get(sender)
+        if not chat_widget:
+            return
+        chat_widget.update_stream_message(sender, stream_id, message, final=final, mode=mode, timestamp=timestamp)
+
+        # 未读消息通知
+        if self._get_current_partner_name() != sender:
+            item = self._friend_item(sender)
+            if item is not None:
+                font = item.font()
+                font.setBold(True)
+                item.setFont(font)
 
     def add_stego_image_to_chat(self, sender, image_bytes, hidden_text, is_self=False, mode='cs', timestamp=None):
         partner = sender if not is_self else self._get_current_partner_name()
@@ -868,13 +941,11 @@ class MainWindow(QMainWindow):
         self.chat_stack.setCurrentWidget(self.chat_widgets[username])
 
         # 清除未读通知
-        for i in range(self.friend_list_widget.count()):
-            item = self.friend_list_widget.item(i)
-            if item.data(Qt.ItemDataRole.UserRole).get("username") == username:
-                font = item.font()
-                font.setBold(False)
-                item.setFont(font)
-                break
+        item = self._friend_item(username)
+        if item is not None:
+            font = item.font()
+            font.setBold(False)
+            item.setFont(font)
 
     def _show_friend_info(self, friend_data):
         username = friend_data.get("username")
@@ -979,11 +1050,12 @@ class MainWindow(QMainWindow):
             del self.context_menu
 
         # 从好友列表移除
-        for i in range(self.friend_list_widget.count()):
-            item = self.friend_list_widget.item(i)
-            if item and item.data(Qt.ItemDataRole.UserRole).get("username") == username:
-                self.friend_list_widget.takeItem(i)
-                break
+        item = self._friend_items.pop(username, None)
+        if item is not None:
+            row = self.friend_list_widget.row(item)
+            if row < self._online_rows:
+                self._online_rows -= 1
+            self.friend_list_widget.takeItem(row)
 
         # 从聊天堆栈中移除
         if username in self.chat_widgets:
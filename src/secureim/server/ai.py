@@ -1,152 +1,592 @@
-import threading
-import time
-import requests
-import json
-from . import server_crypto  # 服务器端加解密模块
-from .state import ai_session_keys
-
-# 硬编码的OpenAI兼容API配置
-API_URL = "http://127.0.0.1:1234/v1/chat/completions"
-API_KEY = "key"                # 替换为实际API密钥
-MODEL = "model"            # 替换为实际模型
-
-# 用于存储每个用户的AI响应生成状态
-ai_response_states = {}
-
-
-def handle_ai_message(username, encrypted_message, send_func):
-    """
-    处理用户发送给AI的消息
-    """
-    # 获取该用户的AES密钥
-    aes_key = ai_session_keys.get_key(username)
-    if not aes_key:
-        response = {"type": "response", "status": "error", "message": "未建立安全会话"}
-        send_func(response)
-        return
-
-    # 解密消息
-    try:
-        decrypted_data = server_crypto.decrypt_with_aes(aes_key, encrypted_message)
-        if decrypted_data is None:
-            response = {"type": "response", "status": "error", "message": "解密失败"}
-            send_func(response)
-            return
-
-        # 提取消息内容
-        message_content = decrypted_data.decode('utf-8')
-        print(f"用户 {username} 向AI发送消息: {message_content}")
-
-        # 启动新线程处理AI请求
-        thread = threading.Thread(
-            target=process_ai_request,
-            args=(username, message_content, aes_key, send_func)
-        )
-        thread.daemon = True
-        thread.start()
-
-    except Exception as e:
-        print(f"处理AI消息时出错: {e}")
-        response = {"type": "response", "status": "error", "message": "处理消息失败"}
-        send_func(response)
-
-
-def process_ai_request(username, message, aes_key, send_func):
-    """
-    处理AI请求并在后台生成响应
-    """
-    # 存储状态
-    ai_response_states[username] = {
-        "generating": True,
-        "last_update": time.time()
-    }
-
-    # 发送等待消息的线程
-    def send_waiting_messages():
-        while ai_response_states.get(username, {}).get("generating", False):
-            # 每5秒发送一次等待消息
-            time.sleep(5)
-
-            # 检查是否还在生成中
-            if not ai_response_states.get(username, {}).get("generating", False):
-                break
-
-            # 加密等待消息
-            waiting_msg = "正在生成内容，请等待..."
-            encrypted_waiting = server_crypto.encrypt_with_aes(aes_key, waiting_msg.encode('utf-8'))
-
-            # 构造AI响应
-            ai_response = {
-                "type": "receive_message",
-                "payload": {
-                    "from": "ai",
-                    "content": encrypted_waiting,
-                    "timestamp": time.time()
-                }
-            }
-
-            # 发送等待消息
-            send_func(ai_response)
-
-    # 启动等待消息线程
-    waiting_thread = threading.Thread(target=send_waiting_messages)
-    waiting_thread.daemon = True
-    waiting_thread.start()
-
-    try:
-        # 调用大模型API
-        headers = {
-            "Authorization": f"Bearer {API_KEY}",
-            "Content-Type": "application/json"
-        }
-
-        data = {
-            "model": MODEL,
-            "messages": [{"role": "user", "content": message}],
-            "stream": False
-        }
-
-        response = requests.post(API_URL, headers=headers, json=data)
-        response.raise_for_status()
-
-        # 解析响应
-        result = response.json()
-        ai_content = result['choices'][0]['message']['content']
-        print(f"AI生成响应给 {username}: {ai_content[:50]}...")
-
-        # 加密AI响应
-        encrypted_response = server_crypto.encrypt_with_aes(aes_key, ai_content.encode('utf-8'))
-
-        # 构造AI响应
-        ai_response = {
-            "type": "receive_message",
-            "payload": {
-                "from": "ai",
-                "content": encrypted_response,
-                "timestamp": time.time()
-            }
-        }
-
-        # 发送最终响应
-        send_func(ai_response)
-
-    except Exception as e:
-        print(f"调用AI API时出错: {e}")
-        error_msg = "AI服务暂时不可用，请稍后再试"
-        encrypted_error = server_crypto.encrypt_with_aes(aes_key, error_msg.encode('utf-8'))
-
-        error_response = {
-            "type": "receive_message",
-            "payload": {
-                "from": "ai",
-                "content": encrypted_error,
-                "timestamp": time.time()
-            }
-        }
-
-        send_func(error_response)
-
-    finally:
-        # 清理状态
-        if username in ai_response_states:
-            ai_response_states[username]["generating"] = False
\ No newline at end of file
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from . import llm_client
+from . import server_crypto  # 服务器端加解密模块
+from .ai_cache import ai_response_cache
+from .ai_memory import conversation_memory, estimate_tokens
+from .scheduler import scheduler
+from .state import ai_session_keys
+
+# 硬编码的OpenAI兼容API配置
+API_URL = "http://127.0.0.1:1234/v1/chat/completions"
+API_KEY = "key"                # 替换为实际API密钥
+MODEL = "model"            # 替换为实际模型
+
+# 可用的大模型后端列表，路由器按延迟与失败率选择，故障后端会被熔断；
+# 默认只有上面配置的一个后端，可追加更多OpenAI兼容端点
+AI_BACKENDS = [
+    {"url": API_URL, "api_key": API_KEY, "model": MODEL},
+]
+
+# AI工作线程池配置：工作线程数即对大模型后端的全局并发上限
+AI_WORKERS = 4
+AI_MAX_BACKLOG = 500        # 全局排队请求上限，超过则拒绝
+AI_MAX_USER_BACKLOG = 20    # 单个用户排队请求上限
+AI_USER_CONCURRENCY = 1     # 单个用户同时执行的请求上限
+AI_DRR_QUANTUM = 256        # 公平调度每轮补充的额度（估算token数），乘以用户权重
+AI_USER_WEIGHTS = {}        # username -> 调度权重，未列出的用户为1
+
+# 流式响应的合并策略：增量文本累积满 STREAM_FLUSH_BYTES 字节或距上次发送超过
+# STREAM_FLUSH_INTERVAL 秒时加密发送一帧；首个增量立即发送以降低首字延迟
+STREAM_FLUSH_INTERVAL = 0.1
+STREAM_FLUSH_BYTES = 512
+
+# 等待首个输出期间，每隔 AI_WAITING_INTERVAL 秒提示一次"正在生成"；
+# 提示的加密与发送在独立的小线程池中执行，不占用共享调度线程
+AI_WAITING_INTERVAL = 5
+AI_NOTICE_WORKERS = 2
+
+# 可重试的后端错误（连接失败、超时、5xx）在尚未输出内容时按指数退避重试
+AI_MAX_RETRIES = 2
+AI_RETRY_BACKOFF = 1.0  # 首次重试延迟（秒），之后每次翻倍
+
+# 对话历史超出token预算时，是否调用大模型把淘汰的旧消息压缩为摘要（每次压缩多一次API调用）
+AI_SUMMARIZE_HISTORY = False
+
+# 是否启用AI回复缓存（范围、有效期与容量见 ai_cache 模块）
+AI_CACHE_ENABLED = False
+
+_notice_executor = None
+_notice_lock = threading.Lock()
+
+
+class AIQueueFullError(Exception):
+    """AI请求积压超过上限。"""
+
+
+class AITask:
+    """
+    排队或正在执行的AI请求。cost 是用于公平调度的估算成本（约等于提示词token数），
+    owner 标识发起请求的连接，连接关闭时按 owner 取消。
+    """
+
+    __slots__ = ('username', 'fn', 'args', 'cost', 'owner', 'cancelled', 'retry_delay', 'parked',
+                 '_callbacks', '_lock')
+
+    def __init__(self, username, fn, args, cost, owner):
+        self.username = username
+        self.fn = fn
+        self.args = args
+        self.cost = cost
+        self.owner = owner
+        self.cancelled = False
+        self.retry_delay = None  # 非空时本次执行结束后按该延迟重试
+        self.parked = False      # 正在退避等待重试
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def on_cancel(self, callback):
+        """注册取消时执行的回调（例如关闭正在读取的HTTP响应）；已取消则立即执行。"""
+        if not self.add_cancel_callback(callback):
+            callback()
+
+    def add_cancel_callback(self, callback):
+        """注册取消回调并返回True；已取消时不注册也不执行，返回False。"""
+        with self._lock:
+            if self.cancelled:
+                return False
+            self._callbacks.append(callback)
+            return True
+
+    def cancel(self):
+        with self._lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"取消AI请求时出错 ({self.username}): {e}")
+
+    def clear_callbacks(self):
+        """丢弃上一次执行注册的取消回调（重试前调用）。"""
+        with self._lock:
+            self._callbacks = []
+
+
+class AIWorkerPool:
+    """
+    固定大小的AI工作线程池，线程数即对大模型后端的全局并发上限。
+    每个用户一个FIFO队列，用户之间按加权差额轮询（DRR）分配执行机会：
+    每轮用户获得 quantum × 权重 的额度，请求按估算成本扣减额度，
+    因此提交大量或很长请求的用户不会挤占其他用户。每个用户同时执行的请求数有上限
+    （默认为1，同一用户的请求按提交顺序完成）。
+    退避重试的请求在等待期间不占用工作线程，但仍占用该用户的执行名额，到期后排在该用户队列的最前面，
+    因此重试不会打乱同一用户请求的顺序。
+    """
+
+    def __init__(self, workers=AI_WORKERS, max_backlog=AI_MAX_BACKLOG, max_user_backlog=AI_MAX_USER_BACKLOG,
+                 max_user_concurrency=AI_USER_CONCURRENCY, quantum=AI_DRR_QUANTUM):
+        self.workers = workers
+        self.max_backlog = max_backlog
+        self.max_user_backlog = max_user_backlog
+        self.max_user_concurrency = max_user_concurrency
+        self.quantum = quantum
+        self._weights = dict(AI_USER_WEIGHTS)  # username -> 权重，默认为1
+        self._queues = {}  # username -> deque[AITask]
+        self._deficit = {}  # username -> 剩余额度
+        self._ready = deque()  # 有排队请求且未达到并发上限的用户（轮询顺序）
+        self._running = {}  # username -> 正在执行的 AITask 列表
+        self._backlog = 0
+        self._cond = threading.Condition()
+        self._threads = []
+        self._local = threading.local()
+        self.completed = 0
+        self.rejected = 0
+        self.failed = 0
+        self.cancelled = 0
+
+    def _ensure_started(self):
+        # 调用方持有 self._cond
+        if not self._threads:
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._worker_loop, name=f"ai-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def set_weight(self, username, weight):
+        """设置用户的调度权重（例如付费用户更高）。"""
+        with self._cond:
+            self._weights[username] = weight
+
+    def submit(self, username, fn, *args, cost=1, owner=None):
+        """为用户排队一个AI任务并返回 AITask，积压超过上限时抛出 AIQueueFullError。"""
+        task = AITask(username, fn, args, max(1, cost), owner)
+        with self._cond:
+            queue = self._queues.get(username)
+            if self._backlog >= self.max_backlog or (queue and len(queue) >= self.max_user_backlog):
+                self.rejected += 1
+                raise AIQueueFullError("AI请求积压过多")
+            if queue is None:
+                queue = self._queues[username] = deque()
+            queue.append(task)
+            self._backlog += 1
+            if len(queue) == 1 and len(self._running.get(username, ())) < self.max_user_concurrency:
+                self._ready.append(username)
+            self._ensure_started()
+            self._cond.notify()
+        return task
+
+    def _next_task(self):
+        """按DRR选出下一个任务。调用方持有 self._cond 且 self._ready 非空。"""
+        while True:
+            username = self._ready[0]
+            task = self._queues[username][0]
+            deficit = self._deficit.get(username, 0)
+            if deficit < task.cost:
+                # 额度不足：补充一轮额度后排到队尾
+                self._deficit[username] = deficit + self.quantum * self._weights.get(username, 1)
+                self._ready.rotate(-1)
+                continue
+            self._deficit[username] = deficit - task.cost
+            queue = self._queues[username]
+            queue.popleft()
+            self._backlog -= 1
+            running = self._running.setdefault(username, [])
+            running.append(task)
+            if not queue:
+                # 队列清空的用户不保留剩余额度（DRR的标准做法）
+                self._ready.popleft()
+                del self._queues[username]
+                self._deficit.pop(username, None)
+            elif len(running) >= self.max_user_concurrency:
+                self._ready.popleft()
+            return task
+
+    def _worker_loop(self):
+        while True:
+            with self._cond:
+                while not self._ready:
+                    self._cond.wait()
+                task = self._next_task()
+            succeeded = False
+            self._local.task = task
+            try:
+                if not task.cancelled:
+                    task.fn(*task.args)
+                succeeded = True
+            except Exception as e:
+                print(f"AI任务执行出错 ({task.username}): {e}")
+            finally:
+                self._local.task = None
+                with self._cond:
+                    # 进入退避等待的任务由 _resume 归还名额，其余任务在这里归还（每个任务只归还一次）
+                    if not (task.retry_delay is not None and not task.cancelled and self._park(task)):
+                        if task.cancelled:
+                            self.cancelled += 1
+                        elif succeeded:
+                            self.completed += 1
+                        else:
+                            self.failed += 1
+                        self._release(task)
+
+    def _release(self, task):
+        """任务结束，归还用户的执行名额。调用方持有 self._cond。"""
+        running = self._running[task.username]
+        running.remove(task)
+        if not running:
+            del self._running[task.username]
+        queue = self._queues.get(task.username)
+        if (queue and task.username not in self._ready
+                and len(running) < self.max_user_concurrency):
+            # 同一用户的后续请求排到就绪队列末尾，与其他用户轮转
+            self._ready.append(task.username)
+            self._cond.notify()
+
+    def _park(self, task):
+        """
+        任务进入退避等待：保留用户的执行名额，到期后重新排队。调用方持有 self._cond。
+        任务在挂起前已被取消时返回False，名额由调用方归还。
+        """
+        delay, task.retry_delay = task.retry_delay, None
+        task.clear_callbacks()
+        task.parked = True
+        # 定时器回调需要 self._cond，在调用方释放锁之前不会执行
+        handle = scheduler.call_later(delay, self._resume, task)
+        # 等待期间连接关闭：立即释放名额，不等定时器到期（self._cond 可重入）。
+        # 取消可能发生在调用方检查之后，此时不在这里同步执行 _resume，以免名额被归还两次
+        if not task.add_cancel_callback(lambda: (handle.cancel(), self._resume(task))):
+            handle.cancel()
+            task.parked = False
+            return False
+        return True
+
+    def retry_later(self, task, delay, *args):
+        """在工作线程中调用：当前任务结束后，delay 秒后以新参数重新执行。"""
+        task.args = args
+        task.retry_delay = delay
+
+    def _resume(self, task):
+        # 退避到期（调度线程）或等待期间被取消
+        with self._cond:
+            if not task.parked:
+                return
+            task.parked = False
+            if task.cancelled:
+                self.cancelled += 1
+                self._release(task)
+                return
+            task.clear_callbacks()
+            queue = self._queues.get(task.username)
+            if queue is None:
+                queue = self._queues[task.username] = deque()
+            queue.appendleft(task)
+            self._backlog += 1
+            self._release(task)
+
+    def current_task(self):
+        """在工作线程中调用时返回正在执行的 AITask。"""
+        return getattr(self._local, 'task', None)
+
+    def cancel_user(self, username, owner=None):
+        """
+        取消用户排队中与正在执行的请求；指定 owner 时只取消该连接发起的请求，
+        以免旧连接关闭时误伤用户重新连接后的请求。返回取消的请求数。
+        """
+        with self._cond:
+            queue = self._queues.get(username)
+            dropped = []
+            if queue:
+                kept = deque()
+                for t in queue:
+                    (dropped if owner is None or t.owner is owner else kept).append(t)
+                self._backlog -= len(dropped)
+                self.cancelled += len(dropped)
+                if kept:
+                    self._queues[username] = kept
+                else:
+                    del self._queues[username]
+                    self._deficit.pop(username, None)
+                    if username in self._ready:
+                        self._ready.remove(username)
+            running = [t for t in self._running.get(username, ()) if owner is None or t.owner is owner]
+        for task in dropped + running:
+            task.cancel()
+        return len(dropped) + len(running)
+
+    def has_pending(self, username):
+        """该用户是否有排队或正在执行的请求。"""
+        with self._cond:
+            return username in self._queues or username in self._running
+
+    def stats(self):
+        with self._cond:
+            return {
+                "workers": self.workers,
+                "backlog": self._backlog,
+                "max_backlog": self.max_backlog,
+                "active": sum(len(tasks) for tasks in self._running.values()),
+                "queued_users": len(self._queues),
+                "max_user_depth": max((len(q) for q in self._queues.values()), default=0),
+                "completed": self.completed,
+                "failed": self.failed,
+                "cancelled": self.cancelled,
+                "rejected": self.rejected
+            }
+
+
+# 全局单例
+ai_worker_pool = AIWorkerPool()
+
+
+def handle_ai_message(username, encrypted_message, send_func, owner=None):
+    """
+    处理用户发送给AI的消息，owner 标识发起请求的连接（用于断开时取消）
+    """
+    # 获取该用户的AES密钥
+    aes_key = ai_session_keys.get_key(username)
+    if not aes_key:
+        response = {"type": "response", "status": "error", "message": "未建立安全会话"}
+        send_func(response)
+        return
+
+    # 解密消息
+    try:
+        decrypted_data = server_crypto.decrypt_with_aes(aes_key, encrypted_message)
+        if decrypted_data is None:
+            response = {"type": "response", "status": "error", "message": "解密失败"}
+            send_func(response)
+            return
+
+        # 提取消息内容
+        message_content = decrypted_data.decode('utf-8')
+        print(f"用户 {username} 向AI发送消息: {message_content}")
+
+        # 该用户没有未完成的请求时，对话上下文已确定，可以直接用缓存回复
+        if AI_CACHE_ENABLED and not ai_worker_pool.has_pending(username):
+            if answer_from_cache(username, message_content, aes_key, send_func):
+                return
+
+        # 交给AI工作线程池处理，同一用户的请求按顺序执行
+        submit_ai_request(username, message_content, aes_key, send_func, owner=owner)
+
+    except Exception as e:
+        print(f"处理AI消息时出错: {e}")
+        response = {"type": "response", "status": "error", "message": "处理消息失败"}
+        send_func(response)
+
+
+class AIStreamSender:
+    """
+    将大模型的文本增量合并为数据块，用用户的AI会话密钥加密后按序号发送 ai_stream_chunk 帧。
+    最后一帧 final 为真，客户端据此结束该条消息的增量显示。
+    """
+
+    def __init__(self, username, aes_key, send_func, flush_interval=STREAM_FLUSH_INTERVAL,
+                 flush_bytes=STREAM_FLUSH_BYTES):
+        self.username = username
+        self.aes_key = aes_key
+        self.send_func = send_func
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.stream_id = uuid.uuid4().hex
+        self.seq = 0  # 已发送的帧数
+        self._parts = []  # 已生成的全部增量
+        self._pending = []
+        self._pending_bytes = 0
+        self._last_flush = time.monotonic()
+
+    @property
+    def text(self):
+        """已生成的完整文本。"""
+        return "".join(self._parts)
+
+    def push(self, delta):
+        """缓存一段增量，达到合并条件时发送。返回本次是否发送了数据帧。"""
+        self._parts.append(delta)
+        self._pending.append(delta)
+        self._pending_bytes += len(delta.encode('utf-8'))
+        if (self.seq == 0 or self._pending_bytes >= self.flush_bytes
+                or time.monotonic() - self._last_flush >= self.flush_interval):
+            self._send(final=False)
+            return True
+        return False
+
+    def finish(self, suffix=""):
+        """发送剩余内容作为结束帧。"""
+        if suffix:
+            self._parts.append(suffix)
+            self._pending.append(suffix)
+        self._send(final=True)
+
+    def _send(self, final):
+        content = "".join(self._pending)
+        self._pending = []
+        self._pending_bytes = 0
+        self._last_flush = time.monotonic()
+        self.send_func({
+            "type": "ai_stream_chunk",
+            "payload": {
+                "from": "ai",
+                "stream_id": self.stream_id,
+                "seq": self.seq,
+                "content": server_crypto.encrypt_with_aes(self.aes_key, content.encode('utf-8')),
+                "final": final,
+                "timestamp": time.time()
+            }
+        })
+        self.seq += 1
+
+
+def _cache_key(username, message, messages):
+    # 上下文为本条消息之前的所有消息（摘要与历史）；模型取路由器配置中的全部模型，
+    # 查询缓存时尚未选定后端，更换或增减模型后不会再命中旧模型生成的回复
+    models = ",".join(sorted({backend["model"] for backend in AI_BACKENDS}))
+    return ai_response_cache.key_for(username, models, message, messages[:-1])
+
+
+def answer_from_cache(username, message, aes_key, send_func):
+    """命中缓存时直接发送缓存的回复（单个结束帧）并返回True，不调用大模型API。"""
+    messages = conversation_memory.build_messages(username, message)
+    reply = ai_response_cache.get(_cache_key(username, message, messages))
+    if reply is None:
+        return False
+    AIStreamSender(username, aes_key, send_func).finish(reply)
+    conversation_memory.record_exchange(username, message, reply)
+    print(f"AI回复缓存命中 ({username})，缓存状态: {ai_response_cache.stats()}")
+    return True
+
+
+def submit_ai_request(username, message, aes_key, send_func, attempt=0, owner=None):
+    """把AI请求提交到工作线程池，积压过多时直接告知用户。"""
+    try:
+        ai_worker_pool.submit(username, process_ai_request, username, message, aes_key, send_func, attempt, owner,
+                              cost=estimate_tokens(message), owner=owner)
+    except AIQueueFullError:
+        print(f"AI请求被拒绝 ({username})，队列状态: {ai_worker_pool.stats()}")
+        response = {"type": "response", "status": "error", "message": "AI服务繁忙，请稍后再试"}
+        send_func(response)
+
+
+def cancel_ai_requests(username, owner=None):
+    """
+    取消用户的AI请求（排队、执行中以及等待重试的），例如在连接关闭时调用。
+    指定 owner 时只取消该连接发起的请求。
+    """
+    count = ai_worker_pool.cancel_user(username, owner)
+    if count:
+        print(f"已取消用户 {username} 的 {count} 个AI请求")
+    return count
+
+
+def summarize_history(previous_summary, turns):
+    """调用大模型把被淘汰的旧消息（连同旧摘要）压缩为一段简短摘要。"""
+    lines = [f"已有摘要：{previous_summary}"] if previous_summary else []
+    lines.extend(f"{'用户' if role == 'user' else '助手'}：{content}" for role, content in turns)
+    client = llm_client.get_router(AI_BACKENDS)
+    result = client.chat_completion([
+        {"role": "system", "content": "请用简洁的中文概括以下对话中的关键信息，供后续对话参考，不超过200字。"},
+        {"role": "user", "content": "\n".join(lines)}
+    ])
+    return result['choices'][0]['message']['content']
+
+
+def _get_notice_executor():
+    global _notice_executor
+    with _notice_lock:
+        if _notice_executor is None:
+            _notice_executor = ThreadPoolExecutor(max_workers=AI_NOTICE_WORKERS, thread_name_prefix="ai-notice")
+        return _notice_executor
+
+
+def _submit_waiting_message(pending, aes_key, send_func):
+    # 调度线程中只提交任务，加密与阻塞的 sendall 在提示线程池中执行；
+    # 上一条提示还没发出（客户端套接字阻塞）时跳过本次，避免提示堆积
+    if pending and not pending[0].done():
+        return
+    pending[:] = [_get_notice_executor().submit(send_waiting_message, aes_key, send_func)]
+
+
+def send_waiting_message(aes_key, send_func):
+    """发送一条"正在生成"提示。"""
+    waiting_msg = "正在生成内容，请等待..."
+    encrypted_waiting = server_crypto.encrypt_with_aes(aes_key, waiting_msg.encode('utf-8'))
+
+    ai_response = {
+        "type": "receive_message",
+        "payload": {
+            "from": "ai",
+            "content": encrypted_waiting,
+            "timestamp": time.time()
+        }
+    }
+    send_func(ai_response)
+
+
+def process_ai_request(username, message, aes_key, send_func, attempt=0, owner=None):
+    """
+    处理AI请求并在后台生成响应
+    """
+    task = ai_worker_pool.current_task()
+    # 在收到首个输出之前，由共享调度器定期提交等待提示
+    waiting_timer = scheduler.call_every(AI_WAITING_INTERVAL, _submit_waiting_message, [], aes_key, send_func)
+
+    stream = AIStreamSender(username, aes_key, send_func)
+    try:
+        # 通过路由器选择后端，以流式方式调用大模型API，增量合并后逐帧发送
+        client = llm_client.get_router(AI_BACKENDS)
+        messages = conversation_memory.build_messages(username, message)
+        on_response = cancelled = None
+        if task is not None:
+            # 请求被取消时中止正在读取的响应，释放工作线程与后端连接（中止引起的错误不计入后端熔断）
+            on_response = lambda response: task.on_cancel(lambda: llm_client.abort_response(response))
+            cancelled = lambda: task.cancelled
+        for delta in client.stream_chat_completion(messages, on_response=on_response, cancelled=cancelled):
+            if task is not None and task.cancelled:
+                break
+            if stream.push(delta):
+                # 已开始输出内容，不再需要等待提示
+                waiting_timer.cancel()
+        if task is not None and task.cancelled:
+            print(f"AI请求已取消 ({username})")
+            return
+        stream.finish()
+        print(f"AI生成响应给 {username}: {stream.text[:50]}...")
+
+        if AI_CACHE_ENABLED:
+            ai_response_cache.put(_cache_key(username, message, messages), stream.text)
+
+        # 只记录完整的回复，中断或失败的请求不进入对话历史
+        conversation_memory.record_exchange(username, message, stream.text,
+                                            summarize_history if AI_SUMMARIZE_HISTORY else None)
+
+    except Exception as e:
+        if task is not None and task.cancelled:
+            print(f"AI请求已取消 ({username})")
+            return
+        print(f"调用AI API时出错: {e}")
+        if stream.seq:
+            # 已发送部分内容，以结束帧告知客户端回复不完整
+            stream.finish("\n[AI服务中断，回复不完整]")
+        elif attempt < AI_MAX_RETRIES and llm_client.is_retryable(e):
+            # 退避期间不占用工作线程，但保留该用户的执行名额，到期后排在其队列最前面
+            delay = AI_RETRY_BACKOFF * (2 ** attempt)
+            print(f"AI请求将在 {delay:.1f}s 后重试 ({username}，第 {attempt + 1} 次)")
+            if task is not None:
+                ai_worker_pool.retry_later(task, delay, username, message, aes_key, send_func, attempt + 1, owner)
+            else:
+                scheduler.call_later(delay, submit_ai_request, username, message, aes_key, send_func,
+                                     attempt + 1, owner)
+        else:
+            error_msg = "AI服务暂时不可用，请稍后再试"
+            encrypted_error = server_crypto.encrypt_with_aes(aes_key, error_msg.encode('utf-8'))
+
+            error_response = {
+                "type": "receive_message",
+                "payload": {
+                    "from": "ai",
+                    "content": encrypted_error,
+                    "timestamp": time.time()
+                }
+            }
+
+            send_func(error_response)
+
+    finally:
+        waiting_timer.cancel()
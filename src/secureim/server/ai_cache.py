@@ -0,0 +1,112 @@
+import hashlib
+import json
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+# 缓存范围：'user' 表示每个用户独立缓存，'global' 表示所有用户共享
+SCOPE_USER = 'user'
+SCOPE_GLOBAL = 'global'
+
+CACHE_TTL = 600                      # 缓存条目的有效期（秒）
+CACHE_MAX_ENTRIES = 10000
+CACHE_MAX_BYTES = 16 * 1024 * 1024   # 所有缓存回复的总大小上限
+
+_WHITESPACE = re.compile(r'\s+')
+_TRAILING_PUNCTUATION = '?？!！.。~～'
+
+
+def normalize_prompt(prompt):
+    """规整提示词：全半角统一(NFKC)、忽略大小写、合并空白并去掉结尾的问号/感叹号等。"""
+    text = unicodedata.normalize('NFKC', prompt).casefold()
+    text = _WHITESPACE.sub(' ', text).strip()
+    return text.rstrip(_TRAILING_PUNCTUATION).strip()
+
+
+def make_key(scope_id, model, prompt, context):
+    """根据范围、模型、规整后的提示词以及对话上下文（消息列表）计算缓存键。"""
+    context_hash = hashlib.sha256(
+        json.dumps(context, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+    raw = '\x00'.join((scope_id, model, context_hash, normalize_prompt(prompt)))
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class AIResponseCache:
+    """
+    AI回复缓存：LRU淘汰（条目数与总字节数双重上限），条目超过TTL后视为失效。
+    记录命中、未命中、过期与淘汰次数，便于观察命中率。
+    """
+
+    def __init__(self, scope=SCOPE_USER, ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES, max_bytes=CACHE_MAX_BYTES):
+        self.scope = scope
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (过期时间, 回复, 字节数)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+    def key_for(self, username, model, prompt, context):
+        scope_id = username if self.scope == SCOPE_USER else '*'
+        return make_key(scope_id, model, prompt, context)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, reply, size = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                self._bytes -= size
+                self.expired += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return reply
+
+    def put(self, key, reply):
+        size = len(reply.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+            self._entries[key] = (time.monotonic() + self.ttl, reply, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "scope": self.scope,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "expired": self.expired,
+                "evictions": self.evictions
+            }
+
+
+# 全局单例
+ai_response_cache = AIResponseCache()
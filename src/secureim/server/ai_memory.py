@@ -0,0 +1,155 @@
+import threading
+import time
+from collections import deque
+
+from .scheduler import scheduler
+
+# 每次请求携带的上下文（摘要 + 历史 + 本条消息）的近似token预算
+CONTEXT_TOKEN_BUDGET = 3000
+SUMMARY_TOKEN_BUDGET = 400   # 摘要本身的上限，超出部分截断
+MAX_TURNS = 64               # 每个用户最多保留的消息条数（环形缓冲区容量）
+IDLE_TIMEOUT = 30 * 60       # 会话空闲超过该秒数后被清除
+SWEEP_INTERVAL = 60          # 空闲清理的执行间隔（秒）
+
+
+def estimate_tokens(text):
+    """
+    粗略估计文本的token数：中日韩字符按每字1个token，其余字符按每4个字符1个token。
+    只用于预算控制，不需要与后端分词器完全一致。
+    """
+    wide = sum(1 for ch in text if ord(ch) >= 0x2E80)
+    return wide + (len(text) - wide + 3) // 4 + 1
+
+
+class _Conversation:
+    """单个用户的会话：环形缓冲区中存放 (角色, 内容, token数)，受 lock 保护。"""
+
+    __slots__ = ('turns', 'tokens', 'summary', 'summary_tokens', 'last_active', 'lock')
+
+    def __init__(self, max_turns):
+        self.turns = deque(maxlen=max_turns)
+        self.tokens = 0  # 缓冲区中所有消息的token总数
+        self.summary = None
+        self.summary_tokens = 0
+        self.last_active = time.monotonic()
+        self.lock = threading.Lock()
+
+
+class ConversationMemory:
+    """
+    按用户保存与AI的对话历史。
+    历史总量受token预算约束，超出时从最旧的消息开始淘汰；可选地把淘汰的消息交给
+    summarizer 压缩成一段摘要，作为系统消息附在上下文开头。空闲会话由调度器定期清除。
+    """
+
+    def __init__(self, budget=CONTEXT_TOKEN_BUDGET, summary_budget=SUMMARY_TOKEN_BUDGET, max_turns=MAX_TURNS,
+                 idle_timeout=IDLE_TIMEOUT, sweep_interval=SWEEP_INTERVAL):
+        self.budget = budget
+        self.summary_budget = summary_budget
+        self.max_turns = max_turns
+        self.idle_timeout = idle_timeout
+        self.sweep_interval = sweep_interval
+        self._conversations = {}  # username -> _Conversation
+        self._lock = threading.Lock()
+        self._sweeper = None
+
+    def _get(self, username):
+        with self._lock:
+            conversation = self._conversations.get(username)
+            if conversation is None:
+                conversation = self._conversations[username] = _Conversation(self.max_turns)
+            if self._sweeper is None:
+                self._sweeper = scheduler.call_every(self.sweep_interval, self.evict_idle)
+            return conversation
+
+    def build_messages(self, username, user_message):
+        """
+        组装本次请求的消息列表：[摘要] + 预算内最近的历史 + 本条用户消息。
+        本条消息总会包含在内，历史从最新往回取，直到预算用完。
+        """
+        conversation = self._get(username)
+        remaining = self.budget - estimate_tokens(user_message)
+        with conversation.lock:
+            conversation.last_active = time.monotonic()
+            if conversation.summary and conversation.summary_tokens <= remaining:
+                remaining -= conversation.summary_tokens
+                summary = conversation.summary
+            else:
+                summary = None
+            history = []
+            for role, content, tokens in reversed(conversation.turns):
+                if tokens > remaining:
+                    break
+                remaining -= tokens
+                history.append({"role": role, "content": content})
+
+        messages = []
+        if summary:
+            messages.append({"role": "system", "content": f"此前对话的摘要：{summary}"})
+        messages.extend(reversed(history))
+        messages.append({"role": "user", "content": user_message})
+        return messages
+
+    def record_exchange(self, username, user_message, reply, summarizer=None):
+        """
+        保存一轮完整的问答，并把历史裁剪到预算以内（最旧的先淘汰）。
+        提供 summarizer(旧摘要, [(角色, 内容), ...]) 时，淘汰的消息被合并进摘要。
+        """
+        conversation = self._get(username)
+        with conversation.lock:
+            conversation.last_active = time.monotonic()
+            dropped = []
+            for role, content in (("user", user_message), ("assistant", reply)):
+                if len(conversation.turns) == conversation.turns.maxlen:
+                    dropped.append(conversation.turns[0])
+                    conversation.tokens -= conversation.turns[0][2]
+                tokens = estimate_tokens(content)
+                conversation.turns.append((role, content, tokens))
+                conversation.tokens += tokens
+            while conversation.turns and conversation.tokens > self.budget:
+                oldest = conversation.turns.popleft()
+                conversation.tokens -= oldest[2]
+                dropped.append(oldest)
+
+            if dropped and summarizer is not None:
+                # 在该用户的会话锁内执行：同一用户的AI请求本来就是串行的
+                try:
+                    summary = summarizer(conversation.summary, [(role, content) for role, content, _ in dropped])
+                except Exception as e:
+                    print(f"生成对话摘要失败 ({username}): {e}")
+                    summary = None
+                if summary:
+                    # 超出摘要预算时按比例截断
+                    tokens = estimate_tokens(summary)
+                    if tokens > self.summary_budget:
+                        summary = summary[:len(summary) * self.summary_budget // tokens]
+                        tokens = estimate_tokens(summary)
+                    conversation.summary = summary
+                    conversation.summary_tokens = tokens
+
+    def clear(self, username):
+        with self._lock:
+            self._conversations.pop(username, None)
+
+    def evict_idle(self):
+        """清除空闲超过 idle_timeout 的会话（由调度器定期调用）。"""
+        deadline = time.monotonic() - self.idle_timeout
+        with self._lock:
+            idle = [name for name, conversation in self._conversations.items()
+                    if conversation.last_active < deadline]
+            for name in idle:
+                del self._conversations[name]
+        return len(idle)
+
+    def stats(self):
+        with self._lock:
+            conversations = list(self._conversations.values())
+        return {
+            "conversations": len(conversations),
+            "turns": sum(len(c.turns) for c in conversations),
+            "tokens": sum(c.tokens + c.summary_tokens for c in conversations)
+        }
+
+
+# 全局单例
+conversation_memory = ConversationMemory()
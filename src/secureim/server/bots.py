@@ -0,0 +1,261 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from . import database, server_crypto
+from .state import AISessionKeys, ai_session_keys, online_users
+
+# 所有机器人共用的工作线程数与排队上限；同一用户发给同一机器人的消息按顺序处理
+BOT_WORKERS = 8
+BOT_MAX_PENDING = 1000
+BOT_BATCH = 16  # 每次占用工作线程最多连续处理的消息数，之后让出给其他会话
+
+# 启用的内置机器人（用户名）；同名账号已被普通用户占用的机器人在启动时会被跳过
+ENABLED_BOTS = ["ai", "echo", "notice"]
+
+
+class BotContext:
+    """一次投递的上下文：发送方用户名、回复函数以及发起请求的连接。"""
+
+    __slots__ = ('username', 'send_func', 'owner')
+
+    def __init__(self, username, send_func, owner):
+        self.username = username
+        self.send_func = send_func
+        self.owner = owner
+
+
+class Bot:
+    """
+    服务器端机器人用户的基类。
+    机器人是数据库中的普通账号（公钥可供客户端获取），私钥由服务器保存；
+    会话密钥与消息的处理函数在共享的机器人线程池中执行，空闲时不占用线程。
+    """
+
+    username = None
+    email = None
+
+    def __init__(self):
+        self.session_keys = AISessionKeys()
+
+    def ensure_account(self):
+        """
+        创建机器人账号与密钥对（如不存在）。返回账号是否可用：
+        同名账号已存在但服务器没有其私钥（例如被普通用户占用）时返回False。
+        """
+        if database.create_bot_account(self.username, self.email):
+            print(f"机器人用户 {self.username} 已创建，并生成了密钥对")
+        elif database.load_private_key_pem(self.username) is None:
+            print(f"错误: 用户名 '{self.username}' 已被普通账号占用且服务器没有其私钥，机器人 {self.username} 未启用")
+            return False
+        return True
+
+    def presence(self):
+        """好友列表中显示的在线状态，机器人默认始终在线。"""
+        return {"status": "online", "ip": "0.0.0.0", "port": 0}
+
+    def on_session_key(self, ctx, encrypted_key):
+        # 已在机器人工作线程中执行，同一会话的后续消息排在其后，直接解包即可
+        try:
+            aes_key = server_crypto.decrypt_with_private_key(self.username, encrypted_key)
+        except Exception as e:
+            print(f"机器人 {self.username} 解包 {ctx.username} 的会话密钥失败: {e}")
+            self.session_keys.remove_key(ctx.username)
+            return
+        self.session_keys.store_key(ctx.username, aes_key)
+
+    def on_message(self, ctx, payload):
+        raise NotImplementedError
+
+    def on_disconnect(self, username, owner):
+        """用户的连接关闭时调用（在连接线程中执行，必须很快返回）。"""
+
+    def decrypt_text(self, username, encrypted_message):
+        aes_key = self.session_keys.get_key(username)
+        if not aes_key or not encrypted_message:
+            return None
+        decrypted = server_crypto.decrypt_with_aes(aes_key, encrypted_message)
+        return decrypted.decode('utf-8') if decrypted is not None else None
+
+    def send_text(self, send_func, username, text):
+        """用该用户的会话密钥加密文本并以机器人的身份发送，没有会话密钥时返回False。"""
+        aes_key = self.session_keys.get_key(username)
+        if not aes_key:
+            return False
+        send_func({
+            "type": "receive_message",
+            "payload": {
+                "from": self.username,
+                "content": server_crypto.encrypt_with_aes(aes_key, text.encode('utf-8')),
+                "timestamp": time.time()
+            }
+        })
+        return True
+
+
+class AIBot(Bot):
+    """AI助手：消息交给 ai 模块的工作线程池，连接关闭时取消未完成的请求。"""
+
+    username = "ai"
+    email = "ai@system.local"
+
+    def __init__(self):
+        super().__init__()
+        self.session_keys = ai_session_keys
+
+    def on_message(self, ctx, payload):
+        from . import ai
+        encrypted_message = payload.get('content')
+        if encrypted_message:
+            ai.handle_ai_message(ctx.username, encrypted_message, ctx.send_func, owner=ctx.owner)
+
+    def on_disconnect(self, username, owner):
+        from . import ai
+        ai.cancel_ai_requests(username, owner=owner)
+
+
+class EchoBot(Bot):
+    """回声机器人：原样返回收到的文本，用于测试端到端加密链路。"""
+
+    username = "echo"
+    email = "echo@system.local"
+
+    def on_message(self, ctx, payload):
+        text = self.decrypt_text(ctx.username, payload.get('content'))
+        if text is not None:
+            self.send_text(ctx.send_func, ctx.username, text)
+
+
+class NotificationBot(Bot):
+    """系统通知机器人：由服务器调用 notify 向在线用户推送通知，不处理用户回复。"""
+
+    username = "notice"
+    email = "notice@system.local"
+
+    def on_message(self, ctx, payload):
+        self.send_text(ctx.send_func, ctx.username, "这是系统通知账号，无法回复消息。")
+
+    def notify(self, username, text):
+        """向在线且已与本机器人建立会话的用户发送通知，返回是否已发送。"""
+        from .connection_handler import send_to_client
+        client_socket = online_users.get_socket(username)
+        if client_socket is None:
+            return False
+        return self.send_text(lambda data: send_to_client(client_socket, data), username, text)
+
+
+BUILTIN_BOTS = {"ai": AIBot, "echo": EchoBot, "notice": NotificationBot}
+
+
+class BotRegistry:
+    """
+    机器人注册表。中继循环把发给机器人的会话密钥与消息交给 dispatch，
+    每个 (机器人, 用户) 会话一个FIFO队列，在共享的有界线程池上按顺序处理，
+    新增机器人只需注册，不需要修改中继逻辑。
+    """
+
+    def __init__(self, workers=BOT_WORKERS, max_pending=BOT_MAX_PENDING):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._bots = {}  # username -> Bot
+        self._queues = {}  # (机器人, 用户) -> deque[(处理函数, 参数)]
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._executor = None
+        self.rejected = 0
+
+    def register(self, bot):
+        self._bots[bot.username] = bot
+        database.RESERVED_USERNAMES.add(bot.username.lower())
+
+    def get(self, username):
+        return self._bots.get(username)
+
+    def initialize(self):
+        """为所有已注册的机器人创建账号（在 database.create_tables 之后调用），账号不可用的机器人会被注销。"""
+        for bot in list(self._bots.values()):
+            if not bot.ensure_account():
+                del self._bots[bot.username]
+
+    def _get_executor(self):
+        # 调用方持有 self._lock
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bot")
+        return self._executor
+
+    def dispatch(self, msg_type, current_user, payload, send_func, owner=None):
+        """
+        若 relay_message / relay_session_key 的目标是机器人，则排队处理并返回True；
+        否则返回False，由调用方按普通用户中继。
+        """
+        bot = self._bots.get(payload.get('to'))
+        if bot is None:
+            return False
+        ctx = BotContext(current_user, send_func, owner)
+        if msg_type == "relay_session_key":
+            encrypted_key = payload.get('key')
+            if encrypted_key:
+                self._enqueue(bot, ctx, bot.on_session_key, ctx, encrypted_key)
+        else:
+            self._enqueue(bot, ctx, bot.on_message, ctx, payload)
+        return True
+
+    def _enqueue(self, bot, ctx, handler, *args):
+        key = (bot.username, ctx.username)
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self.rejected += 1
+                rejected = True
+            else:
+                rejected = False
+                queue = self._queues.get(key)
+                start = queue is None
+                if start:
+                    queue = self._queues[key] = deque()
+                queue.append((handler, args))
+                self._pending += 1
+                if start:
+                    self._get_executor().submit(self._drain, key)
+        if rejected:
+            ctx.send_func({"type": "response", "status": "error", "message": "服务器繁忙，请稍后重试"})
+
+    def _drain(self, key):
+        for _ in range(BOT_BATCH):
+            with self._lock:
+                queue = self._queues[key]
+                if not queue:
+                    del self._queues[key]
+                    return
+                handler, args = queue.popleft()
+                self._pending -= 1
+            try:
+                handler(*args)
+            except Exception as e:
+                print(f"机器人 {key[0]} 处理 {key[1]} 的消息时出错: {e}")
+        # 连续处理了一批仍未处理完，重新排队，让其他会话也能得到线程
+        with self._lock:
+            self._get_executor().submit(self._drain, key)
+
+    def connection_closed(self, username, owner):
+        """用户的连接关闭或退出登录时通知所有机器人。"""
+        for bot in self._bots.values():
+            try:
+                bot.on_disconnect(username, owner)
+            except Exception as e:
+                print(f"机器人 {bot.username} 处理断开连接时出错: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "bots": list(self._bots),
+                "pending": self._pending,
+                "active_sessions": len(self._queues),
+                "rejected": self.rejected
+            }
+
+
+# 全局单例
+bot_registry = BotRegistry()
+for _name in ENABLED_BOTS:
+    bot_registry.register(BUILTIN_BOTS[_name]())
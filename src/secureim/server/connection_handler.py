@@ -1,6 +1,7 @@
 import json
-from .state import online_users, ai_session_keys
-from . import request_handler as handler, server_crypto
+from .state import online_users
+from .bots import bot_registry
+from . import request_handler as handler
 from . import database
 
 def send_to_client(client_socket, data):
@@ -67,7 +68,7 @@ def handle_client_connection(client_socket, address):
                     continue
 
                 elif msg_type == "request_verification_code":
-                    handler.handle_request_verification_code(payload, send_func)
+                    handler.handle_request_verification_code(payload, send_func, address)
                     continue
 
                 elif msg_type == "change_password":
@@ -93,6 +94,8 @@ def handle_client_connection(client_socket, address):
                     handler.handle_get_user_info(current_user, send_func, address)
                 elif msg_type == "get_friends":
                     handler.handle_get_friends(current_user, send_func)
+                elif msg_type == "get_friends_page":
+                    handler.handle_get_friends_page(payload, current_user, send_func)
 
                 elif msg_type == "get_public_key":
                     handler.handle_get_public_key(payload, send_func)
@@ -109,38 +112,25 @@ def handle_client_connection(client_socket, address):
                 elif msg_type in ["relay_message", "relay_session_key"]:
                     to_user = payload.get('to')
 
-                    if to_user == "ai":
-                        # 处理发送给AI的消息
-                        from . import ai
-                        if msg_type == "relay_session_key":
-                            # 处理会话密钥
-                            encrypted_key = payload.get('key')
-                            if encrypted_key:
-                                # 使用AI私钥解密AES密钥
-                                aes_key = server_crypto.decrypt_with_ai_private_key(encrypted_key)
-                                if aes_key:
-                                    # 存储用户与AI的会话密钥
-                                    ai_session_keys.store_key(current_user, aes_key)
-                        elif msg_type == "relay_message":
-                            # 处理普通消息
-                            encrypted_message = payload.get('content')
-                            if encrypted_message:
-                                ai.handle_ai_message(current_user, encrypted_message,
-                                                     lambda data: send_to_client(client_socket, data))
-
-                    else:
-                        target_socket = online_users.get_socket(to_user)
-                        if target_socket:
-                            log_msg_type = "会话密钥" if msg_type == "relay_session_key" else "消息"
-                            print(f"[C/S 中继] 正在从中继 '{current_user}' 到 '{to_user}' 的{log_msg_type}。")
-
-                            relay_payload = {"from": current_user, **payload}
-                            del relay_payload['to']
-                            relay_type = "receive_message" if msg_type == "relay_message" else "receive_session_key"
-                            relay_message = {"type": relay_type, "payload": relay_payload}
-                            send_to_client(target_socket, relay_message)
-                        else:
-                            send_func({"type": "response", "status": "error", "message": f"用户 '{to_user}' 不在线。"})
+                    # 发给机器人用户（如AI）的消息由机器人注册表处理
+                    if not bot_registry.dispatch(msg_type, current_user, payload, send_func, owner=client_socket):
+                        # 与对方登录时的离线消息投递互斥，保证离线消息先于之后的在线消息送达
+                        with online_users.delivery_lock(to_user):
+                            target_socket = online_users.get_socket(to_user)
+                            if target_socket:
+                                log_msg_type = "会话密钥" if msg_type == "relay_session_key" else "消息"
+                                print(f"[C/S 中继] 正在从中继 '{current_user}' 到 '{to_user}' 的{log_msg_type}。")
+
+                                relay_payload = {"from": current_user, **payload}
+                                del relay_payload['to']
+                                relay_type = "receive_message" if msg_type == "relay_message" else "receive_session_key"
+                                relay_message = {"type": relay_type, "payload": relay_payload}
+                                send_to_client(target_socket, relay_message)
+                            else:
+                                handler.queue_offline_message(msg_type, payload, current_user, send_func)
+
+                elif msg_type == "ack_offline_messages":
+                    handler.handle_ack_offline_messages(payload, current_user)
 
                 elif msg_type == "logout":
                     if current_user:
@@ -155,7 +145,8 @@ def handle_client_connection(client_socket, address):
                             if friend_socket:
                                 send_to_client(friend_socket, status_message)
 
-                        # 清理用户状态
+                        # 清理用户状态，通知机器人（取消未完成的AI请求等）
+                        bot_registry.connection_closed(current_user, client_socket)
                         online_users.remove_user(current_user)
                         current_user = None
 
@@ -191,6 +182,8 @@ def handle_client_connection(client_socket, address):
     finally:
         if current_user:
             print(f"用户 '{current_user}' 已断开连接。")
+            # 通知机器人该连接已关闭（取消该连接发起、尚未完成的AI请求等）
+            bot_registry.connection_closed(current_user, client_socket)
             # 广播用户离线状态
             status_message = handler.broadcast_status_update(current_user, "offline", send_func)
             for friend in database.get_friends(current_user):
@@ -1,124 +1,119 @@
-import sqlite3
-import hashlib
 import os
 
+from .password_hashing import password_hasher, HasherBusyError
+from .storage import SQLiteStorage, ShardedSQLiteStorage, DuplicateUserError
+from .user_cache import user_cache, public_key_fingerprint
 # 将数据库文件放置在项目根目录下的 'data' 文件夹中，如果不存在则创建
 DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', 'data')
 os.makedirs(DATA_DIR, exist_ok=True)
 DB_FILE = os.path.join(DATA_DIR, 'server.db')
 
+# 分片数量：1 表示使用单个 server.db；大于1时用户与好友关系按用户分布到
+# DATA_DIR/server_shard{i}.db，每个分片独立加写锁。注意修改分片数不会迁移已有数据。
+SHARD_COUNT = 1
+
+
+def create_storage(shard_count=None):
+    """根据分片配置创建SQLite存储后端（分片路由器或单文件）。"""
+    shard_count = SHARD_COUNT if shard_count is None else shard_count
+    if shard_count > 1:
+        return ShardedSQLiteStorage(DATA_DIR, shard_count)
+    return SQLiteStorage(DB_FILE)
+
+
+# 保留给服务器端机器人用户的用户名（小写），普通用户不能注册
+RESERVED_USERNAMES = {'ai'}
+
+# 当前使用的存储后端，默认是 DATA_DIR 下的单个SQLite文件
+_storage = create_storage()
+
+
+def set_storage(storage):
+    """切换存储后端（例如测试与基准测试使用 MemoryStorage），并清空用户缓存。"""
+    global _storage
+    _storage = storage
+    user_cache.clear()
+
+def get_storage():
+    """返回当前使用的存储后端。"""
+    return _storage
+
 
 def update_password(identifier, new_password):
     """更新用户密码"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
     try:
         password_hash = hash_password(new_password)
-
+    except HasherBusyError:
+        return False, "服务器繁忙，请稍后重试"
+    try:
         # 根据标识符类型决定查询条件
         if '@' in identifier:
-            cursor.execute(
-                "UPDATE users SET password_hash = ? WHERE email = ?",
-                (password_hash, identifier)
-            )
+            user = _storage.get_user_by_email(identifier)
         else:
-            cursor.execute(
-                "UPDATE users SET password_hash = ? WHERE username = ?",
-                (password_hash, identifier)
-            )
-
-        conn.commit()
+            user = _storage.get_user(identifier)
 
-        if cursor.rowcount == 0:
+        if not user or not _storage.update_password_hash(user['username'], password_hash):
             return False, "用户不存在"
 
+        user_cache.invalidate(user['username'])
         return True, "密码更新成功"
     except Exception as e:
         return False, f"数据库错误: {str(e)}"
-    finally:
-        conn.close()
-
-def get_db_connection():
-    """建立到数据库的连接。"""
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    return conn
 
 def create_tables():
     """如果表不存在，则创建所需的数据库表。"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # 用户表 (users)
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL,
-            email TEXT UNIQUE NOT NULL,
-            public_key TEXT NOT NULL
-        );
-    ''')
-    
-    # 好友关系表 (friendships)
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS friendships (
-            user_id1 INTEGER NOT NULL,
-            user_id2 INTEGER NOT NULL,
-            PRIMARY KEY (user_id1, user_id2),
-            FOREIGN KEY(user_id1) REFERENCES users(id),
-            FOREIGN KEY(user_id2) REFERENCES users(id)
-        );
-    ''')
-
-
-    cursor.execute("SELECT COUNT(*) FROM users WHERE username = 'ai'")
-    if cursor.fetchone()[0] == 0:
-        # 为AI生成真实的RSA密钥对
-        from cryptography.hazmat.primitives.asymmetric import rsa
-        from cryptography.hazmat.primitives import serialization
-        from cryptography.hazmat.backends import default_backend
-
-        # 生成私钥
-        private_key = rsa.generate_private_key(
-            public_exponent=65537,
-            key_size=2048,
-            backend=default_backend()
-        )
-
-        # 获取公钥
-        public_key = private_key.public_key()
-
-        # 序列化公钥
-        public_key_pem = public_key.public_bytes(
-            encoding=serialization.Encoding.PEM,
-            format=serialization.PublicFormat.SubjectPublicKeyInfo
-        ).decode('utf-8')
-
-        # 保存私钥到文件（用于服务器解密）
-        ai_private_key_path = os.path.join(DATA_DIR, 'ai_private_key.pem')
-        with open(ai_private_key_path, 'wb') as f:
-            f.write(private_key.private_bytes(
-                encoding=serialization.Encoding.PEM,
-                format=serialization.PrivateFormat.PKCS8,
-                encryption_algorithm=serialization.NoEncryption()
-            ))
-
-        # 插入AI用户
-        cursor.execute(
-            "INSERT INTO users (username, password_hash, email, public_key) VALUES (?, ?, ?, ?)",
-            ("ai", hash_password("ai_password"), "ai@system.local", public_key_pem)
-        )
+    _storage.initialize()
+
+    if create_bot_account("ai", "ai@system.local"):
         print("AI用户已创建，并生成了密钥对")
 
-    conn.commit()
-    conn.close()
-    print(f"数据库表已在 {DB_FILE} 创建或已存在。")
+    print(f"数据库表已在 {_storage} 创建或已存在。")
+
+def create_bot_account(username, email):
+    """
+    为服务器端机器人用户（如AI）创建账号与RSA密钥对，私钥由服务器保存用于解密会话密钥。
+    账号已存在时不做任何事并返回False。
+    """
+    RESERVED_USERNAMES.add(username.lower())
+    if _storage.get_user(username) is not None:
+        return False
+
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.backends import default_backend
+
+    # 生成私钥
+    private_key = rsa.generate_private_key(
+        public_exponent=65537,
+        key_size=2048,
+        backend=default_backend()
+    )
+
+    # 序列化公钥
+    public_key_pem = private_key.public_key().public_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo
+    ).decode('utf-8')
+
+    # 保存私钥（用于服务器解密）
+    _storage.save_private_key(username, private_key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption()
+    ))
+
+    # 机器人账号不能登录，密码为随机值
+    _storage.insert_user(username, hash_password(os.urandom(16).hex()), email, public_key_pem)
+    user_cache.invalidate(username)
+    return True
+
+def load_private_key_pem(name):
+    """从存储后端读取服务器持有的私钥PEM（例如 'ai'）。"""
+    return _storage.load_private_key(name)
 
 def hash_password(password):
-    """为存储密码进行哈希处理。"""
-    return hashlib.sha256(password.encode()).hexdigest()
+    """为存储密码进行哈希处理（scrypt，在哈希进程池中执行）。"""
+    return password_hasher.hash(password)
 
 def add_user(username, password, email, public_key):
     """
@@ -128,116 +123,109 @@ def add_user(username, password, email, public_key):
     if not all([username, password, email, public_key]):
         return False, "所有字段均为必填项。"
 
-    # 阻止注册"ai"用户名
-    if username.lower() == 'ai':
+    # 阻止注册"ai"等机器人用户名
+    if username.lower() in RESERVED_USERNAMES:
         return False, "该用户名已被系统保留"
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    password_hash = hash_password(password)
     try:
-        cursor.execute(
-            "INSERT INTO users (username, password_hash, email, public_key) VALUES (?, ?, ?, ?)",
-            (username, password_hash, email, public_key)
-        )
-        conn.commit()
-
-        # 新注册用户自动添加AI为好友
-        ai_id = get_user_id("ai")
-        new_user_id = get_user_id(username)
-        if ai_id and new_user_id:
-            # 添加双向好友关系
-            if new_user_id > ai_id:
-                user_id1, user_id2 = ai_id, new_user_id
-            else:
-                user_id1, user_id2 = new_user_id, ai_id
-            cursor.execute(
-                "INSERT INTO friendships (user_id1, user_id2) VALUES (?, ?)",
-                (user_id1, user_id2)
-            )
-            conn.commit()
-
-        return True, "注册成功"
-    except sqlite3.IntegrityError as e:
-        error_message = str(e).lower()
-        if 'unique constraint failed: users.username' in error_message:
+        password_hash = hash_password(password)
+    except HasherBusyError:
+        return False, "服务器繁忙，请稍后重试"
+    try:
+        new_user_id = _storage.insert_user(username, password_hash, email, public_key)
+    except DuplicateUserError as e:
+        if e.field == 'username':
             return False, "该用户名已被使用。"
-        elif 'unique constraint failed: users.email' in error_message:
-            return False, "该邮箱已被注册。"
+        return False, "该邮箱已被注册。"
+    except Exception:
+        return False, "发生未知数据库错误。"
+    user_cache.invalidate(username)
+
+    # 新注册用户自动添加AI为好友
+    ai_id = get_user_id("ai")
+    if ai_id and new_user_id:
+        # 添加双向好友关系
+        if new_user_id > ai_id:
+            user_id1, user_id2 = ai_id, new_user_id
         else:
-            return False, "发生未知数据库错误。"
-    finally:
-        conn.close()
+            user_id1, user_id2 = new_user_id, ai_id
+        _storage.add_friendship(user_id1, user_id2)
+
+    return True, "注册成功"
 
 def check_credentials(login_identifier, password):
     """
     使用用户名或邮箱验证用户凭据。
     成功则返回用户名，否则返回None。
+    队列已满时抛出 HasherBusyError。
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    password_hash = hash_password(password)
-    cursor.execute(
-        "SELECT username FROM users WHERE (username = ? OR email = ?) AND password_hash = ?",
-        (login_identifier, login_identifier, password_hash)
-    )
-    user = cursor.fetchone()
-    conn.close()
-    return user['username'] if user else None
+    for user in _storage.get_login_candidates(login_identifier):
+        matched, rehash = password_hasher.verify(password, user['password_hash'])
+        if matched:
+            if rehash:
+                # 旧的SHA-256哈希在登录成功时透明升级；升级失败不影响本次登录，下次登录再试
+                try:
+                    _storage.update_password_hash(user['username'], hash_password(password))
+                except Exception as e:
+                    print(f"升级用户 {user['username']} 的密码哈希失败: {e}")
+            return user['username']
+    return None
+
+def get_user_record(username):
+    """
+    根据用户名获取用户记录（id、用户名、邮箱、公钥、指纹），优先读取缓存。
+    用户不存在时返回None。
+    """
+    if not username:
+        return None
+    record = user_cache.get(username)
+    if record is not None:
+        return record
+    if user_cache.is_missing(username):
+        return None
+
+    generation = user_cache.generation()
+    result = _storage.get_user(username)
+    if not result:
+        user_cache.put_missing(username, generation)
+        return None
+    record = {
+        "id": result['id'],
+        "username": result['username'],
+        "email": result['email'],
+        "public_key": result['public_key'],
+        "fingerprint": public_key_fingerprint(result['public_key'])
+    }
+    return user_cache.put(record, generation)
 
 def get_user_public_key(username):
     """根据用户名检索公钥。"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT public_key FROM users WHERE username = ?", (username,))
-    result = cursor.fetchone()
-    conn.close()
-    return result['public_key'] if result else None
+    record = get_user_record(username)
+    return record['public_key'] if record else None
 
 def get_user_id(username):
     """根据用户名获取用户ID。"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT id FROM users WHERE username = ?", (username,))
-    result = cursor.fetchone()
-    conn.close()
-    return result['id'] if result else None
+    record = get_user_record(username)
+    return record['id'] if record else None
 
 def get_user_email(username):
     """根据用户名检索邮箱。"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT email FROM users WHERE username = ?", (username,))
-    result = cursor.fetchone()
-    conn.close()
-    return result['email'] if result else None
+    record = get_user_record(username)
+    return record['email'] if record else None
 
 def add_friend(username1, username2):
     """添加一个好友关系。"""
     user_id1 = get_user_id(username1)
     user_id2 = get_user_id(username2)
-    
+
     if not user_id1 or not user_id2 or user_id1 == user_id2:
         return False
-        
+
     # 确保好友关系以一致的顺序存储，以避免重复
     if user_id1 > user_id2:
         user_id1, user_id2 = user_id2, user_id1
-        
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute(
-            "INSERT INTO friendships (user_id1, user_id2) VALUES (?, ?)",
-            (user_id1, user_id2)
-        )
-        conn.commit()
-        # 检查插入是否成功
-        return conn.total_changes > 0
-    except sqlite3.IntegrityError: # 好友关系已存在
-        return False
-    finally:
-        conn.close()
+
+    return _storage.add_friendship(user_id1, user_id2)
 
 def delete_friend(username1, username2):
     """删除一个好友关系。"""
@@ -250,16 +238,7 @@ def delete_friend(username1, username2):
     if user_id1 > user_id2:
         user_id1, user_id2 = user_id2, user_id1
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        "DELETE FROM friendships WHERE user_id1 = ? AND user_id2 = ?",
-        (user_id1, user_id2)
-    )
-    conn.commit()
-    deleted = conn.total_changes > 0
-    conn.close()
-    return deleted
+    return _storage.delete_friendship(user_id1, user_id2)
 
 
 def get_friends(username):
@@ -268,16 +247,46 @@ def get_friends(username):
     if not user_id:
         return []
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # 好友关系可能存在于任一列中
-    cursor.execute("""
-        SELECT u.username FROM users u JOIN friendships f ON u.id = f.user_id2 WHERE f.user_id1 = ?
-        UNION
-        SELECT u.username FROM users u JOIN friendships f ON u.id = f.user_id1 WHERE f.user_id2 = ?
-    """, (user_id, user_id))
-    
-    friends = [row['username'] for row in cursor.fetchall()]
-    conn.close()
-    return friends 
\ No newline at end of file
+    return _storage.get_friend_usernames(user_id)
+
+
+def get_friends_page(username, cursor=None, limit=100):
+    """
+    按好友ID的稳定顺序分页获取好友。cursor 为上一页返回的游标（好友ID），
+    返回 ([(好友ID, 用户名), ...], 下一页游标或None)。
+    """
+    user_id = get_user_id(username)
+    if not user_id:
+        return [], None
+
+    page = _storage.get_friend_page(user_id, cursor or 0, limit)
+    next_cursor = page[-1][0] if len(page) == limit else None
+    return page, next_cursor
+
+
+def are_friends(username1, username2):
+    """两个用户是否互为好友。"""
+    user_id1 = get_user_id(username1)
+    user_id2 = get_user_id(username2)
+    if not user_id1 or not user_id2 or user_id1 == user_id2:
+        return False
+
+    page = _storage.get_friend_page(user_id1, user_id2 - 1, 1)
+    return bool(page) and page[0][0] == user_id2
+
+
+def enqueue_offline_message(recipient, envelope):
+    """为离线用户存储一条消息信封，返回其序号。"""
+    return _storage.enqueue_offline_message(recipient, envelope)
+
+def fetch_offline_messages(recipient, after_seq=0, limit=None):
+    """按顺序获取用户尚未确认的离线消息 [(序号, 信封), ...]。"""
+    return _storage.fetch_offline_messages(recipient, after_seq, limit)
+
+def ack_offline_messages(recipient, upto_seq):
+    """确认离线消息已送达，之后可被压缩删除。"""
+    _storage.ack_offline_messages(recipient, upto_seq)
+
+def offline_backlog(recipient):
+    """返回用户离线队列的 (消息数, 字节数)，用于限制单个用户的积压。"""
+    return _storage.offline_backlog(recipient)
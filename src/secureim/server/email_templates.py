@@ -0,0 +1,185 @@
+import base64
+import uuid
+from email.header import Header
+
+DEFAULT_LOCALE = 'zh'
+
+# 每封邮件只替换 {code}，其余内容在启动时编译为固定的MIME字节
+_VERIFICATION_HTML = """<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="UTF-8">
+    <style>
+        body { font-family: Arial, sans-serif; line-height: 1.6; color: #333; }
+        .container { max-width: 600px; margin: 0 auto; padding: 20px; }
+        .header { background-color: #0078d4; color: white; padding: 20px; text-align: center; border-radius: 5px 5px 0 0; }
+        .content { background-color: #f9f9f9; padding: 30px; border-radius: 0 0 5px 5px; }
+        .verification-code { background-color: #e7f3ff; border: 2px dashed #0078d4; padding: 15px; text-align: center; margin: 20px 0; font-size: 24px; font-weight: bold; color: #0078d4; }
+        .warning { color: #d73502; font-size: 14px; margin-top: 20px; }
+        .footer { text-align: center; margin-top: 20px; font-size: 12px; color: #666; }
+    </style>
+</head>
+<body>
+    <div class="container">
+        <div class="header">
+            <h1>%(title)s</h1>
+        </div>
+        <div class="content">
+            <h2>%(greeting)s</h2>
+            <p>%(intro)s</p>
+            <div class="verification-code">
+{code}
+            </div>
+            <p>%(validity)s</p>
+            <div class="warning">
+                <p><strong>%(warning)s</strong></p>
+                <ul>
+                    <li>%(tip1)s</li>
+                    <li>%(tip2)s</li>
+                    <li>%(tip3)s</li>
+                </ul>
+            </div>
+        </div>
+        <div class="footer">
+            <p>%(footer)s</p>
+        </div>
+    </div>
+</body>
+</html>
+"""
+
+_VERIFICATION_TEXT = """%(greeting)s
+
+%(intro)s
+{code}
+%(validity_text)s
+
+%(warning)s
+- %(tip1)s
+- %(tip2)s
+- %(tip3)s
+
+%(footer)s
+"""
+
+_VERIFICATION_STRINGS = {
+    'zh': {
+        'subject': 'SecureIM 邮箱验证码',
+        'title': 'SecureIM 邮箱验证',
+        'greeting': '您好！',
+        'intro': '您正在注册 SecureIM 账户，验证码为：',
+        'validity': '验证码有效期为 <strong>5分钟</strong>，请及时使用。',
+        'validity_text': '验证码有效期为5分钟，请及时使用。',
+        'warning': '安全提醒：',
+        'tip1': '请勿将验证码告诉他人',
+        'tip2': '如果您没有请求此验证码，请忽略此邮件',
+        'tip3': '此邮件由系统自动发送，请勿回复',
+        'footer': '© 2025 SecureIM. 保护您的通信安全。'
+    },
+    'en': {
+        'subject': 'Your SecureIM verification code',
+        'title': 'SecureIM Email Verification',
+        'greeting': 'Hello!',
+        'intro': 'You are signing up for a SecureIM account. Your verification code is:',
+        'validity': 'The code is valid for <strong>5 minutes</strong>.',
+        'validity_text': 'The code is valid for 5 minutes.',
+        'warning': 'Security notice:',
+        'tip1': 'Never share this code with anyone',
+        'tip2': 'If you did not request this code, please ignore this email',
+        'tip3': 'This email was sent automatically, please do not reply',
+        'footer': '© 2025 SecureIM. Keeping your conversations secure.'
+    }
+}
+
+# 模板名 -> 语言 -> (主题, 纯文本正文, HTML正文)
+TEMPLATES = {
+    'verification': {
+        locale: (strings['subject'], _VERIFICATION_TEXT % strings, _VERIFICATION_HTML % strings)
+        for locale, strings in _VERIFICATION_STRINGS.items()
+    }
+}
+
+_PLACEHOLDER = '{code}'
+_LINE = 57  # base64 每行76个字符对应57字节；按整行对齐后各段可以分别编码再拼接
+
+
+def _b64_lines(data):
+    return base64.encodebytes(data).replace(b'\n', b'\r\n')
+
+
+class _CompiledPart:
+    """
+    一个 text/* 正文部分。占位符前的内容补齐到整行（空格插在最后一个换行之前，不影响显示），
+    占位符独占一行base64（值补空格到57字节），因此前后两段在编译时编码一次，每封邮件只编码57字节。
+    """
+
+    def __init__(self, subtype, body):
+        head, tail = body.encode('utf-8').split(_PLACEHOLDER.encode('ascii'), 1)
+        padding = b' ' * (-len(head) % _LINE)
+        newline = head.rfind(b'\n')
+        head = head[:newline] + padding + head[newline:] if newline >= 0 else head + padding
+        self.head = (f'Content-Type: text/{subtype}; charset="utf-8"\r\n'
+                     'Content-Transfer-Encoding: base64\r\n\r\n').encode('ascii') + _b64_lines(head)
+        self.tail = _b64_lines(tail)
+
+    def render(self, value):
+        return self.head + _b64_lines(value.ljust(_LINE)) + self.tail
+
+
+class CompiledTemplate:
+    """编译好的 multipart/alternative 邮件：静态头部与正文各部分都已是最终字节。"""
+
+    def __init__(self, subject, text, html):
+        boundary = f'=_secureim_{uuid.uuid4().hex}'
+        self.headers = ('MIME-Version: 1.0\r\n'
+                        f'Subject: {Header(subject, "utf-8").encode()}\r\n'
+                        f'Content-Type: multipart/alternative; boundary="{boundary}"\r\n').encode('ascii')
+        self.parts = [_CompiledPart('plain', text), _CompiledPart('html', html)]
+        self.separator = f'--{boundary}\r\n'.encode('ascii')
+        self.closing = f'--{boundary}--\r\n'.encode('ascii')
+
+    def render(self, sender, recipient, code):
+        """返回完整的邮件字节。"""
+        if any(c in recipient or c in sender for c in '\r\n'):
+            raise ValueError("邮件地址中不能包含换行")
+        value = code.encode('ascii')
+        if len(value) > _LINE:
+            raise ValueError("替换值过长")
+        chunks = [self.headers, _address_header('From', sender), _address_header('To', recipient), b'\r\n']
+        for part in self.parts:
+            chunks.append(self.separator)
+            chunks.append(part.render(value))
+        chunks.append(self.closing)
+        return b''.join(chunks)
+
+
+def _address_header(name, address):
+    if not address.isascii():
+        address = Header(address, 'utf-8').encode()
+    return f'{name}: {address}\r\n'.encode('ascii')
+
+
+class EmailTemplates:
+    """邮件模板缓存：所有模板与语言版本在创建时编译一次，之后只读。"""
+
+    def __init__(self, templates=TEMPLATES):
+        self._compiled = {}
+        for name, variants in templates.items():
+            for locale, (subject, text, html) in variants.items():
+                self._compiled[(name, locale)] = CompiledTemplate(subject, text, html)
+
+    def get(self, name, locale=None):
+        """返回指定语言的模板，没有该语言（或 locale 不是字符串）时回退到默认语言。"""
+        if not isinstance(locale, str):
+            locale = DEFAULT_LOCALE
+        return self._compiled.get((name, locale)) or self._compiled[(name, DEFAULT_LOCALE)]
+
+    def render(self, name, sender, recipient, code, locale=None):
+        return self.get(name, locale).render(sender, recipient, code)
+
+    def locales(self, name):
+        return sorted(locale for template, locale in self._compiled if template == name)
+
+
+# 全局单例（服务器启动导入时编译）
+email_templates = EmailTemplates()
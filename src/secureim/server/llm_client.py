@@ -0,0 +1,396 @@
+import asyncio
+import functools
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .scheduler import scheduler
+
+# 连接/读取超时（秒），以及每个后端主机的最大连接数
+CONNECT_TIMEOUT = 3.05
+READ_TIMEOUT = 120
+MAX_CONNECTIONS_PER_HOST = 8
+
+# 熔断：连续失败 BREAKER_FAILURE_THRESHOLD 次后打开熔断器，停止向该后端派发请求，
+# 之后每隔 PROBE_INTERVAL 秒在后台探测一次，探测成功后恢复
+BREAKER_FAILURE_THRESHOLD = 3
+PROBE_INTERVAL = 5
+PROBE_TIMEOUT = 3
+
+
+class BackendStats:
+    """单个后端的请求计数、错误计数与延迟统计。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.total_latency = 0.0
+        self.last_latency = None
+        self.ewma_latency = None  # 指数滑动平均延迟（秒）
+        self.ewma_first_token = None  # 流式请求首字延迟的指数滑动平均（秒）
+        self.ewma_error_rate = 0.0  # 失败率的指数滑动平均
+
+    def record(self, latency, error=None):
+        with self._lock:
+            self.requests += 1
+            self.ewma_error_rate = 0.8 * self.ewma_error_rate + (0.2 if error is not None else 0.0)
+            if error is not None:
+                self.errors += 1
+                if isinstance(error, requests.Timeout):
+                    self.timeouts += 1
+                return
+            self.total_latency += latency
+            self.last_latency = latency
+            if self.ewma_latency is None:
+                self.ewma_latency = latency
+            else:
+                self.ewma_latency = 0.8 * self.ewma_latency + 0.2 * latency
+
+    def record_first_token(self, latency):
+        with self._lock:
+            if self.ewma_first_token is None:
+                self.ewma_first_token = latency
+            else:
+                self.ewma_first_token = 0.8 * self.ewma_first_token + 0.2 * latency
+
+    def snapshot(self):
+        with self._lock:
+            succeeded = self.requests - self.errors
+            return {
+                "requests": self.requests,
+                "errors": self.errors,
+                "timeouts": self.timeouts,
+                "avg_latency": self.total_latency / succeeded if succeeded else None,
+                "ewma_latency": self.ewma_latency,
+                "last_latency": self.last_latency,
+                "ewma_first_token": self.ewma_first_token,
+                "ewma_error_rate": self.ewma_error_rate
+            }
+
+
+class LLMClient:
+    """
+    OpenAI兼容 chat/completions 接口的共享HTTP客户端。
+    复用带连接池的 requests.Session（keep-alive），每个主机的连接数有上限，
+    所有请求都带连接/读取超时。achat_completion 可在 asyncio 服务器中使用。
+    """
+
+    def __init__(self, url, api_key, model, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+                 max_connections=MAX_CONNECTIONS_PER_HOST):
+        self.url = url
+        self.model = model
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_connections = max_connections
+        self.session = requests.Session()
+        self.session.headers.update({
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json"
+        })
+        # pool_block=True：连接用尽时等待空闲连接，而不是另开连接
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_connections, pool_block=True, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.stats = BackendStats()
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def chat_completion(self, messages, cancelled=None, **params):
+        """发送非流式请求并返回解析后的JSON响应。失败时抛出 requests 异常并计入错误统计。"""
+        data = {"model": self.model, "messages": messages, "stream": False, **params}
+        start = time.perf_counter()
+        try:
+            response = self.session.post(self.url, json=data, timeout=self.timeout)
+            response.raise_for_status()
+            result = response.json()
+        except Exception as e:
+            if not (cancelled and cancelled()):
+                self.stats.record(time.perf_counter() - start, error=e)
+            raise
+        self.stats.record(time.perf_counter() - start)
+        return result
+
+    def stream_chat_completion(self, messages, on_response=None, cancelled=None, **params):
+        """
+        发送流式请求（SSE，stream=True），逐个产出模型生成的文本增量。
+        首个增量到达时记录首字延迟，整个流结束后计入延迟统计。
+        on_response(response) 在收到响应头后调用，可保存响应以便从其他线程 abort_response；
+        cancelled() 为真时说明失败是调用方中止造成的，不计入错误统计。
+        """
+        data = {"model": self.model, "messages": messages, "stream": True, **params}
+        start = time.perf_counter()
+        first_token = True
+        try:
+            with self.session.post(self.url, json=data, timeout=self.timeout, stream=True) as response:
+                if on_response is not None:
+                    on_response(response)
+                response.raise_for_status()
+                for line in response.iter_lines():
+                    # SSE 事件行形如 "data: {...}"，以 "data: [DONE]" 结束；空行与注释行跳过
+                    if not line.startswith(b"data:"):
+                        continue
+                    event = line[5:].strip()
+                    if event == b"[DONE]":
+                        break
+                    choices = json.loads(event).get("choices") or [{}]
+                    delta = (choices[0].get("delta") or {}).get("content")
+                    if delta:
+                        if first_token:
+                            self.stats.record_first_token(time.perf_counter() - start)
+                            first_token = False
+                        yield delta
+        except Exception as e:
+            if not (cancelled and cancelled()):
+                self.stats.record(time.perf_counter() - start, error=e)
+            raise
+        self.stats.record(time.perf_counter() - start)
+
+    def probe(self):
+        """探测后端是否可达：请求同一服务的 /models，5xx 与认证失败(401/403)视为不可用。"""
+        url = self.url.rsplit('/chat/completions', 1)[0] + '/models'
+        response = self.session.get(url, timeout=(self.timeout[0], PROBE_TIMEOUT))
+        response.close()
+        return response.status_code < 500 and response.status_code not in (401, 403)
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_connections,
+                                                    thread_name_prefix="llm-client")
+            return self._executor
+
+    async def achat_completion(self, messages, **params):
+        """chat_completion 的异步版本，在有界的线程池中执行阻塞的HTTP调用。"""
+        loop = asyncio.get_running_loop()
+        call = functools.partial(self.chat_completion, messages, **params)
+        return await loop.run_in_executor(self._get_executor(), call)
+
+    def close(self):
+        self.session.close()
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+
+def abort_response(response):
+    """从其他线程中止正在读取的流式响应，使阻塞的读取立即返回。"""
+    raw = response.raw
+    if hasattr(raw, "shutdown"):  # urllib3 >= 2.3
+        raw.shutdown()
+    response.close()
+
+
+def is_retryable(error):
+    """连接失败、超时、限流(429)与服务端错误(5xx)可以稍后重试。"""
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code == 429 or error.response.status_code >= 500
+    return False
+
+
+def is_request_error(error):
+    """请求本身有误（400/422），换后端也不会成功，不应切换后端或计入熔断。"""
+    return (isinstance(error, requests.HTTPError) and error.response is not None
+            and error.response.status_code in (400, 422))
+
+
+class NoHealthyBackendError(requests.ConnectionError):
+    """所有后端的熔断器都处于打开状态。"""
+
+
+class CircuitBreaker:
+    """单个后端的熔断器：closed 正常派发，open 暂停派发并等待后台探测恢复。"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD):
+        self.failure_threshold = failure_threshold
+        self.state = self.CLOSED
+        self.failures = 0  # 连续失败次数
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        return self.state == self.CLOSED
+
+    def record_success(self):
+        """记录一次成功，返回熔断器是否因此从打开变为关闭。"""
+        with self._lock:
+            reopened = self.state != self.CLOSED
+            self.failures = 0
+            self.state = self.CLOSED
+            self.opened_at = None
+            return reopened
+
+    def record_failure(self):
+        """记录一次失败，返回熔断器是否因此刚刚打开。"""
+        with self._lock:
+            self.failures += 1
+            if self.state == self.CLOSED and self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+
+class LLMRouter:
+    """
+    在多个OpenAI兼容后端之间路由请求，接口与 LLMClient 相同。
+    按滑动平均延迟（流式请求用首字延迟）与失败率给每个健康后端打分，优先选择得分最低的；
+    后端连续失败时打开熔断器，由调度器定期在后台探测，探测成功后重新启用。
+    尚未输出内容前的失败会立即切换到下一个后端（包括密钥、地址或模型配置错误导致的401/403/404）；
+    只有请求本身有误（400/422）时直接抛出。
+    """
+
+    def __init__(self, backends):
+        self.backends = [get_client(b["url"], b["api_key"], b["model"]) for b in backends]
+        self.model = self.backends[0].model
+        self._breakers = {id(client): CircuitBreaker() for client in self.backends}
+        self._probes = {}  # id(client) -> TimerHandle
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _latency(client, streaming):
+        stats = client.stats
+        latency = stats.ewma_first_token if streaming else None
+        return stats.ewma_latency if latency is None else latency
+
+    def _score(self, client, streaming, prior):
+        stats = client.stats
+        if stats.requests == 0:
+            return 0.0  # 从未请求过的后端优先尝试一次
+        latency = self._latency(client, streaming)
+        if latency is None:
+            latency = prior  # 请求过但从未成功：按其他后端的典型延迟计，由失败率决定排位
+        return latency * (1.0 + 4.0 * stats.ewma_error_rate)
+
+    def candidates(self, streaming=False):
+        """按得分排序的健康后端列表。"""
+        healthy = [c for c in self.backends if self._breakers[id(c)].allow()]
+        latencies = sorted(l for l in (self._latency(c, streaming) for c in self.backends) if l is not None)
+        prior = latencies[len(latencies) // 2] if latencies else 1.0
+        return sorted(healthy, key=lambda c: self._score(c, streaming, prior))
+
+    def _record(self, client, error=None):
+        breaker = self._breakers[id(client)]
+        if error is None:
+            if breaker.record_success():
+                self._stop_probe(client)
+        elif not is_request_error(error) and breaker.record_failure():
+            print(f"大模型后端 {client.url} 连续失败，已熔断，开始后台探测")
+            with self._lock:
+                old = self._probes.pop(id(client), None)
+                self._probes[id(client)] = scheduler.call_every(PROBE_INTERVAL, self._submit_probe, client)
+            if old is not None:
+                old.cancel()
+
+    def _stop_probe(self, client):
+        # 熔断器已关闭（探测成功或进行中的请求成功），停止后台探测
+        with self._lock:
+            handle = self._probes.pop(id(client), None)
+        if handle is not None:
+            handle.cancel()
+
+    def _submit_probe(self, client):
+        # 调度线程中不做网络请求，探测交给该后端的线程池执行
+        client._get_executor().submit(self._probe, client)
+
+    def _probe(self, client):
+        try:
+            healthy = client.probe()
+        except Exception:
+            healthy = False
+        if healthy and self._breakers[id(client)].record_success():
+            print(f"大模型后端 {client.url} 探测成功，恢复使用")
+            self._stop_probe(client)
+
+    def chat_completion(self, messages, cancelled=None, **params):
+        error = NoHealthyBackendError("没有可用的大模型后端")
+        for client in self.candidates():
+            try:
+                result = client.chat_completion(messages, cancelled=cancelled, **params)
+            except Exception as e:
+                if cancelled and cancelled():
+                    raise  # 调用方中止，不计入熔断
+                self._record(client, e)
+                if is_request_error(e):
+                    raise
+                error = e
+                continue
+            self._record(client)
+            return result
+        raise error
+
+    def stream_chat_completion(self, messages, on_response=None, cancelled=None, **params):
+        error = NoHealthyBackendError("没有可用的大模型后端")
+        for client in self.candidates(streaming=True):
+            started = False
+            try:
+                for delta in client.stream_chat_completion(messages, on_response=on_response,
+                                                           cancelled=cancelled, **params):
+                    started = True
+                    yield delta
+            except Exception as e:
+                if cancelled and cancelled():
+                    raise  # 调用方中止（abort_response），不计入熔断
+                self._record(client, e)
+                # 已输出部分内容后不能换后端重来，否则回复会重复
+                if started or is_request_error(e):
+                    raise
+                error = e
+                continue
+            self._record(client)
+            return
+        raise error
+
+    def stats(self):
+        return {
+            f"{client.url} ({client.model})": {
+                **client.stats.snapshot(),
+                "breaker": self._breakers[id(client)].state
+            } for client in self.backends
+        }
+
+
+_clients = {}  # (url, api_key, model) -> LLMClient
+_clients_lock = threading.Lock()
+
+
+def get_client(url, api_key, model):
+    """返回指定后端的共享客户端（按 url/密钥/模型复用）。"""
+    key = (url, api_key, model)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = _clients[key] = LLMClient(url, api_key, model)
+        return client
+
+
+_routers = {}  # 后端配置 -> LLMRouter
+
+
+def get_router(backends):
+    """返回指定后端列表的共享路由器，backends 为 [{"url", "api_key", "model"}, ...]。"""
+    key = tuple((b["url"], b["api_key"], b["model"]) for b in backends)
+    with _clients_lock:
+        router = _routers.get(key)
+    if router is None:
+        router = LLMRouter(backends)
+        with _clients_lock:
+            router = _routers.setdefault(key, router)
+    return router
+
+
+def all_stats():
+    """按后端URL汇总的延迟与错误统计。"""
+    with _clients_lock:
+        clients = list(_clients.values())
+    return {f"{client.url} ({client.model})": client.stats.snapshot() for client in clients}
@@ -0,0 +1,231 @@
+import itertools
+import queue
+import smtplib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from .scheduler import scheduler
+
+# 发信工作线程数（即同时保持的SMTP会话数）与队列上限
+MAIL_WORKERS = 2
+MAIL_MAX_QUEUE = 1000
+MAIL_BATCH = 20           # 一个会话连续发送的最多邮件数，之后检查是否需要让出
+MAIL_IDLE_TIMEOUT = 60    # SMTP会话空闲超过该秒数后主动断开
+MAIL_MAX_RETRIES = 3
+MAIL_RETRY_BACKOFF = 2.0  # 首次重试延迟（秒），之后每次翻倍
+MAIL_TIMEOUT = 10         # 连接与单次SMTP命令的超时（秒）
+MAIL_TRACKED_JOBS = 1000  # 保留最近多少封邮件的投递状态
+
+
+class MailJob:
+    """一封待投递的邮件。on_result(是否成功, 错误信息) 在投递成功或最终失败时调用。"""
+
+    __slots__ = ('id', 'recipient', 'message', 'attempts', 'on_result')
+
+    def __init__(self, job_id, recipient, message, on_result):
+        self.id = job_id
+        self.recipient = recipient
+        self.message = message
+        self.attempts = 0
+        self.on_result = on_result
+
+
+def describe_error(error):
+    """把SMTP异常转换为可以展示给用户的错误信息。"""
+    if isinstance(error, smtplib.SMTPAuthenticationError):
+        return "邮箱认证失败，请检查发送方邮箱配置"
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return "收件人邮箱地址无效"
+    if isinstance(error, smtplib.SMTPException):
+        return f"SMTP服务异常: {str(error)}"
+    return f"发送邮件时发生未知错误: {str(error)}"
+
+
+def is_transient(error):
+    """连接问题与4xx临时错误可以重试，认证失败、收件人被拒等5xx错误不重试。"""
+    if isinstance(error, smtplib.SMTPAuthenticationError):
+        return False
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    if isinstance(error, smtplib.SMTPServerDisconnected):
+        return True
+    # SMTPException 是 OSError 的子类，其余协议错误（如服务器不支持STARTTLS）重试也不会成功
+    if isinstance(error, smtplib.SMTPException):
+        return False
+    return isinstance(error, OSError)
+
+
+class MailOutbox:
+    """
+    异步发信队列。请求线程只负责入队并立即返回；
+    工作线程各自保持一个持久的SMTP会话（STARTTLS与登录只做一次），在同一会话上连续发送多封邮件，
+    会话空闲超时后断开。临时失败由调度器按指数退避重新入队，投递结果通过回调通知。
+    """
+
+    def __init__(self, config, workers=MAIL_WORKERS, max_queue=MAIL_MAX_QUEUE, idle_timeout=MAIL_IDLE_TIMEOUT,
+                 max_retries=MAIL_MAX_RETRIES, retry_backoff=MAIL_RETRY_BACKOFF):
+        self.config = config
+        self.workers = workers
+        self.idle_timeout = idle_timeout
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self._queue = queue.Queue(max_queue)
+        self._ids = itertools.count(1)
+        self._jobs = OrderedDict()  # 最近邮件的投递状态: id -> 'queued' / 'retrying' / 'sent' / 'failed'
+        self._lock = threading.Lock()
+        self._threads = []
+        self._notifier = None  # 调度线程中产生的失败通知交给它执行
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.sessions_opened = 0
+
+    def _ensure_started(self):
+        with self._lock:
+            if not self._threads:
+                for i in range(self.workers):
+                    thread = threading.Thread(target=self._worker_loop, name=f"mail-{i}", daemon=True)
+                    thread.start()
+                    self._threads.append(thread)
+
+    def _set_status(self, job, status):
+        with self._lock:
+            self._jobs[job.id] = status
+            self._jobs.move_to_end(job.id)
+            while len(self._jobs) > MAIL_TRACKED_JOBS:
+                self._jobs.popitem(last=False)
+
+    def submit(self, recipient, message, on_result=None):
+        """邮件入队并返回邮件ID；队列已满时返回None。message 为完整的邮件内容（bytes 或 str）。"""
+        job = MailJob(next(self._ids), recipient, message, on_result)
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            return None
+        self._set_status(job, 'queued')
+        self._ensure_started()
+        return job.id
+
+    def status(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _connect(self):
+        session = smtplib.SMTP(self.config['smtp_server'], self.config['smtp_port'], timeout=MAIL_TIMEOUT)
+        if self.config.get('use_tls', True):
+            session.starttls()  # 启用TLS加密
+        if self.config.get('sender_password'):
+            session.login(self.config['sender_email'], self.config['sender_password'])
+        with self._lock:
+            self.sessions_opened += 1
+        return session
+
+    @staticmethod
+    def _close(session):
+        if session is None:
+            return
+        try:
+            session.quit()
+        except Exception:
+            session.close()
+
+    def _worker_loop(self):
+        session = None
+        while True:
+            try:
+                # 持有会话时最多等待 idle_timeout，超时则断开会话
+                job = self._queue.get(timeout=self.idle_timeout if session else None)
+            except queue.Empty:
+                self._close(session)
+                session = None
+                continue
+            session = self._deliver(session, job)
+            for _ in range(MAIL_BATCH - 1):
+                try:
+                    job = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                session = self._deliver(session, job)
+
+    def _deliver(self, session, job):
+        """在会话上发送一封邮件，返回之后可继续使用的会话（可能为None）。"""
+        job.attempts += 1
+        error = None
+        for _ in range(2):
+            try:
+                if session is None:
+                    session = self._connect()
+                session.sendmail(self.config['sender_email'], [job.recipient], job.message)
+                error = None
+                break
+            except smtplib.SMTPServerDisconnected as e:
+                # 持久会话可能已被服务器关闭，重新连接后再试一次
+                self._close(session)
+                session, error = None, e
+            except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError) as e:
+                # 会话本身仍然可用
+                error = e
+                break
+            except Exception as e:
+                self._close(session)
+                session, error = None, e
+                break
+
+        if error is None:
+            with self._lock:
+                self.sent += 1
+            self._set_status(job, 'sent')
+            print(f"✅ 邮件已成功发送到: {job.recipient}")
+            self._notify(job, True, None)
+        elif job.attempts <= self.max_retries and is_transient(error):
+            delay = self.retry_backoff * (2 ** (job.attempts - 1))
+            with self._lock:
+                self.retried += 1
+            self._set_status(job, 'retrying')
+            print(f"发送邮件到 {job.recipient} 失败，{delay:.1f}s 后重试: {error}")
+            scheduler.call_later(delay, self._requeue, job)
+        else:
+            self._fail(job, describe_error(error))
+        return session
+
+    def _get_notifier(self):
+        with self._lock:
+            if self._notifier is None:
+                self._notifier = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mail-notify")
+            return self._notifier
+
+    def _requeue(self, job):
+        # 在调度线程中执行，不能阻塞：失败回调通常是向客户端发送响应（阻塞的 sendall），交给通知线程执行
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            self._get_notifier().submit(self._fail, job, "发信队列已满")
+
+    def _fail(self, job, error_msg):
+        with self._lock:
+            self.failed += 1
+        self._set_status(job, 'failed')
+        print(f"❌ 邮件发送到 {job.recipient} 失败: {error_msg}")
+        self._notify(job, False, error_msg)
+
+    @staticmethod
+    def _notify(job, success, error_msg):
+        if job.on_result is None:
+            return
+        try:
+            job.on_result(success, error_msg)
+        except Exception as e:
+            print(f"邮件投递回调出错: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queued": self._queue.qsize(),
+                "sent": self.sent,
+                "failed": self.failed,
+                "retried": self.retried,
+                "sessions_opened": self.sessions_opened
+            }
@@ -4,6 +4,7 @@ import threading
 
 from src.secureim.server.database import DATA_DIR
 from . import database
+from .bots import bot_registry
 from .connection_handler import handle_client_connection
 
 HOST = '0.0.0.0'
@@ -19,6 +20,7 @@ def start_server():
 
     # 2. 初始化数据库
     database.create_tables()
+    bot_registry.initialize()
     
     # 3. 创建并绑定服务器套接字
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
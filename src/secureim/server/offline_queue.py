@@ -0,0 +1,292 @@
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+# 记录格式: [长度 uint32][序号 uint64][crc32 uint32][载荷]，载荷为JSON编码的不透明信封
+RECORD_HEADER = struct.Struct('>IQI')
+SEGMENT_SUFFIX = '.log'
+ACK_FILE = 'ack'
+
+
+class _RecipientLog:
+    """单个收件人的分段日志状态，所有访问都在其 lock 保护下进行。"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.segments = []  # 按顺序排列的 (首个序号, 路径)
+        self.next_seq = 1
+        self.acked_seq = 0
+        self.active_file = None  # 当前追加段的文件对象
+        self.active_size = 0
+        self.dirty = False  # 是否有尚未fsync的写入
+        self.read_hint = None  # 上次 fetch 读到的位置: (最后返回的序号, 分段路径, 其后的字节偏移)
+
+
+class OfflineMessageQueue:
+    """
+    存储转发的离线消息队列。
+    每个收件人一个目录，目录下是按首个序号命名的追加式分段日志文件；
+    写入只追加到操作系统缓冲区，由后台刷盘线程批量 fsync，避免每条消息一次事务。
+    确认(ack)后，已被完全确认的分段会被整体删除（压缩）。
+    """
+
+    def __init__(self, base_dir, segment_max_bytes=4 * 1024 * 1024, fsync_interval=0.05, max_open_files=1024):
+        self.base_dir = base_dir
+        self.segment_max_bytes = segment_max_bytes
+        self.fsync_interval = fsync_interval
+        self.max_open_files = max_open_files
+        self._logs = {}  # recipient -> _RecipientLog
+        self._open_logs = OrderedDict()  # 持有打开文件句柄的收件人（LRU）
+        self._lock = threading.Lock()
+        self._flush_cond = threading.Condition()
+        self._flush_generation = 0  # 已完成的刷盘轮次
+        self._flusher = None
+        os.makedirs(base_dir, exist_ok=True)
+
+    # --- 内部工具 ---
+    def _recipient_dir(self, recipient):
+        # 使用十六进制编码用户名，避免文件名中的特殊字符
+        return os.path.join(self.base_dir, recipient.encode('utf-8').hex())
+
+    def _get_log(self, recipient):
+        with self._lock:
+            log = self._logs.get(recipient)
+            if log is None:
+                log = _RecipientLog(self._recipient_dir(recipient))
+                self._load(log)
+                self._logs[recipient] = log
+            return log
+
+    def _load(self, log):
+        """扫描磁盘恢复状态，并截断崩溃时写了一半的尾部记录。"""
+        if not os.path.isdir(log.directory):
+            return
+        try:
+            with open(os.path.join(log.directory, ACK_FILE), 'r') as f:
+                log.acked_seq = int(f.read().strip() or 0)
+        except (FileNotFoundError, ValueError):
+            log.acked_seq = 0
+        names = sorted(n for n in os.listdir(log.directory) if n.endswith(SEGMENT_SUFFIX))
+        log.segments = [(int(n[:-len(SEGMENT_SUFFIX)]), os.path.join(log.directory, n)) for n in names]
+        log.next_seq = log.acked_seq + 1
+        if log.segments:
+            last_seq, valid_size = None, 0
+            for seq, _, end in self._scan(log.segments[-1][1]):
+                last_seq, valid_size = seq, end
+            path = log.segments[-1][1]
+            if os.path.getsize(path) != valid_size:
+                with open(path, 'r+b') as f:
+                    f.truncate(valid_size)
+            if last_seq is not None:
+                log.next_seq = max(log.next_seq, last_seq + 1)
+            else:
+                log.next_seq = max(log.next_seq, log.segments[-1][0])
+
+    @staticmethod
+    def _scan(path, offset=0):
+        """从 offset 开始逐条读取分段文件，产出 (序号, 载荷字节, 记录结束偏移)，遇到损坏记录即停止。"""
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+                length, seq, crc = RECORD_HEADER.unpack(header)
+                body = f.read(length)
+                if len(body) < length or zlib.crc32(body) != crc:
+                    break
+                offset += RECORD_HEADER.size + length
+                yield seq, body, offset
+
+    def _open_active(self, log):
+        """确保存在可追加的当前分段（写满时滚动到新分段）。调用方持有 log.lock。"""
+        if log.active_file is not None and log.active_size < self.segment_max_bytes:
+            return
+        if log.active_file is not None:
+            self._close_active(log)
+        if log.segments and os.path.getsize(log.segments[-1][1]) < self.segment_max_bytes:
+            path = log.segments[-1][1]
+        else:
+            os.makedirs(log.directory, exist_ok=True)
+            path = os.path.join(log.directory, f'{log.next_seq:020d}{SEGMENT_SUFFIX}')
+            log.segments.append((log.next_seq, path))
+        log.active_file = open(path, 'ab')
+        log.active_size = log.active_file.tell()
+        self._track_open(log)
+
+    def _close_active(self, log):
+        if log.active_file is None:
+            return
+        log.active_file.flush()
+        if log.dirty:
+            os.fsync(log.active_file.fileno())
+            log.dirty = False
+        log.active_file.close()
+        log.active_file = None
+        with self._lock:
+            self._open_logs.pop(id(log), None)
+
+    def _track_open(self, log):
+        """记录打开的文件句柄，超过上限时关闭最久未使用的收件人句柄。"""
+        evict = []
+        with self._lock:
+            self._open_logs[id(log)] = log
+            self._open_logs.move_to_end(id(log))
+            while len(self._open_logs) > self.max_open_files:
+                _, old = self._open_logs.popitem(last=False)
+                evict.append(old)
+        for old in evict:
+            # 不能阻塞在其他收件人的锁上，拿不到锁则放回，等下一次淘汰
+            if old.lock.acquire(blocking=False):
+                try:
+                    self._close_active(old)
+                finally:
+                    old.lock.release()
+            else:
+                with self._lock:
+                    self._open_logs[id(old)] = old
+
+    def _ensure_flusher(self):
+        with self._lock:
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+                self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.fsync_interval)
+            self.flush()
+
+    # --- 公共接口 ---
+    def enqueue(self, recipient, envelope, wait_durable=False):
+        """追加一条离线消息并返回其序号。wait_durable 为真时等待下一次批量fsync完成。"""
+        body = json.dumps(envelope, ensure_ascii=False).encode('utf-8')
+        log = self._get_log(recipient)
+        with log.lock:
+            self._open_active(log)
+            seq = log.next_seq
+            log.active_file.write(RECORD_HEADER.pack(len(body), seq, zlib.crc32(body)) + body)
+            log.active_size += RECORD_HEADER.size + len(body)
+            log.next_seq += 1
+            log.dirty = True
+        self._ensure_flusher()
+        if wait_durable:
+            with self._flush_cond:
+                target = self._flush_generation + 2  # 确保等待的是写入之后开始的一轮
+                while self._flush_generation < target:
+                    self._flush_cond.wait()
+        return seq
+
+    def flush(self):
+        """将所有有未刷盘写入的分段 fsync 到磁盘。"""
+        with self._lock:
+            logs = list(self._open_logs.values())
+        for log in logs:
+            with log.lock:
+                if log.active_file is not None and log.dirty:
+                    log.active_file.flush()
+                    os.fsync(log.active_file.fileno())
+                    log.dirty = False
+        with self._flush_cond:
+            self._flush_generation += 1
+            self._flush_cond.notify_all()
+
+    def fetch(self, recipient, after_seq=0, limit=None):
+        """按顺序返回 [(序号, 信封), ...]，只包含序号大于 after_seq 且未确认的消息。"""
+        log = self._get_log(recipient)
+        after_seq = max(after_seq, log.acked_seq)
+        results = []
+        with log.lock:
+            if log.active_file is not None:
+                log.active_file.flush()
+            segments = list(log.segments)
+            hint = log.read_hint
+        position = None  # (分段路径, 最后一条返回记录之后的偏移)
+        for index, (first_seq, path) in enumerate(segments):
+            # 下一个分段的首序号不大于 after_seq+1 时，本段已全部读过
+            if index + 1 < len(segments) and segments[index + 1][0] <= after_seq + 1:
+                continue
+            # 分批投递时从上一批结束的位置继续读，不必从分段开头重新扫描
+            offset = hint[2] if not results and hint and hint[1] == path and hint[0] <= after_seq else 0
+            try:
+                for seq, body, end in self._scan(path, offset):
+                    if seq <= after_seq:
+                        continue
+                    results.append((seq, json.loads(body.decode('utf-8'))))
+                    position = (path, end)
+                    if limit is not None and len(results) >= limit:
+                        break
+            except FileNotFoundError:  # 并发压缩已删除该分段
+                continue
+            if limit is not None and len(results) >= limit:
+                break
+        if position is not None:
+            with log.lock:
+                log.read_hint = (results[-1][0], position[0], position[1])
+        return results
+
+    def ack(self, recipient, upto_seq):
+        """确认序号不大于 upto_seq 的消息，并删除已被完全确认的分段。"""
+        log = self._get_log(recipient)
+        with log.lock:
+            upto_seq = min(upto_seq, log.next_seq - 1)
+            if upto_seq <= log.acked_seq:
+                return
+            log.acked_seq = upto_seq
+            os.makedirs(log.directory, exist_ok=True)
+            tmp_path = os.path.join(log.directory, ACK_FILE + '.tmp')
+            with open(tmp_path, 'w') as f:
+                f.write(str(upto_seq))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, os.path.join(log.directory, ACK_FILE))
+            self._compact(log)
+
+    def _compact(self, log):
+        """删除所有消息均已确认的分段。调用方持有 log.lock。"""
+        keep = []
+        for index, (first_seq, path) in enumerate(log.segments):
+            next_first = log.segments[index + 1][0] if index + 1 < len(log.segments) else log.next_seq
+            if next_first - 1 <= log.acked_seq:
+                if log.active_file is not None and log.active_file.name == path:
+                    self._close_active(log)
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            else:
+                keep.append((first_seq, path))
+        log.segments = keep
+
+    def pending_count(self, recipient):
+        log = self._get_log(recipient)
+        with log.lock:
+            return log.next_seq - 1 - log.acked_seq
+
+    def backlog(self, recipient):
+        """返回 (未确认的消息数, 分段文件总字节数)；字节数包含最早分段中已确认但尚未压缩的记录。"""
+        log = self._get_log(recipient)
+        with log.lock:
+            size = 0
+            for _, path in log.segments:
+                if log.active_file is not None and log.active_file.name == path:
+                    size += log.active_size
+                else:
+                    try:
+                        size += os.path.getsize(path)
+                    except FileNotFoundError:
+                        pass
+            return log.next_seq - 1 - log.acked_seq, size
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            logs = list(self._logs.values())
+        for log in logs:
+            with log.lock:
+                self._close_active(log)
@@ -0,0 +1,116 @@
+import base64
+import hashlib
+import hmac
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+# scrypt 参数：N=2^15, r=8 时每次哈希约占用 32MB 内存
+SCRYPT_N = 2 ** 15
+SCRYPT_R = 8
+SCRYPT_P = 1
+SALT_BYTES = 16
+KEY_BYTES = 32
+
+# 哈希工作进程数与排队上限；排队满时等待 QUEUE_TIMEOUT 秒仍无空位则拒绝
+HASH_WORKERS = max(1, min(4, os.cpu_count() or 1))
+MAX_PENDING = 256
+QUEUE_TIMEOUT = 10
+
+
+class HasherBusyError(Exception):
+    """密码哈希队列已满。"""
+
+
+def _scrypt(password, salt, n, r, p):
+    return hashlib.scrypt(password.encode('utf-8'), salt=salt, n=n, r=r, p=p,
+                          maxmem=256 * r * n + 1024 * 1024, dklen=KEY_BYTES)
+
+
+def is_legacy_hash(stored_hash):
+    """旧版本使用无盐SHA-256，存储为64位十六进制字符串。"""
+    return len(stored_hash) == 64 and not stored_hash.startswith('scrypt$')
+
+
+def compute_hash(password, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P):
+    """计算 scrypt 哈希，格式为 scrypt$N$r$p$盐$哈希（在工作进程中执行）。"""
+    salt = os.urandom(SALT_BYTES)
+    digest = _scrypt(password, salt, n, r, p)
+    return "scrypt${}${}${}${}${}".format(
+        n, r, p, base64.b64encode(salt).decode('ascii'), base64.b64encode(digest).decode('ascii'))
+
+
+def check_hash(password, stored_hash):
+    """校验密码是否与存储的哈希匹配，兼容旧版SHA-256哈希（在工作进程中执行）。"""
+    if is_legacy_hash(stored_hash):
+        legacy = hashlib.sha256(password.encode()).hexdigest()
+        return hmac.compare_digest(legacy, stored_hash)
+    try:
+        _, n, r, p, salt_b64, digest_b64 = stored_hash.split('$')
+        digest = _scrypt(password, base64.b64decode(salt_b64), int(n), int(r), int(p))
+    except ValueError:
+        return False
+    return hmac.compare_digest(digest, base64.b64decode(digest_b64))
+
+
+def needs_rehash(stored_hash, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P):
+    """旧格式或成本参数与当前配置不同的哈希需要在下次登录时重新计算。"""
+    if is_legacy_hash(stored_hash):
+        return True
+    try:
+        _, stored_n, stored_r, stored_p, _, _ = stored_hash.split('$')
+    except ValueError:
+        return True
+    return (int(stored_n), int(stored_r), int(stored_p)) != (n, r, p)
+
+
+class PasswordHasher:
+    """
+    在有界的工作进程池中执行内存密集型的密码哈希与校验，
+    使连接线程在等待结果时不占用GIL，接受连接与消息中继保持响应。
+    """
+
+    def __init__(self, workers=HASH_WORKERS, max_pending=MAX_PENDING, queue_timeout=QUEUE_TIMEOUT,
+                 n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P):
+        self.workers = workers
+        self.queue_timeout = queue_timeout
+        self.n, self.r, self.p = n, r, p
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            return self._executor
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            raise HasherBusyError("密码哈希队列已满")
+        try:
+            return self._get_executor().submit(fn, *args).result()
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        return self._run(compute_hash, password, self.n, self.r, self.p)
+
+    def verify(self, password, stored_hash):
+        """返回 (是否匹配, 是否需要重新哈希)。"""
+        if is_legacy_hash(stored_hash):
+            # 旧哈希校验成本很低，直接在当前线程完成
+            matched = check_hash(password, stored_hash)
+        else:
+            matched = self._run(check_hash, password, stored_hash)
+        return matched, matched and needs_rehash(stored_hash, self.n, self.r, self.p)
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+
+# 全局单例
+password_hasher = PasswordHasher()
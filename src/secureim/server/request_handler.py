@@ -1,24 +1,44 @@
+import json
+import math
 import random
 import re
-import smtplib
 import string
-from email.header import Header
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
+import time
 
 
 from . import database
-from .state import online_users, verification_codes
+from .bots import bot_registry
+from .email_templates import email_templates
+from .mail_outbox import MailOutbox
+from .password_hashing import HasherBusyError
+from .state import online_users, verification_codes, verification_throttle
 
 # 邮件服务器配置 - 如果sender_email为空，则使用模拟邮箱
 EMAIL_CONFIG = {
     'smtp_server': 'smtp.qq.com',
     'smtp_port': 587,
     'sender_email': '',  # 留空则使用模拟邮箱，填写则使用真实SMTP
-    'sender_password': '',  # 邮箱授权码
-    'sender_name': 'SecureIM验证服务'
+    'sender_password': '',  # 邮箱授权码（留空则不登录，例如使用 tools/local_smtp.py 本地测试）
+    'sender_name': 'SecureIM验证服务',
+    'use_tls': True  # 是否使用STARTTLS
 }
 
+# 全局单例：异步发信队列，工作线程保持持久的SMTP会话
+mail_outbox = MailOutbox(EMAIL_CONFIG)
+
+# 登录时每个 offline_messages 帧携带的最大离线消息数
+OFFLINE_BATCH_SIZE = 200
+
+# 离线队列限额：单条信封的最大字节数（隐写图片消息较大），每个收件人最多积压的消息数与字节数
+OFFLINE_MAX_ENVELOPE_BYTES = 8 * 1024 * 1024
+OFFLINE_MAX_MESSAGES = 1000
+OFFLINE_MAX_BYTES = 64 * 1024 * 1024
+
+# 好友列表分页：默认页大小、单页上限、仅筛选在线好友时单次请求最多扫描的页数
+FRIENDS_PAGE_SIZE = 100
+FRIENDS_PAGE_MAX = 500
+FRIENDS_PAGE_MAX_SCAN = 20
+
 def send_to_client(client_socket, data):
     """
     这是一个辅助函数，但由于 request_handler 中的几乎每个函数都需要它，
@@ -120,9 +140,13 @@ def handle_login(payload, send_func, client_socket, address):
     login_identifier = payload.get('username') # May be username or email
     password = payload.get('password')
     
-    username = database.check_credentials(login_identifier, password)
+    try:
+        username = database.check_credentials(login_identifier, password)
+    except HasherBusyError:
+        response = {"type": "response", "action": "login", "status": "error", "message": "服务器繁忙，请稍后重试"}
+        send_func(response)
+        return None
     if username:
-        online_users.add_user(username, client_socket, address)
         # 获取用户的完整信息
         user_email = database.get_user_email(username)
         user_ip = address[0] if address else "未知"
@@ -137,7 +161,11 @@ def handle_login(payload, send_func, client_socket, address):
                 "ip": user_ip
             }
         }
-        send_func(response)
+        # 先投递离线期间收到的消息，再登记为在线：在此期间发来的消息会等待投递锁，之后直接转发
+        with online_users.delivery_lock(username):
+            send_func(response)
+            deliver_offline_messages(username, send_func)
+            online_users.add_user(username, client_socket, address)
         print(f"用户 '{username}' 已登录。")
         broadcast_status_update(username, "online", send_func)
         return username
@@ -176,37 +204,79 @@ def handle_delete_friend(payload, current_user, send_func):
             # send_to_specific_client(friend_socket, notify)
             pass # 实际逻辑在 connection_handler 中
 
+def _friend_entry(f_user):
+    """构造单个好友的列表项（含在线状态与地址）。"""
+    # 机器人用户（如AI）的在线状态由机器人自己提供
+    bot = bot_registry.get(f_user)
+    if bot is not None:
+        return {"username": f_user, **bot.presence()}
+    friend_info = online_users.get_user_info(f_user)
+    if friend_info:
+        return {
+            "username": f_user,
+            "status": "online",
+            "ip": friend_info['ip'],
+            "port": friend_info['port']
+        }
+    return {"username": f_user, "status": "offline"}
+
 def handle_get_friends(current_user, send_func):
     all_friends = database.get_friends(current_user)
-    friend_data = []
-    for f_user in all_friends:
-        # 特殊处理AI用户
-        if f_user == "ai":
-            friend_data.append({
-                "username": "ai",
-                "status": "online",
-                "ip": "0.0.0.0",
-                "port": 0
-            })
-            continue
-        friend_info = online_users.get_user_info(f_user)
-        if friend_info:
-            friend_data.append({
-                "username": f_user,
-                "status": "online",
-                "ip": friend_info['ip'],
-                "port": friend_info['port']
-            })
-        else:
-            friend_data.append({"username": f_user, "status": "offline"})
+    friend_data = [_friend_entry(f_user) for f_user in all_friends]
     response = {"type": "all_friends_list", "payload": friend_data}
     send_func(response)
 
+def handle_get_friends_page(payload, current_user, send_func):
+    """
+    游标分页获取好友列表。payload 可包含: cursor, limit, status ("online" 时只返回在线好友)，
+    以及客户端的 generation（原样返回，客户端据此丢弃过期的响应）。
+    仅筛选在线好友时，单次请求最多扫描 FRIENDS_PAGE_MAX_SCAN 页，未填满也会返回游标以便继续。
+    """
+    cursor = payload.get('cursor')
+    if cursor is not None and (not isinstance(cursor, int) or isinstance(cursor, bool) or cursor < 0):
+        send_func({"type": "response", "action": "get_friends_page", "status": "error", "message": "无效的分页游标"})
+        return
+    limit = payload.get('limit') or FRIENDS_PAGE_SIZE
+    if not isinstance(limit, int) or limit <= 0:
+        limit = FRIENDS_PAGE_SIZE
+    limit = min(limit, FRIENDS_PAGE_MAX)
+    online_only = payload.get('status') == "online"
+
+    friend_data = []
+    next_cursor = cursor
+    for _ in range(FRIENDS_PAGE_MAX_SCAN if online_only else 1):
+        page, next_cursor = database.get_friends_page(current_user, next_cursor, limit)
+        for friend_id, f_user in page:
+            entry = _friend_entry(f_user)
+            if not online_only or entry["status"] == "online":
+                friend_data.append(entry)
+                if len(friend_data) >= limit:
+                    # 页在本批中途填满时，下一页从当前好友之后继续
+                    if friend_id != page[-1][0]:
+                        next_cursor = friend_id
+                    break
+        if next_cursor is None or len(friend_data) >= limit:
+            break
+
+    response = {
+        "type": "friends_page",
+        "payload": {
+            "friends": friend_data,
+            "cursor": cursor,
+            "next_cursor": next_cursor,
+            "status": "online" if online_only else "all",
+            "generation": payload.get('generation')
+        }
+    }
+    send_func(response)
+
 def handle_get_public_key(payload, send_func):
     username = payload.get('username')
-    public_key = database.get_user_public_key(username)
-    if public_key:
-        response = {"type": "public_key_response", "payload": {"username": username, "public_key": public_key}}
+    record = database.get_user_record(username)
+    if record:
+        response = {"type": "public_key_response",
+                    "payload": {"username": username, "public_key": record['public_key'],
+                                "fingerprint": record['fingerprint']}}
     else:
         response = {"type": "response", "status": "error", "message": "用户未找到"}
     send_func(response)
@@ -230,6 +300,67 @@ def handle_relay(msg_type, payload, current_user, send_func):
         send_func(response)
 
 
+def queue_offline_message(msg_type, payload, current_user, send_func):
+    """目标用户离线时，将中继消息存入其离线队列，待其登录后投递；无论是否存入都回复发送方。"""
+    to_user = payload.get('to')
+
+    def reply(queued, message):
+        send_func({"type": "response", "action": msg_type, "status": "success" if queued else "error",
+                   "queued": queued, "to": to_user, "message": message})
+
+    if not database.get_user_id(to_user):
+        reply(False, f"用户 '{to_user}' 不存在。")
+        return
+    if not database.are_friends(current_user, to_user):
+        reply(False, f"'{to_user}' 不是你的好友，无法发送离线消息。")
+        return
+
+    relay_payload = {"from": current_user, **payload}
+    del relay_payload['to']
+    relay_payload.setdefault("timestamp", time.time())
+    relay_type = "receive_message" if msg_type == "relay_message" else "receive_session_key"
+    envelope = {"type": relay_type, "payload": relay_payload}
+    size = len(json.dumps(envelope, ensure_ascii=False).encode('utf-8'))
+    if size > OFFLINE_MAX_ENVELOPE_BYTES:
+        reply(False, f"消息过大（{size} 字节），无法离线存储。")
+        return
+    count, total = database.offline_backlog(to_user)
+    if count >= OFFLINE_MAX_MESSAGES or total + size > OFFLINE_MAX_BYTES:
+        print(f"[离线队列] 用户 '{to_user}' 的离线队列已满（{count} 条, {total} 字节），拒绝来自 '{current_user}' 的消息。")
+        reply(False, f"用户 '{to_user}' 的离线消息已达上限，请待其上线后再发送。")
+        return
+
+    database.enqueue_offline_message(to_user, envelope)
+    print(f"[离线队列] 已为离线用户 '{to_user}' 存储来自 '{current_user}' 的消息。")
+    reply(True, f"用户 '{to_user}' 不在线，消息将在其上线后送达。")
+
+
+def deliver_offline_messages(username, send_func):
+    """
+    用户登录后按顺序批量投递离线消息，客户端收到每批后回复 ack_offline_messages。
+    调用方持有该用户的投递锁。
+    """
+    after_seq = 0
+    while True:
+        batch = database.fetch_offline_messages(username, after_seq, OFFLINE_BATCH_SIZE)
+        if not batch:
+            break
+        messages = [{"seq": seq, "type": envelope["type"], "payload": envelope["payload"]}
+                    for seq, envelope in batch]
+        send_func({"type": "offline_messages", "payload": {"messages": messages}})
+        after_seq = batch[-1][0]
+        if len(batch) < OFFLINE_BATCH_SIZE:
+            break
+    if after_seq:
+        print(f"[离线队列] 已向 '{username}' 投递离线消息，最后序号 {after_seq}。")
+
+
+def handle_ack_offline_messages(payload, current_user):
+    upto_seq = payload.get('upto_seq')
+    if isinstance(upto_seq, int) and upto_seq > 0:
+        database.ack_offline_messages(current_user, upto_seq)
+
+
 def handle_mode_change_request(payload, current_user, send_func):
     """
     处理模式切换请求
@@ -461,16 +592,31 @@ def broadcast_status_update(username, status, send_func_for_user):
     return message
 
 
-def handle_request_verification_code(payload, send_func):
+def handle_request_verification_code(payload, send_func, address=None):
     """处理验证码请求"""
     email = payload.get('email')
 
-    if not email or not re.match(r"[^@]+@[^@]+\.[^@]+", email):
+    if not email or not re.fullmatch(r"[^@\s]+@[^@\s]+\.[^@\s]+", email):
         response = {"type": "response", "action": "request_verification_code",
                     "status": "error", "message": "邮箱格式无效。"}
         send_func(response)
         return
 
+    # 冷却期内的重复请求复用已发送的验证码，不再发信
+    if verification_codes.recent_code(email) is not None:
+        response = {"type": "response", "action": "request_verification_code",
+                    "status": "success", "message": "验证码已发送，请查收邮件，稍后再试可重新发送。"}
+        send_func(response)
+        return
+
+    # 按邮箱、IP与全局的滑动窗口限流
+    wait = verification_throttle.acquire(email, address[0] if address else "unknown")
+    if wait > 0:
+        response = {"type": "response", "action": "request_verification_code",
+                    "status": "error", "message": f"验证码请求过于频繁，请在 {math.ceil(wait)} 秒后重试。"}
+        send_func(response)
+        return
+
     # 生成6位数字验证码
     code = ''.join(random.choices(string.digits, k=6))
     verification_codes.store_code(email, code)
@@ -479,15 +625,22 @@ def handle_request_verification_code(payload, send_func):
     sender_email = EMAIL_CONFIG.get('sender_email', '').strip()
 
     if sender_email:  # 如果配置了发送方邮箱，使用真实SMTP
-        success, error_msg = send_verification_email(email, code)
-        if success:
+        def on_result(success, error_msg):
+            if success:
+                return
+            # 最终投递失败：删除验证码（期间重新发送的新验证码不受影响）并通知客户端
+            verification_codes.remove_code(email, code)
+            send_func({"type": "response", "action": "request_verification_code", "status": "error",
+                       "message": f"验证码发送失败：{error_msg or '邮件服务异常，请稍后重试。'}"})
+
+        # 邮件入队后立即响应，投递由发信队列异步完成
+        if mail_outbox.submit(email, build_verification_email(email, code, payload.get('lang')), on_result) is not None:
             response = {"type": "response", "action": "request_verification_code",
                         "status": "success", "message": "验证码已发送到您的邮箱，请查收。"}
         else:
-            # 如果邮件发送失败，从存储中删除验证码
-            verification_codes._codes.pop(email, None)
+            verification_codes.remove_code(email, code)
             response = {"type": "response", "action": "request_verification_code",
-                        "status": "error", "message": f"验证码发送失败：{error_msg or '邮件服务异常，请稍后重试。'}"}
+                        "status": "error", "message": "验证码发送失败：邮件服务繁忙，请稍后重试。"}
     else:
         # TODO: 实际发送邮件的逻辑，这里仅模拟
         print(f"[验证码] 发送到 {email}: {code}")  # 开发阶段在控制台显示
@@ -496,104 +649,23 @@ def handle_request_verification_code(payload, send_func):
     send_func(response)
 
 
-def send_verification_email(recipient_email, verification_code):
+def build_verification_email(recipient_email, verification_code, locale=None):
     """
-    发送验证码邮件
+    构建验证码邮件（模板在启动时已编译，这里只替换收件人与验证码）
 
     Args:
         recipient_email (str): 收件人邮箱
         verification_code (str): 验证码
+        locale (str): 邮件语言，如 'zh' / 'en'，默认中文
 
     Returns:
-        bool: 发送成功返回True，失败返回False
-        str: 错误信息（如果发送失败）
+        bytes: 完整的邮件内容，交给发信队列投递
     """
-    try:
-        # 创建邮件对象
-        msg = MIMEMultipart()
-        msg['From'] = EMAIL_CONFIG['sender_email']
-        msg['To'] = recipient_email
-        subject = 'SecureIM 邮箱验证码'
-        msg['Subject'] = Header(subject, 'utf-8')
-
-        # 邮件正文
-        email_body = f"""
-<!DOCTYPE html>
-<html>
-<head>
-    <meta charset="UTF-8">
-    <style>
-        body {{ font-family: Arial, sans-serif; line-height: 1.6; color: #333; }}
-        .container {{ max-width: 600px; margin: 0 auto; padding: 20px; }}
-        .header {{ background-color: #0078d4; color: white; padding: 20px; text-align: center; border-radius: 5px 5px 0 0; }}
-        .content {{ background-color: #f9f9f9; padding: 30px; border-radius: 0 0 5px 5px; }}
-        .verification-code {{ background-color: #e7f3ff; border: 2px dashed #0078d4; padding: 15px; text-align: center; margin: 20px 0; font-size: 24px; font-weight: bold; color: #0078d4; }}
-        .warning {{ color: #d73502; font-size: 14px; margin-top: 20px; }}
-        .footer {{ text-align: center; margin-top: 20px; font-size: 12px; color: #666; }}
-    </style>
-</head>
-<body>
-    <div class="container">
-        <div class="header">
-            <h1>SecureIM 邮箱验证</h1>
-        </div>
-        <div class="content">
-            <h2>您好！</h2>
-            <p>您正在注册 SecureIM 账户，验证码为：</p>
-            <div class="verification-code">{verification_code}</div>
-            <p>验证码有效期为 <strong>5分钟</strong>，请及时使用。</p>
-            <div class="warning">
-                <p><strong>安全提醒：</strong></p>
-                <ul>
-                    <li>请勿将验证码告诉他人</li>
-                    <li>如果您没有请求此验证码，请忽略此邮件</li>
-                    <li>此邮件由系统自动发送，请勿回复</li>
-                </ul>
-            </div>
-        </div>
-        <div class="footer">
-            <p>© 2025 SecureIM. 保护您的通信安全。</p>
-        </div>
-    </div>
-</body>
-</html>
-        """
-
-        # 添加HTML正文
-        msg.attach(MIMEText(email_body, 'html', 'utf-8'))
-
-        # 连接SMTP服务器并发送邮件
-        server = smtplib.SMTP(EMAIL_CONFIG['smtp_server'], EMAIL_CONFIG['smtp_port'])
-        server.starttls()  # 启用TLS加密
-        server.login(EMAIL_CONFIG['sender_email'], EMAIL_CONFIG['sender_password'])
-
-        # 发送邮件
-        text = msg.as_string()
-        server.sendmail(EMAIL_CONFIG['sender_email'], recipient_email, text)
-        server.quit()
-
-        print(f"✅ 验证码邮件已成功发送到: {recipient_email}")
-        return True, None
-
-    except smtplib.SMTPAuthenticationError:
-        error_msg = "邮箱认证失败，请检查发送方邮箱配置"
-        print(f"❌ SMTP认证错误: {error_msg}")
-        return False, error_msg
-
-    except smtplib.SMTPRecipientsRefused:
-        error_msg = "收件人邮箱地址无效"
-        print(f"❌ 收件人邮箱被拒绝: {error_msg}")
-        return False, error_msg
-
-    except smtplib.SMTPException as e:
-        error_msg = f"SMTP服务异常: {str(e)}"
-        print(f"❌ SMTP异常: {error_msg}")
-        return False, error_msg
-
-    except Exception as e:
-        error_msg = f"发送邮件时发生未知错误: {str(e)}"
-        print(f"❌ 未知错误: {error_msg}")
-        return False, error_msg
+    # locale 来自客户端请求，只接受已有模板的语言，其余（包括非字符串）使用默认语言
+    if not isinstance(locale, str) or locale not in email_templates.locales('verification'):
+        locale = None
+    return email_templates.render('verification', EMAIL_CONFIG['sender_email'], recipient_email,
+                                  verification_code, locale)
 
 
 def handle_get_user_info(current_user, send_func, address):
@@ -0,0 +1,141 @@
+import heapq
+import itertools
+import threading
+import time
+
+
+class TimerHandle:
+    """call_later/call_every 返回的句柄，可用于取消尚未执行的定时任务。"""
+
+    __slots__ = ('when', 'interval', 'callback', 'args', 'loop', 'cancelled', 'in_heap', '_scheduler')
+
+    def __init__(self, scheduler, when, interval, callback, args, loop):
+        self._scheduler = scheduler
+        self.when = when
+        self.interval = interval  # 周期任务的间隔，一次性任务为None
+        self.callback = callback
+        self.args = args
+        self.loop = loop  # 非空时回调投递到该 asyncio 事件循环中执行
+        self.cancelled = False
+        self.in_heap = False  # 是否仍在调度堆中（一次性任务执行后即出堆）
+
+    def cancel(self):
+        self._scheduler.cancel(self)
+
+
+class Scheduler:
+    """
+    服务器共享的定时任务调度器：一个最小堆加一个后台线程。
+    任意数量的待执行定时器只占用一个线程，添加为 O(log n)，取消为 O(1)（惰性删除）。
+    回调在调度线程中执行，必须很快返回；耗时的工作应在回调中提交到相应的线程池。
+    传入 loop 参数时回调通过 call_soon_threadsafe 在该 asyncio 事件循环中执行。
+    """
+
+    def __init__(self):
+        self._heap = []  # (执行时间, 序号, 句柄)
+        self._counter = itertools.count()  # 相同执行时间按添加顺序执行
+        self._cancelled = 0  # 堆中已取消但尚未弹出的定时器数量
+        self._cond = threading.Condition()
+        self._thread = None
+        self.executed = 0
+        self.failed = 0
+
+    def _ensure_started(self):
+        # 调用方持有 self._cond
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="scheduler", daemon=True)
+            self._thread.start()
+
+    def _push(self, handle):
+        with self._cond:
+            heapq.heappush(self._heap, (handle.when, next(self._counter), handle))
+            handle.in_heap = True
+            self._ensure_started()
+            # 只有新任务成为最早的任务时才需要唤醒调度线程重新计算等待时间
+            if self._heap[0][2] is handle:
+                self._cond.notify()
+        return handle
+
+    def call_at(self, when, callback, *args, loop=None):
+        """在 time.monotonic() 时间 when 执行 callback(*args)。"""
+        return self._push(TimerHandle(self, when, None, callback, args, loop))
+
+    def call_later(self, delay, callback, *args, loop=None):
+        """在 delay 秒后执行 callback(*args)。"""
+        return self.call_at(time.monotonic() + delay, callback, *args, loop=loop)
+
+    def call_every(self, interval, callback, *args, first_delay=None, loop=None):
+        """每隔 interval 秒执行一次 callback(*args)，直到句柄被取消。首次执行默认在 interval 秒后。"""
+        delay = interval if first_delay is None else first_delay
+        return self._push(TimerHandle(self, time.monotonic() + delay, interval, callback, args, loop))
+
+    def cancel(self, handle):
+        with self._cond:
+            if handle.cancelled:
+                return
+            handle.cancelled = True
+            if not handle.in_heap:
+                return  # 已执行完的一次性任务，不在堆中
+            self._cancelled += 1
+            # 已取消的定时器过多时重建堆，避免长延迟的已取消定时器占用内存
+            if self._cancelled > 256 and self._cancelled * 2 > len(self._heap):
+                for entry in self._heap:
+                    if entry[2].cancelled:
+                        entry[2].in_heap = False
+                self._heap = [entry for entry in self._heap if not entry[2].cancelled]
+                heapq.heapify(self._heap)
+                self._cancelled = 0
+
+    def pending(self):
+        """尚未执行且未取消的定时器数量。"""
+        with self._cond:
+            return len(self._heap) - self._cancelled
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    when, _, handle = self._heap[0]
+                    if handle.cancelled:
+                        heapq.heappop(self._heap)
+                        handle.in_heap = False
+                        self._cancelled -= 1
+                        continue
+                    delay = when - time.monotonic()
+                    if delay <= 0:
+                        heapq.heappop(self._heap)
+                        handle.in_heap = False
+                        break
+                    self._cond.wait(delay)
+                if handle.interval is not None:
+                    # 周期任务按固定节拍重新排入，执行耗时不会累积漂移
+                    handle.when = max(handle.when + handle.interval, time.monotonic())
+                    heapq.heappush(self._heap, (handle.when, next(self._counter), handle))
+                    handle.in_heap = True
+            self._dispatch(handle)
+
+    def _dispatch(self, handle):
+        if handle.loop is not None:
+            try:
+                handle.loop.call_soon_threadsafe(self._invoke, handle)
+            except RuntimeError:  # 事件循环已关闭
+                handle.cancel()
+            return
+        self._invoke(handle)
+
+    def _invoke(self, handle):
+        if handle.cancelled:
+            return
+        try:
+            handle.callback(*handle.args)
+            self.executed += 1
+        except Exception as e:
+            self.failed += 1
+            print(f"定时任务执行出错 ({getattr(handle.callback, '__name__', handle.callback)}): {e}")
+
+
+# 全局单例
+scheduler = Scheduler()
@@ -1,58 +1,86 @@
-import base64
-import os
-from cryptography.hazmat.primitives.asymmetric import padding
-from cryptography.hazmat.primitives import serialization, hashes
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-
-
-# 从文件加载AI的私钥
-def load_ai_private_key():
-    # 假设私钥文件在项目根目录的data文件夹下
-    key_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', 'data', 'ai_private_key.pem')
-    with open(key_path, 'rb') as f:
-        private_key = serialization.load_pem_private_key(
-            f.read(),
-            password=None,
-            backend=default_backend()
-        )
-    return private_key
-
-
-def decrypt_with_ai_private_key(encrypted_data_b64):
-    private_key = load_ai_private_key()
-    encrypted_data = base64.b64decode(encrypted_data_b64)
-    decrypted_data = private_key.decrypt(
-        encrypted_data,
-        padding.OAEP(
-            mgf=padding.MGF1(algorithm=hashes.SHA256()),
-            algorithm=hashes.SHA256(),
-            label=None
-        )
-    )
-    return decrypted_data
-
-
-def encrypt_with_aes(key, plaintext_bytes):
-    iv = os.urandom(12)  # GCM推荐的IV大小为12字节
-    cipher = Cipher(algorithms.AES(key), modes.GCM(iv), backend=default_backend())
-    encryptor = cipher.encryptor()
-    ciphertext = encryptor.update(plaintext_bytes) + encryptor.finalize()
-    return base64.b64encode(iv + encryptor.tag + ciphertext).decode('utf-8')
-
-
-def decrypt_with_aes(key, encrypted_data_b64):
-    try:
-        encrypted_data = base64.b64decode(encrypted_data_b64)
-        iv = encrypted_data[:12]
-        tag = encrypted_data[12:28]  # GCM认证标签为16字节
-        ciphertext = encrypted_data[28:]
-
-        cipher = Cipher(algorithms.AES(key), modes.GCM(iv, tag), backend=default_backend())
-        decryptor = cipher.decryptor()
-
-        decrypted_bytes = decryptor.update(ciphertext) + decryptor.finalize()
-        return decrypted_bytes
-    except Exception as e:
-        print(f"AES解密失败: {e}")
+import base64
+import os
+import threading
+from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives import serialization, hashes
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+
+# 从存储后端加载服务器持有的私钥（AI等服务器端机器人用户）
+def load_private_key(name):
+    # SQLite后端下私钥文件位于项目根目录的data文件夹下
+    from . import database
+    pem_bytes = database.load_private_key_pem(name)
+    if pem_bytes is None:
+        raise FileNotFoundError(f"{name} 私钥不存在")
+    private_key = serialization.load_pem_private_key(
+        pem_bytes,
+        password=None,
+        backend=default_backend()
+    )
+    return private_key
+
+
+# 从存储后端加载AI的私钥
+def load_ai_private_key():
+    return load_private_key('ai')
+
+
+_private_keys = {}  # 名称 -> (存储后端, 已解析的私钥对象)
+_key_lock = threading.Lock()
+
+
+def get_private_key(name):
+    """返回已解析的私钥，只在首次使用（或切换存储后端后）从存储读取并解析一次。"""
+    from . import database
+    storage = database.get_storage()
+    with _key_lock:
+        cached_storage, private_key = _private_keys.get(name, (None, None))
+        if private_key is None or cached_storage is not storage:
+            private_key = load_private_key(name)
+            _private_keys[name] = (storage, private_key)
+        return private_key
+
+
+def decrypt_with_private_key(name, encrypted_data_b64):
+    private_key = get_private_key(name)
+    encrypted_data = base64.b64decode(encrypted_data_b64)
+    decrypted_data = private_key.decrypt(
+        encrypted_data,
+        padding.OAEP(
+            mgf=padding.MGF1(algorithm=hashes.SHA256()),
+            algorithm=hashes.SHA256(),
+            label=None
+        )
+    )
+    return decrypted_data
+
+
+def decrypt_with_ai_private_key(encrypted_data_b64):
+    return decrypt_with_private_key('ai', encrypted_data_b64)
+
+
+def encrypt_with_aes(key, plaintext_bytes):
+    iv = os.urandom(12)  # GCM推荐的IV大小为12字节
+    cipher = Cipher(algorithms.AES(key), modes.GCM(iv), backend=default_backend())
+    encryptor = cipher.encryptor()
+    ciphertext = encryptor.update(plaintext_bytes) + encryptor.finalize()
+    return base64.b64encode(iv + encryptor.tag + ciphertext).decode('utf-8')
+
+
+def decrypt_with_aes(key, encrypted_data_b64):
+    try:
+        encrypted_data = base64.b64decode(encrypted_data_b64)
+        iv = encrypted_data[:12]
+        tag = encrypted_data[12:28]  # GCM认证标签为16字节
+        ciphertext = encrypted_data[28:]
+
+        cipher = Cipher(algorithms.AES(key), modes.GCM(iv, tag), backend=default_backend())
+        decryptor = cipher.decryptor()
+
+        decrypted_bytes = decryptor.update(ciphertext) + decryptor.finalize()
+        return decrypted_bytes
+    except Exception as e:
+        print(f"AES解密失败: {e}")
         return None
\ No newline at end of file
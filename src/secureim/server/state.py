@@ -1,11 +1,37 @@
 import threading
 import time
 
+from .scheduler import scheduler
+
+# 邮箱验证码有效期（秒），到期由调度器自动清除
+VERIFICATION_CODE_TTL = 300
+
+# 冷却期（秒）：同一邮箱在该时间内重复请求验证码时复用已发送的验证码，不再发信
+VERIFICATION_CODE_COOLDOWN = 60
+
+# 验证码请求的滑动窗口限流：(窗口秒数, 窗口内最多发信次数)
+VERIFICATION_LIMIT_PER_EMAIL = (3600, 5)
+VERIFICATION_LIMIT_PER_IP = (3600, 20)
+VERIFICATION_LIMIT_GLOBAL = (60, 120)
+THROTTLE_SWEEP_INTERVAL = 300  # 清理过期限流计数的间隔（秒）
+
+# 投递锁的分段数：按收件人用户名散列到固定数量的锁上，不随用户数增长
+DELIVERY_LOCK_STRIPES = 64
+
 
 class OnlineUsers:
     def __init__(self):
         self._users = {}
         self._lock = threading.Lock()
+        self._delivery_locks = [threading.Lock() for _ in range(DELIVERY_LOCK_STRIPES)]
+
+    def delivery_lock(self, username):
+        """
+        收件人的投递锁：中继时的"是否在线→直接转发/存入离线队列"与登录时的"投递离线消息→登记在线"
+        在同一把锁下进行，离线消息总是先于其后的在线消息送达，每个发送方的消息保持顺序。
+        持有期间不得再获取其他用户的投递锁。
+        """
+        return self._delivery_locks[hash(username) % len(self._delivery_locks)]
 
     def get_socket(self, username):
         with self._lock:
@@ -32,27 +58,144 @@ class OnlineUsers:
 
 class EmailVerificationCodes:
     def __init__(self):
-        self._codes = {}  # email -> {"code": "123456", "timestamp": time.time()}
+        self._codes = {}  # email -> {"code": "123456", "timestamp": time.time(), "expiry": TimerHandle}
         self._lock = threading.Lock()
 
     def store_code(self, email, code):
         with self._lock:
-            self._codes[email] = {"code": code, "timestamp": time.time()}
+            old = self._codes.get(email)
+            if old:
+                old["expiry"].cancel()
+            record = {"code": code, "timestamp": time.time()}
+            record["expiry"] = scheduler.call_later(VERIFICATION_CODE_TTL, self._expire, email, record)
+            self._codes[email] = record
+
+    def _expire(self, email, record):
+        with self._lock:
+            # 只删除到期的这一个验证码，期间重新发送的新验证码不受影响
+            if self._codes.get(email) is record:
+                del self._codes[email]
+
+    def recent_code(self, email, cooldown=VERIFICATION_CODE_COOLDOWN):
+        """返回该邮箱在冷却期内发出的验证码，没有则返回None。"""
+        with self._lock:
+            record = self._codes.get(email)
+            if record and time.time() - record["timestamp"] < cooldown:
+                return record["code"]
+            return None
+
+    def remove_code(self, email, code=None):
+        """删除邮箱的验证码；指定 code 时仅当当前验证码与之相同才删除（避免误删重新发送的新验证码）。"""
+        with self._lock:
+            record = self._codes.get(email)
+            if record and (code is None or record["code"] == code):
+                del self._codes[email]
+                record["expiry"].cancel()
 
     def verify_code(self, email, code):
         with self._lock:
             if email not in self._codes:
                 return False
             stored = self._codes[email]
-            # 验证码5分钟内有效
-            if time.time() - stored["timestamp"] > 300:
+            # 验证码5分钟内有效（调度器可能稍晚于到期时间才清除）
+            if time.time() - stored["timestamp"] > VERIFICATION_CODE_TTL:
                 del self._codes[email]
                 return False
             if stored["code"] == code:
                 del self._codes[email]  # 验证成功后删除
+                stored["expiry"].cancel()
                 return True
             return False
 
+class SlidingWindowLimiter:
+    """
+    滑动窗口计数器：每个键只保存 [窗口编号, 上一窗口计数, 当前窗口计数]，
+    以上一窗口计数按剩余比例加权近似滑动窗口内的请求数。调用方负责加锁。
+    """
+
+    def __init__(self, window, limit):
+        self.window = window
+        self.limit = limit
+        self._slots = {}  # key -> [窗口编号, 上一窗口计数, 当前窗口计数]
+
+    def _slot(self, key, now):
+        window_id = int(now // self.window)
+        slot = self._slots.get(key)
+        if slot is None or slot[0] < window_id - 1:
+            return [window_id, 0, 0]
+        if slot[0] == window_id - 1:
+            return [window_id, slot[2], 0]
+        return slot
+
+    def retry_after(self, key, now):
+        """允许再请求一次时返回0，否则返回大约还需等待的秒数。"""
+        _, previous, current = self._slot(key, now)
+        elapsed = (now % self.window) / self.window
+        if previous * (1 - elapsed) + current < self.limit:
+            return 0
+        if current < self.limit:
+            # 等上一窗口的权重降到足够低
+            return ((1 - (self.limit - current) / previous) - elapsed) * self.window
+        # 等到下一个窗口，且本窗口计数的权重降到足够低
+        return (1 - elapsed) * self.window + (1 - self.limit / current) * self.window
+
+    def hit(self, key, now):
+        slot = self._slot(key, now)
+        slot[2] += 1
+        self._slots[key] = slot
+
+    def sweep(self, now):
+        """删除两个窗口内没有请求的键。"""
+        oldest = int(now // self.window) - 1
+        for key in [k for k, slot in self._slots.items() if slot[0] < oldest]:
+            del self._slots[key]
+
+    def __len__(self):
+        return len(self._slots)
+
+
+class VerificationThrottle:
+    """
+    验证码发信限流：按邮箱、按IP和全局三个滑动窗口，三者都允许时才计数并放行，
+    因此每个邮箱/IP在一个窗口内触发的发信次数有确定的上限。过期计数由调度器定期清理。
+    """
+
+    def __init__(self, per_email=VERIFICATION_LIMIT_PER_EMAIL, per_ip=VERIFICATION_LIMIT_PER_IP,
+                 global_limit=VERIFICATION_LIMIT_GLOBAL, sweep_interval=THROTTLE_SWEEP_INTERVAL):
+        self._email = SlidingWindowLimiter(*per_email)
+        self._ip = SlidingWindowLimiter(*per_ip)
+        self._global = SlidingWindowLimiter(*global_limit)
+        self.sweep_interval = sweep_interval
+        self._lock = threading.Lock()
+        self._sweeper = None
+        self.rejected = 0
+
+    def acquire(self, email, ip):
+        """允许发信时计数并返回0，否则返回需要等待的秒数（不计数）。"""
+        now = time.time()
+        checks = ((self._global, '*'), (self._ip, ip), (self._email, email.lower()))
+        with self._lock:
+            if self._sweeper is None:
+                self._sweeper = scheduler.call_every(self.sweep_interval, self.sweep)
+            wait = max(limiter.retry_after(key, now) for limiter, key in checks)
+            if wait > 0:
+                self.rejected += 1
+                return wait
+            for limiter, key in checks:
+                limiter.hit(key, now)
+            return 0
+
+    def sweep(self):
+        now = time.time()
+        with self._lock:
+            for limiter in (self._email, self._ip, self._global):
+                limiter.sweep(now)
+
+    def stats(self):
+        with self._lock:
+            return {"emails": len(self._email), "ips": len(self._ip), "rejected": self.rejected}
+
+
 class AISessionKeys:
     def __init__(self):
         self._keys = {}  # username -> aes_key (bytes)
@@ -74,4 +217,5 @@ class AISessionKeys:
 # 全局单例
 online_users = OnlineUsers()
 verification_codes = EmailVerificationCodes()
+verification_throttle = VerificationThrottle()
 ai_session_keys = AISessionKeys()  # AI会话密钥管理器
\ No newline at end of file
@@ -0,0 +1,644 @@
+import bisect
+import json
+import os
+import sqlite3
+import threading
+import zlib
+
+from .offline_queue import OfflineMessageQueue
+
+
+class DuplicateUserError(Exception):
+    """用户名或邮箱已存在。field 为 'username' 或 'email'。"""
+
+    def __init__(self, field):
+        super().__init__(f"duplicate {field}")
+        self.field = field
+
+
+class StorageBackend:
+    """
+    存储后端接口：用户、好友关系、服务器密钥材料，以及离线消息。
+    用户记录以字典返回: {"id", "username", "password_hash", "email", "public_key"}。
+    好友关系总是以 (较小ID, 较大ID) 的顺序存储。
+    """
+
+    def initialize(self):
+        """创建所需的表或结构（幂等）。"""
+        raise NotImplementedError
+
+    # --- 用户 ---
+    def insert_user(self, username, password_hash, email, public_key):
+        """插入新用户并返回其ID。用户名或邮箱重复时抛出 DuplicateUserError。"""
+        raise NotImplementedError
+
+    def get_user(self, username):
+        raise NotImplementedError
+
+    def get_user_by_email(self, email):
+        raise NotImplementedError
+
+    def get_login_candidates(self, identifier):
+        """返回用户名或邮箱等于 identifier 的所有用户记录。"""
+        raise NotImplementedError
+
+    def update_password_hash(self, username, password_hash):
+        """更新密码哈希，用户不存在时返回False。"""
+        raise NotImplementedError
+
+    # --- 好友关系 ---
+    def add_friendship(self, user_id1, user_id2):
+        """添加好友关系，已存在时返回False。"""
+        raise NotImplementedError
+
+    def delete_friendship(self, user_id1, user_id2):
+        """删除好友关系，不存在时返回False。"""
+        raise NotImplementedError
+
+    def get_friend_usernames(self, user_id):
+        raise NotImplementedError
+
+    def get_friend_page(self, user_id, after_id=0, limit=100):
+        """按好友ID升序返回ID大于 after_id 的至多 limit 个好友 [(好友ID, 用户名), ...]。"""
+        raise NotImplementedError
+
+    # --- 服务器密钥材料 ---
+    def save_private_key(self, name, pem_bytes):
+        raise NotImplementedError
+
+    def load_private_key(self, name):
+        """返回PEM字节，不存在时返回None。"""
+        raise NotImplementedError
+
+    # --- 离线消息 ---
+    def enqueue_offline_message(self, recipient, envelope):
+        """为收件人追加一条不透明的离线消息信封，返回其序号（按收件人递增）。"""
+        raise NotImplementedError
+
+    def fetch_offline_messages(self, recipient, after_seq=0, limit=None):
+        """按顺序返回未确认的 [(序号, 信封), ...]。"""
+        raise NotImplementedError
+
+    def ack_offline_messages(self, recipient, upto_seq):
+        """确认序号不大于 upto_seq 的离线消息，之后不再返回。"""
+        raise NotImplementedError
+
+    def offline_backlog(self, recipient):
+        """返回收件人未确认的离线消息 (条数, 大约占用的字节数)，用于配额检查。"""
+        raise NotImplementedError
+
+
+_offline_init_lock = threading.Lock()
+
+
+class SQLiteStorage(StorageBackend):
+    """基于单个SQLite文件的存储后端，私钥以PEM文件保存在数据库所在目录。"""
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.data_dir = os.path.dirname(os.path.abspath(db_file))
+
+    def __str__(self):
+        return self.db_file
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_file)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def initialize(self):
+        conn = self._connect()
+        cursor = conn.cursor()
+
+        # 用户表 (users)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT UNIQUE NOT NULL,
+                password_hash TEXT NOT NULL,
+                email TEXT UNIQUE NOT NULL,
+                public_key TEXT NOT NULL
+            );
+        ''')
+
+        # 好友关系表 (friendships)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS friendships (
+                user_id1 INTEGER NOT NULL,
+                user_id2 INTEGER NOT NULL,
+                PRIMARY KEY (user_id1, user_id2),
+                FOREIGN KEY(user_id1) REFERENCES users(id),
+                FOREIGN KEY(user_id2) REFERENCES users(id)
+            );
+        ''')
+        # 主键只覆盖 user_id1 开头的查询，好友列表（含分页）还需要按 (user_id2, user_id1) 有序查找
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_friendships_reverse ON friendships(user_id2, user_id1)")
+        conn.commit()
+        conn.close()
+
+    def insert_user(self, username, password_hash, email, public_key):
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(
+                "INSERT INTO users (username, password_hash, email, public_key) VALUES (?, ?, ?, ?)",
+                (username, password_hash, email, public_key)
+            )
+            conn.commit()
+            return cursor.lastrowid
+        except sqlite3.IntegrityError as e:
+            error_message = str(e).lower()
+            if 'users.username' in error_message:
+                raise DuplicateUserError('username')
+            elif 'users.email' in error_message:
+                raise DuplicateUserError('email')
+            raise
+        finally:
+            conn.close()
+
+    def _fetch_user(self, where, value):
+        conn = self._connect()
+        cursor = conn.cursor()
+        cursor.execute(
+            f"SELECT id, username, password_hash, email, public_key FROM users WHERE {where} = ?",
+            (value,)
+        )
+        result = cursor.fetchone()
+        conn.close()
+        return dict(result) if result else None
+
+    def get_user(self, username):
+        return self._fetch_user("username", username)
+
+    def get_user_by_email(self, email):
+        return self._fetch_user("email", email)
+
+    def get_login_candidates(self, identifier):
+        conn = self._connect()
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT id, username, password_hash, email, public_key FROM users WHERE username = ? OR email = ?",
+            (identifier, identifier)
+        )
+        rows = [dict(row) for row in cursor.fetchall()]
+        conn.close()
+        return rows
+
+    def _update_user(self, column, value, username):
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(f"UPDATE users SET {column} = ? WHERE username = ?", (value, username))
+            conn.commit()
+            return cursor.rowcount > 0
+        finally:
+            conn.close()
+
+    def update_password_hash(self, username, password_hash):
+        return self._update_user("password_hash", password_hash, username)
+
+    def add_friendship(self, user_id1, user_id2):
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(
+                "INSERT INTO friendships (user_id1, user_id2) VALUES (?, ?)",
+                (user_id1, user_id2)
+            )
+            conn.commit()
+            return cursor.rowcount > 0
+        except sqlite3.IntegrityError:  # 好友关系已存在
+            return False
+        finally:
+            conn.close()
+
+    def delete_friendship(self, user_id1, user_id2):
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(
+                "DELETE FROM friendships WHERE user_id1 = ? AND user_id2 = ?",
+                (user_id1, user_id2)
+            )
+            conn.commit()
+            return cursor.rowcount > 0
+        finally:
+            conn.close()
+
+    def get_friend_usernames(self, user_id):
+        conn = self._connect()
+        cursor = conn.cursor()
+        # 好友关系可能存在于任一列中
+        cursor.execute("""
+            SELECT u.username FROM users u JOIN friendships f ON u.id = f.user_id2 WHERE f.user_id1 = ?
+            UNION
+            SELECT u.username FROM users u JOIN friendships f ON u.id = f.user_id1 WHERE f.user_id2 = ?
+        """, (user_id, user_id))
+        friends = [row['username'] for row in cursor.fetchall()]
+        conn.close()
+        return friends
+
+    def get_friend_page(self, user_id, after_id=0, limit=100):
+        conn = self._connect()
+        cursor = conn.cursor()
+        # 两侧各自沿索引有序取至多 limit 行，再合并取前 limit 行，代价与好友总数无关
+        cursor.execute("""
+            SELECT f.id, u.username FROM (
+                SELECT id FROM (SELECT user_id2 AS id FROM friendships
+                                WHERE user_id1 = ? AND user_id2 > ? ORDER BY user_id2 LIMIT ?)
+                UNION ALL
+                SELECT id FROM (SELECT user_id1 AS id FROM friendships
+                                WHERE user_id2 = ? AND user_id1 > ? ORDER BY user_id1 LIMIT ?)
+                ORDER BY id LIMIT ?
+            ) f JOIN users u ON u.id = f.id ORDER BY f.id
+        """, (user_id, after_id, limit, user_id, after_id, limit, limit))
+        page = [(row['id'], row['username']) for row in cursor.fetchall()]
+        conn.close()
+        return page
+
+    def _offline_queue(self):
+        # 离线消息不进SQLite，而是写入数据目录下的追加式分段日志
+        queue = getattr(self, '_offline', None)
+        if queue is None:
+            with _offline_init_lock:
+                queue = getattr(self, '_offline', None)
+                if queue is None:
+                    queue = self._offline = OfflineMessageQueue(os.path.join(self.data_dir, 'offline'))
+        return queue
+
+    def enqueue_offline_message(self, recipient, envelope):
+        return self._offline_queue().enqueue(recipient, envelope)
+
+    def fetch_offline_messages(self, recipient, after_seq=0, limit=None):
+        return self._offline_queue().fetch(recipient, after_seq, limit)
+
+    def ack_offline_messages(self, recipient, upto_seq):
+        self._offline_queue().ack(recipient, upto_seq)
+
+    def offline_backlog(self, recipient):
+        return self._offline_queue().backlog(recipient)
+
+    def _private_key_path(self, name):
+        return os.path.join(self.data_dir, f'{name}_private_key.pem')
+
+    def save_private_key(self, name, pem_bytes):
+        with open(self._private_key_path(name), 'wb') as f:
+            f.write(pem_bytes)
+
+    def load_private_key(self, name):
+        try:
+            with open(self._private_key_path(name), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+
+
+class ShardedSQLiteStorage(SQLiteStorage):
+    """
+    按用户分片的SQLite存储：用户及其好友关系分布在 N 个SQLite文件中，
+    每个分片拥有独立的写锁。
+    - 用户按用户名哈希分配分片，用户ID满足 id % N == 分片号，因此按ID即可路由；
+    - 邮箱唯一性由按邮箱哈希分片的 emails 目录表保证；
+    - 好友关系在双方所在分片各存一行（附带好友用户名），查询好友列表只访问一个分片。
+    """
+
+    def __init__(self, data_dir, shard_count):
+        if shard_count < 1:
+            raise ValueError("shard_count 必须至少为1")
+        self.data_dir = os.path.abspath(data_dir)
+        self.shard_count = shard_count
+        self.shard_files = [os.path.join(self.data_dir, f'server_shard{i}.db') for i in range(shard_count)]
+        # 每个线程为每个分片保持一个长连接，避免每次查询重新打开文件与WAL检查点
+        self._local = threading.local()
+
+    def __str__(self):
+        return f"{self.data_dir} ({self.shard_count} 个分片)"
+
+    def _connect_shard(self, shard):
+        connections = getattr(self._local, 'connections', None)
+        if connections is None:
+            connections = self._local.connections = {}
+        conn = connections.get(shard)
+        if conn is None:
+            conn = sqlite3.connect(self.shard_files[shard], timeout=30)
+            conn.row_factory = sqlite3.Row
+            connections[shard] = conn
+        return conn
+
+    def _shard_for_key(self, key):
+        return zlib.crc32(key.encode('utf-8')) % self.shard_count
+
+    def _shard_for_id(self, user_id):
+        return user_id % self.shard_count
+
+    def initialize(self):
+        for shard in range(self.shard_count):
+            conn = self._connect_shard(shard)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS users (
+                    id INTEGER PRIMARY KEY,
+                    username TEXT UNIQUE NOT NULL,
+                    password_hash TEXT NOT NULL,
+                    email TEXT NOT NULL,
+                    public_key TEXT NOT NULL
+                );
+            ''')
+            # 邮箱目录：email -> username，保证跨分片的邮箱唯一
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS emails (
+                    email TEXT PRIMARY KEY,
+                    username TEXT NOT NULL
+                );
+            ''')
+            # 好友关系：每条关系在双方分片各存一行
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS friendships (
+                    user_id INTEGER NOT NULL,
+                    friend_id INTEGER NOT NULL,
+                    friend_username TEXT NOT NULL,
+                    PRIMARY KEY (user_id, friend_id)
+                );
+            ''')
+            conn.commit()
+
+    def insert_user(self, username, password_hash, email, public_key):
+        email_shard = self._shard_for_key(email)
+        conn = self._connect_shard(email_shard)
+        try:
+            conn.execute("INSERT INTO emails (email, username) VALUES (?, ?)", (email, username))
+            conn.commit()
+        except sqlite3.IntegrityError:
+            conn.rollback()
+            raise DuplicateUserError('email')
+
+        shard = self._shard_for_key(username)
+        conn = self._connect_shard(shard)
+        try:
+            # BEGIN IMMEDIATE 持有该分片的写锁，保证ID分配无竞争
+            conn.execute("BEGIN IMMEDIATE")
+            cursor = conn.execute(
+                "SELECT COALESCE(MAX(id), ?) + ? FROM users", (shard, self.shard_count)
+            )
+            user_id = cursor.fetchone()[0]
+            conn.execute(
+                "INSERT INTO users (id, username, password_hash, email, public_key) VALUES (?, ?, ?, ?, ?)",
+                (user_id, username, password_hash, email, public_key)
+            )
+            conn.commit()
+            return user_id
+        except sqlite3.IntegrityError:
+            conn.rollback()
+            self._release_email(email, username)
+            raise DuplicateUserError('username')
+        except Exception:
+            conn.rollback()
+            raise
+
+    def _release_email(self, email, username):
+        conn = self._connect_shard(self._shard_for_key(email))
+        conn.execute("DELETE FROM emails WHERE email = ? AND username = ?", (email, username))
+        conn.commit()
+
+    def _fetch_user_in_shard(self, shard, where, value):
+        conn = self._connect_shard(shard)
+        cursor = conn.execute(
+            f"SELECT id, username, password_hash, email, public_key FROM users WHERE {where} = ?",
+            (value,)
+        )
+        result = cursor.fetchone()
+        return dict(result) if result else None
+
+    def get_user(self, username):
+        return self._fetch_user_in_shard(self._shard_for_key(username), "username", username)
+
+    def _get_user_by_id(self, user_id):
+        return self._fetch_user_in_shard(self._shard_for_id(user_id), "id", user_id)
+
+    def get_user_by_email(self, email):
+        conn = self._connect_shard(self._shard_for_key(email))
+        result = conn.execute("SELECT username FROM emails WHERE email = ?", (email,)).fetchone()
+        if not result:
+            return None
+        user = self.get_user(result['username'])
+        # 目录项可能属于一次未完成的注册，以用户表为准
+        return user if user and user['email'] == email else None
+
+    def get_login_candidates(self, identifier):
+        candidates = {}
+        for user in (self.get_user(identifier), self.get_user_by_email(identifier)):
+            if user:
+                candidates[user['id']] = user
+        return [candidates[user_id] for user_id in sorted(candidates)]
+
+    def _update_user(self, column, value, username):
+        conn = self._connect_shard(self._shard_for_key(username))
+        cursor = conn.execute(f"UPDATE users SET {column} = ? WHERE username = ?", (value, username))
+        conn.commit()
+        return cursor.rowcount > 0
+
+    def _insert_friend_row(self, user_id, friend):
+        conn = self._connect_shard(self._shard_for_id(user_id))
+        cursor = conn.execute(
+            "INSERT OR IGNORE INTO friendships (user_id, friend_id, friend_username) VALUES (?, ?, ?)",
+            (user_id, friend['id'], friend['username'])
+        )
+        conn.commit()
+        return cursor.rowcount > 0
+
+    def _delete_friend_row(self, user_id, friend_id):
+        conn = self._connect_shard(self._shard_for_id(user_id))
+        cursor = conn.execute(
+            "DELETE FROM friendships WHERE user_id = ? AND friend_id = ?", (user_id, friend_id)
+        )
+        conn.commit()
+        return cursor.rowcount > 0
+
+    def add_friendship(self, user_id1, user_id2):
+        user1 = self._get_user_by_id(user_id1)
+        user2 = self._get_user_by_id(user_id2)
+        if not user1 or not user2:
+            return False
+        added = self._insert_friend_row(user_id1, user2)
+        # 另一侧总是补齐，以修复此前中断留下的单侧记录
+        added = self._insert_friend_row(user_id2, user1) or added
+        return added
+
+    def delete_friendship(self, user_id1, user_id2):
+        deleted = self._delete_friend_row(user_id1, user_id2)
+        deleted = self._delete_friend_row(user_id2, user_id1) or deleted
+        return deleted
+
+    def get_friend_usernames(self, user_id):
+        conn = self._connect_shard(self._shard_for_id(user_id))
+        cursor = conn.execute("SELECT friend_username FROM friendships WHERE user_id = ?", (user_id,))
+        friends = [row['friend_username'] for row in cursor.fetchall()]
+        return friends
+
+    def get_friend_page(self, user_id, after_id=0, limit=100):
+        conn = self._connect_shard(self._shard_for_id(user_id))
+        cursor = conn.execute(
+            "SELECT friend_id, friend_username FROM friendships WHERE user_id = ? AND friend_id > ? "
+            "ORDER BY friend_id LIMIT ?",
+            (user_id, after_id, limit)
+        )
+        return [(row['friend_id'], row['friend_username']) for row in cursor.fetchall()]
+
+
+def _envelope_size(envelope):
+    return len(json.dumps(envelope, ensure_ascii=False).encode('utf-8'))
+
+
+def _sorted_add(values, value):
+    index = bisect.bisect_left(values, value)
+    if index == len(values) or values[index] != value:
+        values.insert(index, value)
+
+
+def _sorted_discard(values, value):
+    index = bisect.bisect_left(values, value)
+    if index < len(values) and values[index] == value:
+        del values[index]
+
+
+class MemoryStorage(StorageBackend):
+    """
+    纯内存存储后端，语义与 SQLiteStorage 相同，用于测试与基准测试。
+    不做任何磁盘I/O，进程退出后数据丢失。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._users = {}  # id -> user record
+        self._by_username = {}  # username -> id
+        self._by_email = {}  # email -> id
+        self._friendships = set()  # (user_id1, user_id2)，user_id1 < user_id2
+        self._friends = {}  # user_id -> 有序的 friend_id 列表（分页时二分查找起点）
+        self._private_keys = {}  # name -> pem bytes
+        self._offline = {}  # recipient -> {"next_seq": int, "messages": [(seq, envelope), ...], "bytes": int}
+        self._next_id = 1
+
+    def __str__(self):
+        return "内存存储"
+
+    def initialize(self):
+        pass
+
+    def insert_user(self, username, password_hash, email, public_key):
+        with self._lock:
+            if username in self._by_username:
+                raise DuplicateUserError('username')
+            if email in self._by_email:
+                raise DuplicateUserError('email')
+            user_id = self._next_id
+            self._next_id += 1
+            self._users[user_id] = {
+                "id": user_id,
+                "username": username,
+                "password_hash": password_hash,
+                "email": email,
+                "public_key": public_key
+            }
+            self._by_username[username] = user_id
+            self._by_email[email] = user_id
+            return user_id
+
+    def _copy(self, user_id):
+        user = self._users.get(user_id) if user_id is not None else None
+        return dict(user) if user else None
+
+    def get_user(self, username):
+        with self._lock:
+            return self._copy(self._by_username.get(username))
+
+    def get_user_by_email(self, email):
+        with self._lock:
+            return self._copy(self._by_email.get(email))
+
+    def get_login_candidates(self, identifier):
+        with self._lock:
+            ids = {self._by_username.get(identifier), self._by_email.get(identifier)}
+            return [self._copy(user_id) for user_id in sorted(i for i in ids if i is not None)]
+
+    def _update_user(self, field, value, username):
+        with self._lock:
+            user_id = self._by_username.get(username)
+            if user_id is None:
+                return False
+            self._users[user_id][field] = value
+            return True
+
+    def update_password_hash(self, username, password_hash):
+        return self._update_user("password_hash", password_hash, username)
+
+    def add_friendship(self, user_id1, user_id2):
+        with self._lock:
+            key = (user_id1, user_id2)
+            if key in self._friendships:
+                return False
+            self._friendships.add(key)
+            _sorted_add(self._friends.setdefault(user_id1, []), user_id2)
+            _sorted_add(self._friends.setdefault(user_id2, []), user_id1)
+            return True
+
+    def delete_friendship(self, user_id1, user_id2):
+        with self._lock:
+            key = (user_id1, user_id2)
+            if key not in self._friendships:
+                return False
+            self._friendships.discard(key)
+            _sorted_discard(self._friends.get(user_id1, []), user_id2)
+            _sorted_discard(self._friends.get(user_id2, []), user_id1)
+            return True
+
+    def get_friend_usernames(self, user_id):
+        with self._lock:
+            return [self._users[friend_id]['username']
+                    for friend_id in self._friends.get(user_id, ())
+                    if friend_id in self._users]
+
+    def get_friend_page(self, user_id, after_id=0, limit=100):
+        with self._lock:
+            friend_ids = self._friends.get(user_id, [])
+            start = bisect.bisect_right(friend_ids, after_id)
+            friend_ids = friend_ids[start:start + limit]
+            return [(friend_id, self._users[friend_id]['username']) for friend_id in friend_ids]
+
+    def save_private_key(self, name, pem_bytes):
+        with self._lock:
+            self._private_keys[name] = pem_bytes
+
+    def load_private_key(self, name):
+        with self._lock:
+            return self._private_keys.get(name)
+
+    def enqueue_offline_message(self, recipient, envelope):
+        with self._lock:
+            queue = self._offline.setdefault(recipient, {"next_seq": 1, "messages": [], "bytes": 0})
+            seq = queue["next_seq"]
+            queue["next_seq"] += 1
+            queue["messages"].append((seq, envelope))
+            queue["bytes"] += _envelope_size(envelope)
+            return seq
+
+    def fetch_offline_messages(self, recipient, after_seq=0, limit=None):
+        with self._lock:
+            queue = self._offline.get(recipient)
+            if not queue:
+                return []
+            messages = [m for m in queue["messages"] if m[0] > after_seq]
+            return messages[:limit] if limit is not None else messages
+
+    def ack_offline_messages(self, recipient, upto_seq):
+        with self._lock:
+            queue = self._offline.get(recipient)
+            if queue:
+                acked = [m for m in queue["messages"] if m[0] <= upto_seq]
+                queue["messages"] = queue["messages"][len(acked):]
+                queue["bytes"] -= sum(_envelope_size(envelope) for _, envelope in acked)
+
+    def offline_backlog(self, recipient):
+        with self._lock:
+            queue = self._offline.get(recipient)
+            return (len(queue["messages"]), queue["bytes"]) if queue else (0, 0)
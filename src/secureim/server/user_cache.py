@@ -0,0 +1,113 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+# 不存在的用户名的缓存时间（秒）：短时间内重复查询同一个不存在的用户（如反复添加好友、发消息）不再访问存储
+NEGATIVE_TTL = 5
+
+
+def public_key_fingerprint(public_key_pem):
+    """计算公钥PEM文本的SHA-256指纹（十六进制）。"""
+    return hashlib.sha256(public_key_pem.encode('utf-8')).hexdigest()
+
+
+class UserRecordCache:
+    """
+    用户记录的进程内LRU读穿缓存。
+    记录为字典: {"id", "username", "email", "public_key", "fingerprint"}。
+    条目数有上限，超出时淘汰最久未使用的记录。
+    查询不存在的用户名的结果也缓存 negative_ttl 秒，任何失效都会使这些结果作废。
+    """
+
+    def __init__(self, max_entries=4096, negative_ttl=NEGATIVE_TTL):
+        self._max_entries = max_entries
+        self._negative_ttl = negative_ttl
+        self._records = OrderedDict()  # username -> record
+        self._missing = OrderedDict()  # username -> (写入时的 generation, 过期时间)
+        self._generation = 0  # 每次失效时递增，用于丢弃失效前发起的加载结果
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+
+    def generation(self):
+        with self._lock:
+            return self._generation
+
+    def get(self, username):
+        with self._lock:
+            record = self._records.get(username)
+            if record is None:
+                self.misses += 1
+                return None
+            self._records.move_to_end(username)
+            self.hits += 1
+            return record
+
+    def is_missing(self, username):
+        """该用户名最近查询过且不存在（期间没有发生失效）时返回True。"""
+        with self._lock:
+            entry = self._missing.get(username)
+            if entry is None:
+                return False
+            generation, expires = entry
+            if generation != self._generation or expires <= time.monotonic():
+                del self._missing[username]
+                return False
+            self.negative_hits += 1
+            return True
+
+    def put_missing(self, username, generation):
+        """记录该用户名不存在；generation 与当前不一致（加载期间发生了失效）时不记录。"""
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._missing.pop(username, None)
+            self._missing[username] = (generation, time.monotonic() + self._negative_ttl)
+            while len(self._missing) > self._max_entries:
+                self._missing.popitem(last=False)
+
+    def put(self, record, generation=None):
+        """
+        写入一条记录。若给出的 generation 与当前不一致（加载期间发生了失效），
+        则放弃写入以免缓存旧数据。
+        """
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return record
+            username = record['username']
+            self._records.pop(username, None)
+            self._records[username] = record
+            while len(self._records) > self._max_entries:
+                self._records.popitem(last=False)
+            return record
+
+    def invalidate(self, username):
+        with self._lock:
+            self._generation += 1
+            self._records.pop(username, None)
+            self._missing.pop(username, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._records.clear()
+            self._missing.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._records),
+                "max_entries": self._max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "negative_entries": len(self._missing),
+                "negative_hits": self.negative_hits,
+                "hit_rate": self.hits / total if total else 0.0
+            }
+
+
+# 全局单例
+user_cache = UserRecordCache()
@@ -0,0 +1,70 @@
+"""
+AIWorkerPool 的重试与取消：退避等待期间保留用户的执行名额，取消后名额只归还一次。
+运行: python -m unittest discover tests  （或 python -m pytest tests）
+"""
+import os
+import sys
+import threading
+import unittest
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+from src.secureim.server import ai
+
+
+class WorkerPoolRetryTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = ai.AIWorkerPool(workers=1)
+        self.call_later = ai.scheduler.call_later
+
+    def tearDown(self):
+        ai.scheduler.call_later = self.call_later
+
+    def run_task(self, username):
+        """提交一个只记录完成的任务，等待其执行，返回是否在超时前完成。"""
+        done = threading.Event()
+        self.pool.submit(username, done.set)
+        return done.wait(2)
+
+    def test_cancel_between_retry_decision_and_parking(self):
+        tasks = []
+
+        def retrying():
+            task = self.pool.current_task()
+            tasks.append(task)
+            self.pool.retry_later(task, 60)
+
+        def call_later(delay, fn, *args):
+            # 工作线程已决定重试、尚未注册取消回调时，连接关闭取消了该任务
+            self.pool.cancel_user("alice")
+            return self.call_later(delay, fn, *args)
+
+        ai.scheduler.call_later = call_later
+        self.pool.submit("alice", retrying)
+
+        self.assertTrue(self.run_task("bob"))
+        ai.scheduler.call_later = self.call_later
+        self.assertTrue(tasks[0].cancelled)
+        self.assertFalse(tasks[0].parked)
+        self.assertEqual(self.pool.cancelled, 1)
+        # 名额已归还且工作线程仍然存活，同一用户的新请求可以执行
+        self.assertTrue(self.run_task("alice"))
+
+    def test_cancel_while_parked_frees_slot(self):
+        parked = threading.Event()
+
+        def retrying():
+            self.pool.retry_later(self.pool.current_task(), 60)
+            parked.set()
+
+        self.pool.submit("alice", retrying)
+        self.assertTrue(parked.wait(2))
+        self.assertEqual(self.pool.cancel_user("alice"), 1)
+
+        self.assertTrue(self.run_task("alice"))
+        self.assertEqual(self.pool.cancelled, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+"""
+LLMRouter 的故障切换与熔断行为，使用 tools/mock_llm_server 启动的本地模拟后端。
+运行: python -m unittest discover tests  （或 python -m pytest tests）
+"""
+import os
+import sys
+import time
+import unittest
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'tools'))
+
+import requests
+
+from mock_llm_server import MockLLMConfig, start_server
+from src.secureim.server import llm_client
+
+MESSAGES = [{"role": "user", "content": "hi"}]
+
+
+class RouterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+    def backend(self, **options):
+        """启动一个模拟后端，返回 (配置, 后端描述)。"""
+        config = MockLLMConfig(**{"latency": 0, "tokens_per_sec": 0, "reply_tokens": 6, **options})
+        server, url = start_server(config)
+        self.servers.append(server)
+        return config, {"url": url, "api_key": "test", "model": "mock"}
+
+    def stream(self, router):
+        return "".join(router.stream_chat_completion(MESSAGES))
+
+
+class FailoverTest(RouterTestCase):
+    def test_fails_over_before_first_token(self):
+        bad, bad_backend = self.backend(fail_rate=1.0, fail_status=503)
+        good, good_backend = self.backend()
+        router = llm_client.LLMRouter([bad_backend, good_backend])
+
+        reply = self.stream(router)
+
+        self.assertTrue(reply.startswith("echo(2)"))
+        self.assertEqual(bad.requests, 1)
+        self.assertEqual(good.requests, 1)
+
+    def test_fails_over_on_backend_configuration_error(self):
+        bad, bad_backend = self.backend(fail_rate=1.0, fail_status=401)
+        good, good_backend = self.backend()
+        router = llm_client.LLMRouter([bad_backend, good_backend])
+        bad_client = router.backends[0]
+        router._score = lambda client, streaming, prior: 0.0 if client is bad_client else 1.0
+
+        for _ in range(llm_client.BREAKER_FAILURE_THRESHOLD):
+            self.assertIn("choices", router.chat_completion(MESSAGES))
+
+        # 401 也计入熔断，之后不再派发给该后端
+        self.assertEqual(router.stats()[f"{bad_backend['url']} (mock)"]["breaker"], llm_client.CircuitBreaker.OPEN)
+        router.chat_completion(MESSAGES)
+        self.assertEqual(bad.requests, llm_client.BREAKER_FAILURE_THRESHOLD)
+
+    def test_request_error_is_raised_without_failover(self):
+        bad, bad_backend = self.backend(fail_rate=1.0, fail_status=400)
+        good, good_backend = self.backend()
+        router = llm_client.LLMRouter([bad_backend, good_backend])
+
+        with self.assertRaises(requests.HTTPError):
+            router.chat_completion(MESSAGES)
+        self.assertEqual(good.requests, 0)
+
+    def test_no_failover_after_partial_output(self):
+        dropping, dropping_backend = self.backend(drop_rate=1.0)
+        good, good_backend = self.backend()
+        router = llm_client.LLMRouter([dropping_backend, good_backend])
+
+        received = []
+        with self.assertRaises(requests.RequestException):
+            for delta in router.stream_chat_completion(MESSAGES):
+                received.append(delta)
+
+        self.assertTrue(received)
+        self.assertEqual(good.requests, 0)
+
+    def test_failing_backend_is_not_preferred(self):
+        bad, bad_backend = self.backend(fail_rate=1.0, fail_status=503)
+        good, good_backend = self.backend()
+        router = llm_client.LLMRouter([bad_backend, good_backend])
+
+        self.stream(router)
+        self.stream(router)
+
+        # 从未成功的后端按其他后端的延迟与自身失败率打分，不再排在第一位
+        self.assertEqual(bad.requests, 1)
+        self.assertEqual(good.requests, 2)
+
+
+class CircuitBreakerTest(RouterTestCase):
+    def setUp(self):
+        super().setUp()
+        self.probe_interval = llm_client.PROBE_INTERVAL
+        llm_client.PROBE_INTERVAL = 0.05
+
+    def tearDown(self):
+        llm_client.PROBE_INTERVAL = self.probe_interval
+        super().tearDown()
+
+    def test_breaker_opens_after_threshold_and_recovers_by_probe(self):
+        bad, bad_backend = self.backend(fail_rate=1.0, fail_status=503)
+        good, good_backend = self.backend()
+        router = llm_client.LLMRouter([bad_backend, good_backend])
+        name = f"{bad_backend['url']} (mock)"
+        bad_client = router.backends[0]
+        # 固定失败后端的排位，使每次请求都先尝试它
+        router._score = lambda client, streaming, prior: 0.0 if client is bad_client else 1.0
+
+        for i in range(llm_client.BREAKER_FAILURE_THRESHOLD):
+            self.assertEqual(router.stats()[name]["breaker"], llm_client.CircuitBreaker.CLOSED)
+            self.stream(router)
+        self.assertEqual(router.stats()[name]["breaker"], llm_client.CircuitBreaker.OPEN)
+
+        self.stream(router)
+        self.assertEqual(bad.requests, llm_client.BREAKER_FAILURE_THRESHOLD)
+
+        bad.fail_rate = 0.0
+        deadline = time.monotonic() + 5
+        while router.stats()[name]["breaker"] != llm_client.CircuitBreaker.CLOSED and time.monotonic() < deadline:
+            time.sleep(0.02)
+        self.assertEqual(router.stats()[name]["breaker"], llm_client.CircuitBreaker.CLOSED)
+        self.assertNotIn(id(bad_client), router._probes)
+
+        self.stream(router)
+        self.assertEqual(bad.requests, llm_client.BREAKER_FAILURE_THRESHOLD + 1)
+
+    def test_success_while_open_stops_probe(self):
+        bad, bad_backend = self.backend(fail_rate=1.0, fail_status=503)
+        router = llm_client.LLMRouter([bad_backend])
+        client = router.backends[0]
+        for _ in range(llm_client.BREAKER_FAILURE_THRESHOLD):
+            with self.assertRaises(requests.HTTPError):
+                router.chat_completion(MESSAGES)
+        handle = router._probes[id(client)]
+
+        # 熔断打开前已发出的请求成功，同样关闭熔断器并停止探测
+        router._record(client)
+
+        self.assertNotIn(id(client), router._probes)
+        self.assertTrue(handle.cancelled)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+"""
+AI链路压测：在进程内驱动 ai.handle_ai_message，模拟多个用户并发发送加密的AI消息。
+
+默认在子进程中启动 tools/mock_llm_server.py 作为后端（不计入本进程CPU），
+报告端到端延迟与首个数据块延迟的 p50/p95/p99、吞吐量以及每个请求消耗的服务器CPU时间。
+用法: python tools/bench_ai.py --users 50 --messages 5 --latency 0.2 --tokens-per-sec 100
+"""
+import argparse
+import os
+import subprocess
+import sys
+import threading
+import time
+
+# 将项目根目录添加到 Python 路径中，以便能够导入 src.secureim 包
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.secureim.server import ai, llm_client, server_crypto
+from src.secureim.server.state import ai_session_keys
+
+
+def start_mock_server(args):
+    """在子进程中启动模拟大模型服务，返回 (进程, 接口地址)。"""
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mock_llm_server.py'),
+               '--port', '0', '--latency', str(args.latency), '--tokens-per-sec', str(args.tokens_per_sec),
+               '--reply-tokens', str(args.reply_tokens), '--fail-rate', str(args.fail_rate)]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline()
+    return process, line.rsplit(' ', 1)[-1].strip()
+
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))]
+
+
+def run_user(username, aes_key, messages, think_time, results):
+    """依次发送消息，每条等待结束帧（或错误）后再发送下一条。"""
+    for i in range(messages):
+        done = threading.Event()
+        record = {"start": time.perf_counter(), "first": None, "end": None, "error": False}
+
+        def send_func(data, record=record, done=done):
+            now = time.perf_counter()
+            if data.get("type") == "ai_stream_chunk":
+                if record["first"] is None:
+                    record["first"] = now
+                if data["payload"].get("final"):
+                    record["end"] = now
+                    done.set()
+            elif data.get("type") == "receive_message":
+                text = server_crypto.decrypt_with_aes(aes_key, data["payload"]["content"]) or b""
+                if "正在生成" not in text.decode('utf-8'):
+                    record["end"], record["error"] = now, True
+                    done.set()
+            else:  # 队列已满等错误响应
+                record["end"], record["error"] = now, True
+                done.set()
+
+        encrypted = server_crypto.encrypt_with_aes(aes_key, f"第{i}条测试消息，请简单回答。".encode('utf-8'))
+        record["start"] = time.perf_counter()
+        ai.handle_ai_message(username, encrypted, send_func)
+        if not done.wait(120):
+            record["error"] = True
+        results.append(record)
+        if think_time:
+            time.sleep(think_time)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SecureIM AI链路压测")
+    parser.add_argument('--users', type=int, default=50, help="模拟用户数")
+    parser.add_argument('--messages', type=int, default=5, help="每个用户发送的消息数")
+    parser.add_argument('--think-time', type=float, default=0.0, help="同一用户两条消息之间的间隔（秒）")
+    parser.add_argument('--workers', type=int, default=ai.AI_WORKERS, help="AI工作线程数")
+    parser.add_argument('--url', help="使用已运行的后端地址，不启动模拟服务")
+    parser.add_argument('--latency', type=float, default=0.2, help="模拟服务的首字延迟（秒）")
+    parser.add_argument('--tokens-per-sec', type=float, default=100.0)
+    parser.add_argument('--reply-tokens', type=int, default=40)
+    parser.add_argument('--fail-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    process = None
+    url = args.url
+    if not url:
+        process, url = start_mock_server(args)
+    ai.AI_BACKENDS = [{"url": url, "api_key": "bench", "model": "mock"}]
+    ai.ai_worker_pool = ai.AIWorkerPool(workers=args.workers, max_backlog=max(ai.AI_MAX_BACKLOG, args.users * 2))
+
+    users = []
+    for i in range(args.users):
+        username = f"bench_ai_{i}"
+        aes_key = os.urandom(32)
+        ai_session_keys.store_key(username, aes_key)
+        users.append((username, aes_key))
+
+    print(f"后端: {url}，用户数 {args.users}，每用户 {args.messages} 条，工作线程 {args.workers}")
+    results = []
+    threads = [threading.Thread(target=run_user, args=(u, k, args.messages, args.think_time, results))
+               for u, k in users]
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+
+    ok = [r for r in results if not r["error"] and r["end"] is not None]
+    total = [(r["end"] - r["start"]) * 1000 for r in ok]
+    first = [(r["first"] - r["start"]) * 1000 for r in ok if r["first"] is not None]
+    print(f"完成 {len(ok)}/{len(results)} 个请求，用时 {wall:.2f}s，吞吐 {len(ok) / wall:.1f} 请求/秒")
+    for name, values in (("端到端", total), ("首个数据块", first)):
+        print(f"{name}延迟(ms): p50={percentile(values, 50):.1f} p95={percentile(values, 95):.1f} "
+              f"p99={percentile(values, 99):.1f}")
+    # 本进程CPU包含服务器AI链路与压测线程本身（加密消息），不包含模拟服务子进程
+    print(f"服务器CPU: 共 {cpu:.2f}s，每请求 {cpu / max(1, len(results)) * 1000:.2f}ms")
+    print(f"工作线程池: {ai.ai_worker_pool.stats()}")
+    for backend, stats in llm_client.get_router(ai.AI_BACKENDS).stats().items():
+        print(f"后端 {backend}: {stats}")
+
+    if process is not None:
+        process.terminate()
+        process.wait()
+
+
+if __name__ == '__main__':
+    main()
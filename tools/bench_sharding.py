@@ -0,0 +1,86 @@
+"""
+分片SQLite写吞吐基准测试。
+
+对不同分片数，用多个线程并发执行用户注册与好友关系写入，报告每秒写操作数。
+单文件基线与各分片一样使用WAL日志模式；基线每次操作新建连接，分片存储复用线程内的长连接，
+两者的差异可对照1分片一行。
+用法: python tools/bench_sharding.py --users 2000 --threads 8 --shards 1 2 4 8
+"""
+import argparse
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+# 将项目根目录添加到 Python 路径中，以便能够导入 src.secureim 包
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.secureim.server.storage import SQLiteStorage, ShardedSQLiteStorage
+
+
+def enable_wal(db_file):
+    """把数据库文件切换为WAL日志模式（与分片存储相同；该设置保存在文件中，对之后的连接都有效）。"""
+    conn = sqlite3.connect(db_file)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+    finally:
+        conn.close()
+
+
+def run_workload(storage, users, threads):
+    """每个线程注册一批用户，并与前一个用户建立好友关系。返回 (写操作数, 耗时秒)。"""
+    storage.initialize()
+    per_thread = users // threads
+    ops = [0] * threads
+
+    def worker(index):
+        previous_id = None
+        for i in range(per_thread):
+            name = f"bench_{index}_{i}"
+            user_id = storage.insert_user(name, "x" * 64, f"{name}@bench.local", "KEY")
+            ops[index] += 1
+            if previous_id is not None:
+                pair = (min(previous_id, user_id), max(previous_id, user_id))
+                storage.add_friendship(*pair)
+                ops[index] += 1
+            previous_id = user_id
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    start = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return sum(ops), time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="分片SQLite写吞吐基准测试")
+    parser.add_argument('--users', type=int, default=2000, help="注册的用户总数")
+    parser.add_argument('--threads', type=int, default=8, help="并发写线程数")
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4, 8], help="要测试的分片数")
+    parser.add_argument('--dir', default=None, help="数据库临时目录所在位置（应位于真实磁盘上，而非tmpfs）")
+    args = parser.parse_args()
+
+    print(f"{'存储':>10} {'写操作':>8} {'耗时(s)':>9} {'ops/s':>10}")
+    # 第一行是未分片的 server.db 作为基线，其余为不同分片数的路由存储
+    layouts = [('单文件', None)] + [(f'{n}分片', n) for n in args.shards]
+    for label, shard_count in layouts:
+        data_dir = tempfile.mkdtemp(prefix="secureim_bench_", dir=args.dir)
+        try:
+            if shard_count is None:
+                db_file = os.path.join(data_dir, 'server.db')
+                enable_wal(db_file)
+                storage = SQLiteStorage(db_file)
+            else:
+                storage = ShardedSQLiteStorage(data_dir, shard_count)
+            ops, elapsed = run_workload(storage, args.users, args.threads)
+            print(f"{label:>10} {ops:>8} {elapsed:>9.2f} {ops / elapsed:>10.0f}")
+        finally:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
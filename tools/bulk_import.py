@@ -0,0 +1,305 @@
+"""
+批量导入与合成数据生成工具，用于在生产规模的数据库上做基准测试。
+
+- import:   从 CSV/JSONL 流式导入用户与好友关系
+- generate: 生成具有幂律度分布的合成社交图
+
+对新建的数据库，数据先以大事务 + executemany 写入不带约束的暂存表，全部载入后去重，
+再按主键顺序复制到与 SQLiteStorage.initialize 完全相同的正式表中。
+仅支持单文件布局（database.SHARD_COUNT = 1）。
+
+用法:
+  python tools/bulk_import.py import --users users.csv --friendships friends.jsonl
+  python tools/bulk_import.py generate --users 1000000 --avg-degree 20
+"""
+import argparse
+import bisect
+import csv
+import itertools
+import json
+import os
+import random
+import sqlite3
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+# 将项目根目录添加到 Python 路径中，以便能够导入 src.secureim 包
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.secureim.server import database, password_hashing
+from src.secureim.server.storage import SQLiteStorage
+
+BATCH_SIZE = 50000
+
+
+def read_records(path):
+    """按行流式读取 CSV（带表头）或 JSONL 文件，产出字典。"""
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        if path.endswith('.jsonl') or path.endswith('.json'):
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+        else:
+            yield from csv.DictReader(f)
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def open_for_load(db_file):
+    """
+    打开数据库并关闭载入期间不需要的持久化开销。
+    返回 (连接, 是否为新库)；新库先写入不带约束的暂存表，由 finalize_users / finalize 复制到正式表。
+    """
+    fresh = not os.path.exists(db_file) or os.path.getsize(db_file) == 0
+    if fresh:
+        # 正式表的结构与服务器一致（唯一约束、好友关系主键与反向索引）
+        SQLiteStorage(db_file).initialize()
+    conn = sqlite3.connect(db_file, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=OFF")
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("PRAGMA cache_size=-262144")  # 256MB页缓存
+    conn.execute("PRAGMA temp_store=MEMORY")
+    if fresh:
+        conn.execute('''
+            CREATE TABLE users_load (
+                id INTEGER PRIMARY KEY,
+                username TEXT NOT NULL,
+                password_hash TEXT NOT NULL,
+                email TEXT NOT NULL,
+                public_key TEXT NOT NULL
+            );
+        ''')
+        conn.execute('''
+            CREATE TABLE friendships_load (
+                user_id1 INTEGER NOT NULL,
+                user_id2 INTEGER NOT NULL
+            );
+        ''')
+    return conn, fresh
+
+
+def _has_table(conn, name):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone() is not None
+
+
+def finalize_users(conn, fresh):
+    """
+    用户载入完成后去除重复的用户名/邮箱（保留最先出现的一条），按ID复制到正式的 users 表
+    （须在载入好友关系之前完成）。
+    """
+    if not fresh or not _has_table(conn, 'users_load'):
+        return
+    start = time.perf_counter()
+    conn.execute("BEGIN")
+    conn.execute("DELETE FROM users_load WHERE id NOT IN (SELECT MIN(id) FROM users_load GROUP BY username)")
+    conn.execute("DELETE FROM users_load WHERE id NOT IN (SELECT MIN(id) FROM users_load GROUP BY email)")
+    conn.execute("INSERT INTO users (id, username, password_hash, email, public_key) "
+                 "SELECT id, username, password_hash, email, public_key FROM users_load ORDER BY id")
+    conn.execute("DROP TABLE users_load")
+    conn.execute("COMMIT")
+    print(f"用户表整理完成，用时 {time.perf_counter() - start:.1f}s")
+
+
+def finalize(conn, fresh):
+    """去除重复的好友关系并按主键顺序复制到正式表，然后恢复正常的持久化设置。"""
+    if fresh:
+        finalize_users(conn, fresh)
+        start = time.perf_counter()
+        conn.execute("BEGIN")
+        conn.execute("INSERT OR IGNORE INTO friendships (user_id1, user_id2) "
+                     "SELECT user_id1, user_id2 FROM friendships_load ORDER BY user_id1, user_id2")
+        conn.execute("DROP TABLE friendships_load")
+        conn.execute("COMMIT")
+        print(f"好友关系表整理完成，用时 {time.perf_counter() - start:.1f}s")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_friendships_reverse ON friendships(user_id2, user_id1)")
+    conn.execute("PRAGMA journal_mode=DELETE")
+    conn.execute("ANALYZE")
+    if fresh:
+        # 回收暂存表占用的页面
+        conn.execute("VACUUM")
+    conn.close()
+
+
+def hash_rows(rows, workers):
+    """为只提供明文密码的记录计算 scrypt 哈希（在进程池中并行执行）。"""
+    plain = [i for i, row in enumerate(rows) if not row.get('password_hash')]
+    if plain:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            hashes = pool.map(password_hashing.compute_hash, (rows[i]['password'] for i in plain), chunksize=64)
+            for i, password_hash in zip(plain, hashes):
+                rows[i]['password_hash'] = password_hash
+    return rows
+
+
+def load_users(conn, records, fresh, workers=password_hashing.HASH_WORKERS):
+    """批量写入用户，每 BATCH_SIZE 行一个事务。返回写入行数。"""
+    sql = ("INSERT INTO users_load" if fresh else "INSERT OR IGNORE INTO users") + " (username, password_hash, email, public_key) VALUES (?, ?, ?, ?)"
+    total = 0
+    start = time.perf_counter()
+    for batch in batched(records, BATCH_SIZE):
+        batch = hash_rows(batch, workers)
+        conn.execute("BEGIN")
+        conn.executemany(sql, ((r['username'], r['password_hash'], r['email'], r['public_key']) for r in batch))
+        conn.execute("COMMIT")
+        total += len(batch)
+        print(f"\r已导入用户 {total}（{total / (time.perf_counter() - start):.0f} 行/秒）", end='', flush=True)
+    print()
+    return total
+
+
+def load_user_ids(conn):
+    return {username: user_id for user_id, username in conn.execute("SELECT id, username FROM users")}
+
+
+def max_user_id(conn):
+    return conn.execute("SELECT COALESCE(MAX(id), 0) FROM users").fetchone()[0]
+
+
+def user_ids_after(conn, user_id):
+    """ID大于 user_id 的所有用户（即本次导入实际写入的用户，ID自增且不会复用）。"""
+    return [row[0] for row in conn.execute("SELECT id FROM users WHERE id > ? ORDER BY id", (user_id,))]
+
+
+def load_friendships(conn, pairs, fresh):
+    """批量写入好友关系，pairs 为用户ID对，写入前规整为 (较小ID, 较大ID)。返回写入行数。"""
+    sql = ("INSERT INTO friendships_load" if fresh else "INSERT OR IGNORE INTO friendships") + " (user_id1, user_id2) VALUES (?, ?)"
+    total = 0
+    start = time.perf_counter()
+    normalized = ((a, b) if a < b else (b, a) for a, b in pairs if a != b)
+    for batch in batched(normalized, BATCH_SIZE):
+        conn.execute("BEGIN")
+        conn.executemany(sql, batch)
+        conn.execute("COMMIT")
+        total += len(batch)
+        print(f"\r已导入好友关系 {total}（{total / (time.perf_counter() - start):.0f} 行/秒）", end='', flush=True)
+    print()
+    return total
+
+
+def friendship_pairs_from_records(records, user_ids):
+    """把 (user1, user2) 用户名记录映射为ID对，跳过不存在的用户。"""
+    for record in records:
+        id1 = user_ids.get(record.get('user1'))
+        id2 = user_ids.get(record.get('user2'))
+        if id1 and id2:
+            yield id1, id2
+
+
+def synthetic_users(count, public_key_pem, password_hash, prefix="user"):
+    for i in range(count):
+        yield {
+            "username": f"{prefix}{i}",
+            "email": f"{prefix}{i}@bench.local",
+            "public_key": public_key_pem,
+            "password_hash": password_hash
+        }
+
+
+def power_law_edges(user_ids, avg_degree, exponent, seed=None):
+    """
+    按 Chung-Lu 模型生成边：节点 i 的期望度数正比于 (i+1)^(-1/(exponent-1))，
+    因此度分布服从指数为 exponent 的幂律。产出 (id1, id2)，可能包含少量重复边（载入后去重）。
+    """
+    rng = random.Random(seed)
+    n = len(user_ids)
+    edge_count = n * avg_degree // 2
+    gamma = 1.0 / (exponent - 1.0)
+    cumulative = list(itertools.accumulate((i + 1) ** -gamma for i in range(n)))
+    # 打乱节点顺序，避免低ID用户恰好都是高度数节点
+    order = list(user_ids)
+    rng.shuffle(order)
+    total_weight = cumulative[-1]
+    for _ in range(edge_count):
+        a = bisect.bisect(cumulative, rng.random() * total_weight)
+        b = bisect.bisect(cumulative, rng.random() * total_weight)
+        if a != b:
+            yield order[min(a, n - 1)], order[min(b, n - 1)]
+
+
+def make_public_key():
+    """生成一个真实的RSA公钥供所有合成用户共用，使密钥交换在格式上可用。"""
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from cryptography.hazmat.primitives import serialization
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    return key.public_key().public_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo
+    ).decode('utf-8')
+
+
+def add_ai_friendships(db_file):
+    """创建AI用户（如不存在），并与所有用户建立好友关系，与正常注册的结果一致。"""
+    database.set_storage(SQLiteStorage(db_file))
+    database.create_tables()
+    conn = sqlite3.connect(db_file, isolation_level=None)
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("BEGIN")
+    conn.execute("""
+        INSERT OR IGNORE INTO friendships (user_id1, user_id2)
+        SELECT MIN(a.id, u.id), MAX(a.id, u.id) FROM users u, users a
+        WHERE a.username = 'ai' AND u.id != a.id
+    """)
+    conn.execute("COMMIT")
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SecureIM 批量导入与合成数据生成")
+    parser.add_argument('--db', default=database.DB_FILE, help="目标SQLite文件（默认 data/server.db）")
+    parser.add_argument('--no-ai-friend', action='store_true', help="不为导入的用户添加AI好友")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    imp = sub.add_parser('import', help="从CSV/JSONL导入")
+    imp.add_argument('--users', help="用户文件，字段: username,email,public_key,password 或 password_hash")
+    imp.add_argument('--friendships', help="好友关系文件，字段: user1,user2（用户名）")
+
+    gen = sub.add_parser('generate', help="生成幂律度分布的合成社交图")
+    gen.add_argument('--users', type=int, required=True, help="用户数量")
+    gen.add_argument('--avg-degree', type=int, default=20, help="平均好友数")
+    gen.add_argument('--exponent', type=float, default=2.5, help="度分布的幂律指数（>2）")
+    gen.add_argument('--password', default='benchmark1', help="所有合成用户共用的密码")
+    gen.add_argument('--prefix', default='user', help="合成用户名前缀")
+    gen.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    conn, fresh = open_for_load(args.db)
+    try:
+        if args.command == 'import':
+            if args.users:
+                load_users(conn, read_records(args.users), fresh)
+                finalize_users(conn, fresh)
+            if args.friendships:
+                user_ids = load_user_ids(conn)
+                load_friendships(conn, friendship_pairs_from_records(read_records(args.friendships), user_ids), fresh)
+        else:
+            # 哈希只计算一次，所有合成用户共用
+            password_hash = password_hashing.compute_hash(args.password)
+            # 只在本次实际写入的用户之间连边：已有同名用户（被忽略的行）与恰好同前缀的其他用户不参与
+            previous_max_id = max_user_id(conn)
+            load_users(conn, synthetic_users(args.users, make_public_key(), password_hash, args.prefix), fresh)
+            finalize_users(conn, fresh)
+            new_ids = user_ids_after(conn, previous_max_id)
+            if new_ids:
+                load_friendships(conn, power_law_edges(new_ids, args.avg_degree, args.exponent, args.seed), fresh)
+            else:
+                print("没有写入新用户（用户名已全部存在），跳过生成好友关系")
+    finally:
+        finalize(conn, fresh)
+
+    if not args.no_ai_friend:
+        add_ai_friendships(args.db)
+    print(f"完成，总用时 {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
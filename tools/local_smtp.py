@@ -0,0 +1,151 @@
+"""
+本地SMTP接收服务（smtpd 模块已在 Python 3.12 中移除），用于在没有真实邮箱的情况下测试发信队列。
+
+只实现发信所需的最小命令集（EHLO/HELO、MAIL、RCPT、DATA、RSET、NOOP、QUIT），不支持STARTTLS与登录，
+服务器端需配置 EMAIL_CONFIG: smtp_server='127.0.0.1'、smtp_port=端口、sender_password=''、use_tls=False。
+收到的邮件打印摘要，可选保存为 .eml 文件；支持故障注入（按比例返回451临时错误、每个连接发送若干封后断开）。
+用法: python tools/local_smtp.py --port 2525 --save-dir data/mail --fail-rate 0.1 --drop-after 5
+"""
+import argparse
+import os
+import random
+import socketserver
+import threading
+import time
+from email import message_from_bytes
+from email.header import decode_header, make_header
+
+
+class LocalSMTPConfig:
+    def __init__(self, save_dir=None, fail_rate=0.0, drop_after=0, quiet=False, seed=None):
+        self.save_dir = save_dir
+        self.fail_rate = fail_rate      # RCPT 返回 451 的比例
+        self.drop_after = drop_after    # 每个连接接收多少封邮件后直接断开（0 表示不断开）
+        self.quiet = quiet
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.messages = []              # (发件人, 收件人列表, 原始邮件)
+        self.connections = 0
+
+    def roll(self, rate):
+        with self.lock:
+            return self.random.random() < rate
+
+
+class LocalSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def make_handler(config):
+    class LocalSMTPHandler(socketserver.StreamRequestHandler):
+        def reply(self, line):
+            self.wfile.write(line.encode('ascii') + b"\r\n")
+
+        def read_data(self):
+            lines = []
+            while True:
+                line = self.rfile.readline()
+                if not line or line in (b".\r\n", b".\n"):
+                    break
+                if line.startswith(b".."):
+                    line = line[1:]  # 去掉透明转义的点
+                lines.append(line)
+            return b"".join(lines)
+
+        def store(self, sender, recipients, data):
+            with config.lock:
+                config.messages.append((sender, recipients, data))
+                index = len(config.messages)
+            if config.save_dir:
+                with open(os.path.join(config.save_dir, f"{int(time.time() * 1000)}-{index}.eml"), 'wb') as f:
+                    f.write(data)
+            if not config.quiet:
+                subject = str(make_header(decode_header(message_from_bytes(data).get('Subject', ''))))
+                print(f"[{index}] {sender} -> {', '.join(recipients)}: {subject} ({len(data)} 字节)", flush=True)
+
+        def handle(self):
+            with config.lock:
+                config.connections += 1
+            self.reply("220 localhost SecureIM local SMTP")
+            sender, recipients, received = None, [], 0
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    return
+                command, _, argument = line.decode('utf-8', 'replace').strip().partition(' ')
+                command = command.upper()
+                if command == 'EHLO':
+                    self.reply("250-localhost")
+                    self.reply("250 8BITMIME")
+                elif command == 'HELO':
+                    self.reply("250 localhost")
+                elif command == 'MAIL':
+                    sender, recipients = argument.partition(':')[2].strip().strip('<>'), []
+                    self.reply("250 OK")
+                elif command == 'RCPT':
+                    if sender is None:
+                        self.reply("503 need MAIL command")
+                    elif config.roll(config.fail_rate):
+                        self.reply("451 injected temporary failure")
+                    else:
+                        recipients.append(argument.partition(':')[2].strip().strip('<>'))
+                        self.reply("250 OK")
+                elif command == 'DATA':
+                    if not recipients:
+                        self.reply("503 need RCPT command")
+                        continue
+                    self.reply("354 End data with <CR><LF>.<CR><LF>")
+                    self.store(sender, recipients, self.read_data())
+                    sender, recipients = None, []
+                    received += 1
+                    self.reply("250 OK")
+                    if config.drop_after and received >= config.drop_after:
+                        return  # 模拟服务器关闭空闲或长时间使用的连接
+                elif command == 'RSET':
+                    sender, recipients = None, []
+                    self.reply("250 OK")
+                elif command == 'NOOP':
+                    self.reply("250 OK")
+                elif command == 'QUIT':
+                    self.reply("221 Bye")
+                    return
+                else:
+                    self.reply("502 command not implemented")
+
+    return LocalSMTPHandler
+
+
+def start_server(config, host='127.0.0.1', port=0):
+    """在后台线程中启动本地SMTP服务，返回 (server, 端口)。"""
+    server = LocalSMTPServer((host, port), make_handler(config))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, server.server_address[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="用于测试的本地SMTP接收服务")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=2525)
+    parser.add_argument('--save-dir', help="将收到的邮件保存为 .eml 文件的目录")
+    parser.add_argument('--fail-rate', type=float, default=0.0, help="RCPT 返回451临时错误的比例")
+    parser.add_argument('--drop-after', type=int, default=0, help="每个连接接收多少封邮件后断开")
+    parser.add_argument('--quiet', action='store_true', help="不打印收到的邮件")
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.save_dir:
+        os.makedirs(args.save_dir, exist_ok=True)
+    config = LocalSMTPConfig(args.save_dir, args.fail_rate, args.drop_after, args.quiet, args.seed)
+    server = LocalSMTPServer((args.host, args.port), make_handler(config))
+    print(f"本地SMTP服务已启动: {args.host}:{server.server_address[1]}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(f"共 {config.connections} 个连接，收到 {len(config.messages)} 封邮件")
+
+
+if __name__ == '__main__':
+    main()
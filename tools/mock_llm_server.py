@@ -0,0 +1,149 @@
+"""
+本地模拟大模型服务，提供 OpenAI 兼容的 /v1/chat/completions（流式与非流式）与 /v1/models 接口，
+用于在没有真实模型的情况下测试与压测AI链路。
+
+可配置首字延迟、生成速度、回复长度，以及故障注入（按比例返回错误状态码或在流式输出中途断开）。
+用法: python tools/mock_llm_server.py --port 1234 --latency 0.2 --tokens-per-sec 50 --fail-rate 0.05
+"""
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MockLLMConfig:
+    def __init__(self, latency=0.2, tokens_per_sec=50.0, reply_tokens=40, fail_rate=0.0, fail_status=503,
+                 drop_rate=0.0, seed=None):
+        self.latency = latency            # 首字延迟（秒）
+        self.tokens_per_sec = tokens_per_sec
+        self.reply_tokens = reply_tokens  # 每条回复的token数
+        self.fail_rate = fail_rate        # 直接返回 fail_status 的请求比例
+        self.fail_status = fail_status
+        self.drop_rate = drop_rate        # 流式输出到一半时断开连接的请求比例
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    def roll(self, rate):
+        with self.lock:
+            return self.random.random() < rate
+
+
+class MockLLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # 客户端丢弃连接（例如收到注入的错误后不读响应体）属于正常情况，不打印堆栈
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+
+
+def make_handler(config):
+    class MockLLMHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # 支持 keep-alive，与真实服务一致
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, status, body):
+            data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _write_chunk(self, data):
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.flush()
+
+        def do_GET(self):
+            if self.path.rstrip('/').endswith('/models'):
+                self._send_json(200, {"object": "list", "data": [{"id": "mock", "object": "model"}]})
+            else:
+                self._send_json(404, {"error": {"message": "not found"}})
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            with config.lock:
+                config.requests += 1
+            if config.roll(config.fail_rate):
+                self._send_json(config.fail_status, {"error": {"message": "injected failure"}})
+                return
+
+            prompt = (body.get("messages") or [{}])[-1].get("content", "")
+            tokens = [f"tok{i} " for i in range(config.reply_tokens)]
+            if prompt:
+                tokens[0] = f"echo({len(prompt)}) "
+            interval = 1.0 / config.tokens_per_sec if config.tokens_per_sec > 0 else 0
+            time.sleep(config.latency)
+
+            if not body.get("stream"):
+                time.sleep(interval * (len(tokens) - 1))
+                self._send_json(200, {
+                    "id": f"chatcmpl-{uuid.uuid4().hex}",
+                    "object": "chat.completion",
+                    "model": body.get("model", "mock"),
+                    "choices": [{"index": 0, "finish_reason": "stop",
+                                 "message": {"role": "assistant", "content": "".join(tokens)}}]
+                })
+                return
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            drop_at = len(tokens) // 2 if config.roll(config.drop_rate) else None
+            for index, token in enumerate(tokens):
+                if index == drop_at:
+                    self.close_connection = True
+                    return
+                if index:
+                    time.sleep(interval)
+                event = {"choices": [{"index": 0, "delta": {"content": token}}]}
+                self._write_chunk(f"data: {json.dumps(event)}\n\n".encode('utf-8'))
+            self._write_chunk(b"data: [DONE]\n\n")
+            self._write_chunk(b"")
+
+    return MockLLMHandler
+
+
+def start_server(config, host='127.0.0.1', port=0):
+    """在后台线程中启动模拟服务，返回 (server, chat/completions 地址)。"""
+    server = MockLLMServer((host, port), make_handler(config))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v1/chat/completions"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI兼容的本地模拟大模型服务")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1234)
+    parser.add_argument('--latency', type=float, default=0.2, help="首字延迟（秒）")
+    parser.add_argument('--tokens-per-sec', type=float, default=50.0, help="生成速度")
+    parser.add_argument('--reply-tokens', type=int, default=40, help="每条回复的token数")
+    parser.add_argument('--fail-rate', type=float, default=0.0, help="返回错误状态码的请求比例")
+    parser.add_argument('--fail-status', type=int, default=503)
+    parser.add_argument('--drop-rate', type=float, default=0.0, help="流式输出中途断开的请求比例")
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    config = MockLLMConfig(args.latency, args.tokens_per_sec, args.reply_tokens, args.fail_rate,
+                           args.fail_status, args.drop_rate, args.seed)
+    server = MockLLMServer((args.host, args.port), make_handler(config))
+    print(f"模拟大模型服务已启动: http://{args.host}:{server.server_address[1]}/v1/chat/completions", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(f"共处理 {config.requests} 个请求")
+
+
+if __name__ == '__main__':
+    main()